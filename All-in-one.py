@@ -1,90 +1,301 @@
+import io
 import os
-import numpy as np
-from PIL import Image, ImageOps, ImageEnhance
+import time
+import shutil
+import signal
+import asyncio
+import threading
+import zipfile
+import argparse
+import itertools
+from PIL import Image
 import subprocess
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from Blocks import gray_tail_height, count_gray_blocks, detect_gray_tail
+from Scan import check_crop, decode_jpeg, shift_mcus
+from Enhance import auto_color, auto_color_strips, strip_rows
+from Manifest import MANIFEST_NAME, Manifest, current_hash, data_hash, is_complete, region_hash
+from Folders import JPEG_PATTERNS, iter_files, original_stem
+from Metrics import FILE_STAGE, NULL_TRACER, Tracer
+from Offsets import batch_offsets
+from References import ReferenceLibrary, payload_hints
+from Archives import archive_stem, is_archive, iter_members
+from Triage import triage_folder
+from Segments import header_end
+from Files import copy_range
+from Watch import POLL_INTERVAL, STATUS_NAME, DropFolderWatcher, ServiceStatus
+
+START_OFFSET = 153605  # Encrypted bytes at the start of every file
+TRAILER_SIZE = 334  # Bytes the ransomware appends to every file
+MCU_ADJUSTMENT = 22  # Subtracted from the detected number of good MCUs before inserting
+AUTO_COLOR_FACTORS = {"cutoff": 1, "sharpness": 3, "color": 3}
+OUTPUT_QUALITY = 95
+
+# Files sampled when the offsets are detected from the files themselves
+OFFSET_SAMPLE = 32
+# Detected offsets less certain than this are reported but not used
+OFFSET_CONFIDENCE = 0.9
+
+# Files handed to the worker processes ahead of the results being collected, per worker
+JOBS_AHEAD = 4
+
+# Stages a file goes through, in order; the manifest records which of them finished
+STAGES = ("repair", "shift", "color")
 
 class ImageProcessor:
-    def __init__(self, output_text_widget=None):
+    # Reference headers shared by every processor in this process, keyed by (path, mtime, size)
+    _reference_headers = {}
+    # Guards _reference_headers against the io_jobs threads loading references at the same time
+    _reference_lock = threading.Lock()
+
+    def __init__(self, output_text_widget=None, in_memory=False, keep_intermediates=False, force=False,
+                 recursive=False, patterns=JPEG_PATTERNS, metrics_path=None, metrics=False,
+                 start_offset=START_OFFSET, trailer_size=TRAILER_SIZE, interval_jobs=1, memory_budget=None,
+                 dedupe=False, lossless_crop=False, sort=False):
         self.outputText = output_text_widget  # Assuming outputText is a text widget for logging
+        self.in_memory = in_memory  # Pass each file between stages in memory and write only the results
+        self.keep_intermediates = keep_intermediates  # Also write the in-memory intermediate files, for debugging
+        self.force = force  # Process files again even when the manifest says they are done
+        self.recursive = recursive  # Also process the subfolders of the encrypted folder
+        self.patterns = patterns  # Name patterns of the encrypted files, e.g. "*.jpg.locked"
+        self.metrics_path = metrics_path  # JSON lines file for per stage metrics
+        self.start_offset = start_offset  # Encrypted bytes at the start of every file
+        self.trailer_size = trailer_size  # Bytes appended after the JPEG data
+        self.interval_jobs = interval_jobs  # Threads or processes the restart intervals of one image are split between
+        self.memory_budget = memory_budget  # Bytes a file's color and block analysis stages may use, None for no cap
+        self.dedupe = dedupe  # Process files with the same payload once and link the outputs to the others
+        # Crop on the compressed stream instead of re-encoding; lossless, but the pure Python scan walk is slower
+        self.lossless_crop = lossless_crop
+        self.sort = sort  # Hand out each folder's files in name order instead of as the folder is read
+        self.payload_hashes = {}  # name: payload hash of the files of the folder being processed, when deduplicating
+        self.dedupe_stats = None  # Work the last deduplicated folder saved
+        self.deferred_writes = None  # (path, bytes) of the result files held back for the caller to write, when a list
+        # Times and counts each stage when metrics are on; the stand-in does nothing when they are off
+        self.tracer = Tracer(metrics_path) if metrics or metrics_path else NULL_TRACER
+
+    # Options a worker process needs to build an equivalent processor
+    def options(self):
+        return {"in_memory": self.in_memory, "keep_intermediates": self.keep_intermediates, "force": self.force,
+                "recursive": self.recursive, "patterns": self.patterns, "metrics": self.tracer.enabled,
+                "start_offset": self.start_offset, "trailer_size": self.trailer_size,
+                "interval_jobs": self.interval_jobs, "memory_budget": self.memory_budget, "dedupe": self.dedupe,
+                "lossless_crop": self.lossless_crop, "sort": self.sort}
+
+    # Parameters that change the outputs; a manifest entry made with other parameters is stale
+    def parameters(self):
+        return {"start_offset": self.start_offset, "trailer_size": self.trailer_size, "mcu_adjustment": MCU_ADJUSTMENT,
+                "mcu_insert": "scan", "lossless_crop": self.lossless_crop, "auto_color": AUTO_COLOR_FACTORS,
+                "quality": OUTPUT_QUALITY}
 
     # Function to load a file
     def load_file(self, filepath):
         with open(filepath, 'rb') as file:
-            return file.read()
+            data = file.read()
+        self.tracer.count(bytes_read=len(data))
+        return data
 
-    # Function to find the last FF DA + 12 bytes in a reference JPEG file
+    # Function to find the header of a reference JPEG file, up to the end of its first SOS segment
     def find_ff_da_plus_12(self, data):
+        # The first SOS segment, whatever its length, so an embedded thumbnail's SOS is never picked
+        end = header_end(data)
+        if end is not None:
+            return data[:end]
+        # Fall back to the last SOS marker for references whose header cannot be walked
         marker = b'\xFF\xDA'
         index = data.rfind(marker)
         if index != -1:
             return data[:index + 12]  # Include FF DA + 12 bytes
         return None
 
+    # Function to get the (1) part of a reference JPEG, reading and parsing it once per process
+    def load_reference_header(self, reference_path):
+        stat = os.stat(reference_path)
+        path = os.path.abspath(reference_path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+
+        headers = ImageProcessor._reference_headers
+        with ImageProcessor._reference_lock:
+            if key in headers:
+                return headers[key]
+        # Read outside the lock, so a slow share does not hold up the threads whose reference is cached
+        header = self.find_ff_da_plus_12(self.load_file(reference_path))
+        with ImageProcessor._reference_lock:
+            # Drop entries for earlier versions of the same file before caching this one
+            for stale_key in [k for k in headers if k[0] == path]:
+                del headers[stale_key]
+            headers[key] = header
+        return header
+
+    # Function to get a copy of the reference headers loaded so far, to hand to new workers
+    @staticmethod
+    def reference_headers():
+        with ImageProcessor._reference_lock:
+            return dict(ImageProcessor._reference_headers)
+
+    # Function to load several reference headers up front, returns {path: header or None}
+    def preload_references(self, reference_paths):
+        return {reference_path: self.load_reference_header(reference_path) for reference_path in reference_paths}
+
+    # Function to get the (start, end) byte range kept from an encrypted JPEG file of the given size
+    def encrypted_payload_range(self, size):
+        start, end, _ = slice(self.start_offset, max(size - self.trailer_size, 0)).indices(size)
+        return start, max(start, end)
+
     # Function to process the encrypted JPEG file
     def process_encrypted_jpeg(self, data):
-        start_offset = 153605
-        end_offset = -334
-        return data[start_offset:end_offset]
+        start, end = self.encrypted_payload_range(len(data))
+        return data[start:end]
 
     # Function to repair the JPEG files
     def repair_jpeg(self, reference_path, encrypted_path, output_folder):
-        reference_data = self.load_file(reference_path)
-        encrypted_data = self.load_file(encrypted_path)
-
         # Get the (1) part from the reference JPEG
-        ref_part = self.find_ff_da_plus_12(reference_data)
+        ref_part = self.load_reference_header(reference_path)
 
         if ref_part is None:
             if self.outputText is not None:
                 self.outputText.append(f"Could not find FF DA marker in {reference_path}")
             return
 
-        # Get the (2) part from the encrypted JPEG
-        encrypted_part = self.process_encrypted_jpeg(encrypted_data)
-
-        # Merge (1) and (2)
-        merged_data = ref_part + encrypted_part
-
         # Prepare the output file name and save it to the Repaired folder
         os.makedirs(output_folder, exist_ok=True)
-        output_filename = os.path.join(output_folder, os.path.basename(encrypted_path).split('.')[0] + '.JPG')
-        with open(output_filename, 'wb') as output_file:
-            output_file.write(merged_data)
+        output_filename = self.repaired_filename(encrypted_path, output_folder)
+
+        # Merge (1) and the (2) part of the encrypted JPEG, streaming (2) straight from disk
+        with self.tracer.stage("repair"), open(encrypted_path, 'rb') as encrypted_file, \
+                open(output_filename, 'wb') as output_file:
+            start, end = self.encrypted_payload_range(os.fstat(encrypted_file.fileno()).st_size)
+            output_file.write(ref_part)
+            copy_range(encrypted_file, output_file, start, end - start)
+            self.tracer.count(bytes_read=end - start, bytes_written=len(ref_part) + end - start)
 
         if self.outputText is not None:
             self.outputText.append(f"Repaired file saved as {output_filename}")
 
+        return output_filename
+
+    # Function to write a result file, or hold it back for the caller when writes are deferred
+    def write_file(self, path, data):
+        if self.deferred_writes is not None:
+            self.deferred_writes.append((path, bytes(data)))
+            return
+        with open(path, 'wb') as output_file:
+            output_file.write(data)
+
+    # Function to check whether a result file is on disk or held back for the caller to write
+    def is_written(self, path):
+        if self.deferred_writes and any(pending_path == path for pending_path, _ in self.deferred_writes):
+            return True
+        return os.path.isfile(path)
+
+    # Function to write the result files held back so far
+    def flush_writes(self):
+        if self.deferred_writes:
+            write_files(self.deferred_writes)
+            self.deferred_writes = []
+
+    # Function to get the Repaired folder file name for an encrypted JPEG file
+    def repaired_filename(self, encrypted_path, output_folder):
+        return os.path.join(output_folder, original_stem(os.path.basename(encrypted_path)) + '.JPG')
+
+    # Function to claim the Repaired file name of an encrypted file in claimed, {path: encrypted path}, for this
+    # run; returns False, logging it, when another file already has it, e.g. IMG_1.jpg next to IMG_1.jpg.locked
+    def claim_output(self, encrypted_path, output_folder, claimed):
+        path = self.repaired_filename(encrypted_path, output_folder)
+        owner = claimed.setdefault(os.path.normcase(path), encrypted_path)
+        if owner != encrypted_path:
+            if self.outputText is not None:
+                self.outputText.append(f"Skipping {encrypted_path}, its output {path} is already that of {owner}.")
+            return False
+        return True
+
+    # Function to get every output path of an encrypted JPEG file: the repaired file, the cropped copy and the
+    # MCU shifted result
+    def output_paths(self, encrypted_path, output_folder):
+        repaired_path = self.repaired_filename(encrypted_path, output_folder)
+        repaired_folder = os.path.join(output_folder, "Repaired")
+        stem = os.path.basename(repaired_path).rsplit('.', 1)[0]
+        return [repaired_path, os.path.join(repaired_folder, os.path.basename(repaired_path)),
+                os.path.join(repaired_folder, stem + "_repaired.JPG")]
+
+    # Function to remove the outputs of a file that are hardlinked to a duplicate's, so writing them again
+    # in place cannot change the other file's outputs
+    def unlink_shared_outputs(self, encrypted_path, output_folder):
+        for path in self.output_paths(encrypted_path, output_folder):
+            try:
+                if os.stat(path).st_nlink > 1:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    # Function to repair a JPEG file in memory, returns the merged bytes or None
+    def repair_data(self, reference_path, encrypted_path):
+        # Get the (1) part from the reference JPEG
+        ref_part = self.load_reference_header(reference_path)
+
+        if ref_part is None:
+            if self.outputText is not None:
+                self.outputText.append(f"Could not find FF DA marker in {reference_path}")
+            return None
+
+        with self.tracer.stage("repair"):
+            merged_data = self.read_merged(ref_part, encrypted_path)
+            self.tracer.count(bytes_read=len(merged_data) - len(ref_part))
+        return merged_data
+
+    # Function to read the (2) part of an encrypted JPEG straight into place after (1), returns the merged bytes
+    def read_merged(self, ref_part, encrypted_path):
+        with open(encrypted_path, 'rb') as encrypted_file:
+            start, end = self.encrypted_payload_range(os.fstat(encrypted_file.fileno()).st_size)
+            merged_data = bytearray(len(ref_part) + end - start)
+            merged_data[:len(ref_part)] = ref_part
+            encrypted_file.seek(start)
+            encrypted_file.readinto(memoryview(merged_data)[len(ref_part):])
+        return merged_data
+
+    # Function to get the strip height that keeps a stage on the image within the memory budget, None when it fits whole
+    def strip_rows(self, im):
+        return strip_rows(im, self.memory_budget) if self.memory_budget else None
+
+    # Function to decode JPEG bytes, in bands of restart intervals on interval_jobs threads when the scan allows it
+    def decode_image(self, data):
+        return decode_jpeg(data, self.interval_jobs)
+
+    # Function to open an image file, decoded in bands like decode_image when interval_jobs is above 1
+    def open_image(self, image_path):
+        if self.interval_jobs > 1:
+            return self.decode_image(self.load_file(image_path))
+        return Image.open(image_path)
+
     def shift_mcu(self, jpg_file):
         if not os.path.isfile(jpg_file) or not jpg_file.lower().endswith((".jpg", ".jpeg")):
             if self.outputText is not None:
                 self.outputText.append(f"Invalid file path: {jpg_file}. Please provide a valid JPEG file.")
-            return
+            return False
 
+        # Decoded at full size, as in process_file_in_memory, so a block with only its AC terms left is not grey
         try:
-            img = Image.open(jpg_file)
-            data = np.array(img, dtype=np.uint8)
+            with self.tracer.stage("decode"):
+                data = self.load_file(jpg_file)
+                img = self.decode_image(data)
+                self.tracer.count(pixels=img.width * img.height)
         except Exception as e:
             if self.outputText is not None:
                 self.outputText.append(f"Error opening image {jpg_file}: {str(e)}")
-            return
-
-        # Crop the height to remove bottom non-MCU corrupted blocks
-        height_cropped = self.crop_non_mcu_blocks(data)
+            return False
 
-        # Re-calculate the data shape after cropping
-        data_cropped = data[:height_cropped, :, :]
+        with self.tracer.stage("shift"):
+            return self.shift_mcu_image(img, data, jpg_file)
 
-        # Detect the number of good MCU blocks after cropping
-        num_good_mcu = self.auto_detect_shift(data_cropped)
+    # Function to shift the MCUs of a decoded image whose JPEG bytes are data, outputs are named after jpg_file
+    def shift_mcu_image(self, img, data, jpg_file, save_cropped=True):
+        # Crop the height to remove bottom non-MCU corrupted blocks and detect the number of good MCU
+        # blocks after cropping, converting only the bottom rows of the image to arrays
+        height_cropped, num_good_mcu = detect_gray_tail(img, max_rows=self.strip_rows(img))
         if num_good_mcu == 0:
             if self.outputText is not None:
                 self.outputText.append(f"No MCU shift needed for {jpg_file}.")
-            return
-
-        # Calculate the adjusted MCU value for jpegrepair
-        insert_value = max(num_good_mcu - 22, 0)  # Ensure the value does not go below 0
-        if self.outputText is not None:
-            self.outputText.append(f"Detected MCU value for {jpg_file}: {num_good_mcu}, using adjusted value: {insert_value}")
+            return True
 
         # Create the Repaired folder in the same directory as the JPEG file
         repaired_folder = os.path.join(os.path.dirname(jpg_file), "Repaired")
@@ -92,133 +303,1018 @@ class ImageProcessor:
 
         # Save the cropped image to the Repaired folder with the same name
         cropped_image_path = os.path.join(repaired_folder, os.path.basename(jpg_file))
-        output_img = Image.fromarray(data_cropped)
-        output_img.save(cropped_image_path, "JPEG")
+        cropped_data, report = self.crop_jpeg(img, data, height_cropped)
+        if save_cropped:
+            self.save_cropped(cropped_data, cropped_image_path)
+
+        insert_value = self.detect_insert_value(report, num_good_mcu, jpg_file)
+
+        # Insert the detected adjusted number of MCUs in memory, jpegrepair.exe only covers what the engine cannot
+        output_repaired_path = os.path.join(repaired_folder, os.path.basename(jpg_file).rsplit('.', 1)[0] + "_repaired.JPG")
+        try:
+            repaired_data = self.shift_mcu_data(cropped_data, insert_value)
+        except (ValueError, IndexError) as e:
+            if self.outputText is not None:
+                self.outputText.append(f"In-process MCU insert not possible for {cropped_image_path}: {str(e)}")
+            if not save_cropped:
+                self.save_cropped(cropped_data, cropped_image_path)  # jpegrepair.exe reads it from disk
+            if not self.run_jpegrepair(cropped_image_path, output_repaired_path, insert_value):
+                if self.outputText is not None:
+                    self.outputText.append(f"MCU shift failed for {jpg_file}, no {output_repaired_path} written")
+                return False
+        else:
+            self.write_file(output_repaired_path, repaired_data)
+            self.tracer.count(bytes_written=len(repaired_data))
+
+        # The stage only counts as done once its output is there, so a re-run redoes it otherwise
+        if not self.is_written(output_repaired_path):
+            return False
         if self.outputText is not None:
-            self.outputText.append(f"Cropped image saved to: {cropped_image_path}")
+            self.outputText.append(f"Processed image saved to: {output_repaired_path}")
+        return True
+
+    # Function to get the number of MCUs to insert at the start of the cropped JPEG: exactly the MCUs missing
+    # from its scan when the lossless crop walked it and left its report, else the adjusted count of grey blocks
+    def detect_insert_value(self, report, num_good_mcu, jpg_file):
+        if report is not None:
+            if self.outputText is not None:
+                if report["mcu"] is not None:
+                    self.outputText.append(f"First bad MCU in {jpg_file}: {report['mcu']} at byte {report['offset']} "
+                                           f"({report['reason']})")
+                if len(report["damaged"]) > 1:
+                    self.outputText.append(f"Damaged restart intervals in {jpg_file}: "
+                                           f"{', '.join(str(interval) for interval in report['damaged'])}")
+                self.outputText.append(f"Scan of {jpg_file} holds {report['decoded']} of {report['mcus']} MCUs, "
+                                       f"inserting {report['missing']}")
+            return report["missing"]
+
+        # Calculate the adjusted MCU value for jpegrepair
+        insert_value = max(num_good_mcu - MCU_ADJUSTMENT, 0)  # Ensure the value does not go below 0
+        if self.outputText is not None:
+            self.outputText.append(f"Detected MCU value for {jpg_file}: {num_good_mcu}, using adjusted value: {insert_value}")
+        return insert_value
+
+    # Function to insert (count > 0) or delete (count < 0) MCUs at an MCU position of JPEG bytes, in memory
+    def shift_mcu_data(self, data, count, position=0):
+        return shift_mcus(data, count, position)
+
+    # Function to run jpegrepair.exe, returns True when it succeeded and wrote output_path
+    def run_jpegrepair(self, input_path, output_path, insert_value):
+        # jpegrepair.exe reads its input from disk
+        self.flush_writes()
 
         # Call jpegrepair.exe with the detected adjusted insert value
-        output_repaired_path = os.path.join(repaired_folder, os.path.basename(jpg_file).rsplit('.', 1)[0] + "_repaired.JPG")
-        command = f"jpegrepair.exe \"{cropped_image_path}\" \"{output_repaired_path}\" insert {insert_value}"
+        command = f"jpegrepair.exe \"{input_path}\" \"{output_path}\" insert {insert_value}"
         if self.outputText is not None:
             self.outputText.append(f"Running command: {command}")
 
         # Run the command
         try:
             result = subprocess.run(command, shell=True, capture_output=True, text=True)
-            if result.stdout:
-                self.outputText.append(result.stdout)
-            if result.stderr:
-                self.outputText.append("Error: " + result.stderr)
+            if self.outputText is not None:
+                if result.stdout:
+                    self.outputText.append(result.stdout)
+                if result.stderr:
+                    self.outputText.append("Error: " + result.stderr)
         except Exception as e:
             if self.outputText is not None:
                 self.outputText.append(f"An error occurred while running jpegrepair: {str(e)}")
+            return False
+        return result.returncode == 0 and os.path.isfile(output_path)
+
+    # Function to crop JPEG bytes to their top rows, returns the cropped bytes and the report of the MCUs they
+    # hold. With lossless_crop set and a scan the walker handles, the crop is cut on the compressed stream and
+    # the walk that finds the cut also checks the MCUs; otherwise the decoded image is re-encoded, which holds
+    # every MCU of its frame, and the report is None
+    def crop_jpeg(self, img, data, height):
+        if self.lossless_crop:
+            try:
+                return check_crop(data, height, jobs=self.interval_jobs)
+            except (ValueError, IndexError):
+                pass  # Progressive and other scans the walker does not handle are cropped by re-encoding
+        buffer = io.BytesIO()
+        img.crop((0, 0, img.width, height)).save(buffer, "JPEG")
+        return buffer.getvalue(), None
 
+    def save_cropped(self, cropped_data, cropped_image_path):
+        self.write_file(cropped_image_path, cropped_data)
+        self.tracer.count(bytes_written=len(cropped_data))
         if self.outputText is not None:
-            self.outputText.append(f"Processed image saved to: {output_repaired_path}")
+            self.outputText.append(f"Cropped image saved to: {cropped_image_path}")
 
     def crop_non_mcu_blocks(self, data):
-        block_size = 8
-        height, width, _ = data.shape
-
         # Start from the bottom and crop any non-MCU blocks
-        while height >= block_size:
-            if not np.array_equal(data[height - block_size:height, :, :], np.ones((block_size, width, 3), dtype=np.uint8) * 128):
-                break
-            height -= block_size
-
-        return height
+        return gray_tail_height(data)
 
     def auto_detect_shift(self, data):
-        block_size = 8
-        height, width, _ = data.shape
-
-        # Analyze the last scanline (last block row)
-        last_scanline_start = height - block_size
-        if last_scanline_start < 0:
-            return 0  # Not enough data to process
-
-        last_scanline = data[last_scanline_start:height, :, :]
+        # Count the grey blocks in the last scanline (last block row)
+        return count_gray_blocks(data)
 
-        num_mcus = 0
-        for j in range(0, width, block_size):
-            if j + block_size <= width:  # Ensure we don't go out of bounds
-                mcu = last_scanline[:, j:j + block_size, :]
-                gray_mcu = np.ones((block_size, block_size, 3), dtype=np.uint8) * 128
-
-                diff = np.abs(mcu.astype(int) - gray_mcu.astype(int))
-                avg_diff = np.mean(diff)
+    def auto_color_image(self, image_path):
+        jpg_file = os.path.basename(image_path)
+        try:
+            # Open the original image
+            with self.open_image(image_path) as im:
+                return self.save_auto_color(im, image_path)
+        except Exception as e:
+            return f"Error processing image {jpg_file}: {str(e)}"
 
-                # Adjust threshold to allow for some variability in the image
-                if avg_diff < 20:  # Increased threshold to 20 for potential slight color variations
-                    num_mcus += 1
+    # Function to auto color an open image and save it to image_path, returns the log message
+    def save_auto_color(self, im, image_path):
+        with self.tracer.stage("color"):
+            # Apply auto contrast, sharpness and color with the fused color engine (adjustable factors)
+            rows = self.strip_rows(im)
+            if rows is None:
+                im = auto_color(im, **AUTO_COLOR_FACTORS)
+            else:
+                im = auto_color_strips(im, rows, **AUTO_COLOR_FACTORS)  # The same pixels, a strip at a time
 
-        return num_mcus
+            # Save the processed image back in the Repaired folder with original quality
+            original_quality = OUTPUT_QUALITY  # Default quality, adjust if needed
+            if self.deferred_writes is not None:
+                buffer = io.BytesIO()
+                im.save(buffer, "JPEG", quality=original_quality)
+                self.write_file(image_path, buffer.getvalue())
+                written = buffer.tell()
+            else:
+                im.save(image_path, quality=original_quality)
+                written = os.path.getsize(image_path) if self.tracer.enabled else 0
+            self.tracer.count(pixels=im.width * im.height, bytes_written=written)
+        return f"Auto color applied to {os.path.basename(image_path)} and saved with quality {original_quality}."
 
     def auto_color_images(self, repaired_folder):
-        # List all JPG and JPEG files in the Repaired folder
-        jpg_files = [f for f in os.listdir(repaired_folder) if f.lower().endswith((".jpg", ".jpeg"))]
+        log_messages = []  # List to collect log messages
+
+        # Color the JPG and JPEG files in the Repaired folder as they are listed
+        for image_path in iter_files(repaired_folder):
+            log_messages.append(self.auto_color_image(image_path))
 
-        if not jpg_files:
+        if not log_messages:
             if self.outputText is not None:
                 self.outputText.append("No JPG or JPEG files found in the Repaired folder.")
             return
 
-        log_messages = []  # List to collect log messages
+        # Append all log messages at once
+        if self.outputText is not None:
+            self.outputText.append("\n".join(log_messages))
+            self.outputText.append("Auto Color process complete.")
+
+    # Run one encrypted file through repair, MCU shift and auto color, returns the stages that finished
+    def process_file(self, reference_jpeg, encrypted_path, output_folder):
+        if self.in_memory:
+            return self.process_file_in_memory(reference_jpeg, encrypted_path, output_folder)
+
+        self.unlink_shared_outputs(encrypted_path, output_folder)
+        repaired_path = self.repair_jpeg(reference_jpeg, encrypted_path, output_folder)
+        if repaired_path is None:
+            return []
+        stages = ["repair"]
+
+        if self.shift_mcu(repaired_path):
+            stages.append("shift")
+
+        try:
+            with self.open_image(repaired_path) as im:
+                message = self.save_auto_color(im, repaired_path)
+            if self.is_written(repaired_path):
+                stages.append("color")
+        except Exception as e:
+            message = f"Error processing image {os.path.basename(repaired_path)}: {str(e)}"
+        if self.outputText is not None:
+            self.outputText.append(message)
+        return stages
+
+    # Run one encrypted file through the same stages, passing its bytes and decoded image between them
+    # so the colored repair and the shifted copy are the only files written; repaired_data is the
+    # merged bytes when the caller already read them
+    def process_file_in_memory(self, reference_jpeg, encrypted_path, output_folder, repaired_data=None):
+        if repaired_data is None:
+            repaired_data = self.repair_data(reference_jpeg, encrypted_path)
+        if repaired_data is None:
+            return []
+        stages = ["repair"]
+        self.unlink_shared_outputs(encrypted_path, output_folder)
+
+        os.makedirs(output_folder, exist_ok=True)
+        repaired_path = self.repaired_filename(encrypted_path, output_folder)
+        if self.keep_intermediates:
+            self.write_file(repaired_path, repaired_data)
+            if self.outputText is not None:
+                self.outputText.append(f"Repaired file saved as {repaired_path}")
 
-        for jpg_file in jpg_files:
-            image_path = os.path.join(repaired_folder, jpg_file)
+        # Decoded at full size: the grey tail test needs every pixel of a block, which a draft() decode at 1/8
+        # scale reduces to its DC value, and the auto color stage writes the full image from this same decode
+        try:
+            with self.tracer.stage("decode"):
+                img = self.decode_image(repaired_data)
+                self.tracer.count(pixels=img.width * img.height)
+        except Exception as e:
+            message = f"Error opening image {repaired_path}: {str(e)}"
+            img = None
+        else:
+            with self.tracer.stage("shift"):
+                shifted = self.shift_mcu_image(img, repaired_data, repaired_path, save_cropped=self.keep_intermediates)
+            if shifted:
+                stages.append("shift")
             try:
-                # Open the original image
-                with Image.open(image_path) as im:
-                    # Apply auto contrast
-                    im = ImageOps.autocontrast(im, cutoff=1)
-
-                    # Enhance sharpness
-                    sharpness_enhancer = ImageEnhance.Sharpness(im)
-                    im = sharpness_enhancer.enhance(3)  # Adjustable sharpness factor
-
-                    # Posterize the image
-                    im = ImageOps.posterize(im, bits=8)
-
-                    # Enhance color
-                    color_enhancer = ImageEnhance.Color(im)
-                    im = color_enhancer.enhance(3)  # Adjustable color enhancement factor
-
-                    # Save the processed image back in the Repaired folder with original quality
-                    original_quality = 95  # Default quality, adjust if needed
-                    im.save(image_path, quality=original_quality)
-                    log_messages.append(f"Auto color applied to {jpg_file} and saved with quality {original_quality}.")
+                message = self.save_auto_color(img, repaired_path)
+                if self.is_written(repaired_path):
+                    stages.append("color")
             except Exception as e:
-                log_messages.append(f"Error processing image {jpg_file}: {str(e)}")
+                message = f"Error processing image {os.path.basename(repaired_path)}: {str(e)}"
+                img = None
 
-        # Append all log messages at once
+        # Whatever failed, the repaired bytes still end up in the Repaired folder
+        if img is None:
+            self.write_file(repaired_path, repaired_data)
+            message += f"\nRepaired file saved as {repaired_path}"
         if self.outputText is not None:
-            self.outputText.append("\n".join(log_messages))
-            self.outputText.append("Auto Color process complete.")
+            self.outputText.append(message)
+        return stages
+
+    # Run one encrypted file unless its manifest entry shows it was already done with the same inputs,
+    # returns the new manifest entry, or None when the file was skipped
+    def process_file_resumable(self, reference_jpeg, encrypted_path, output_folder, entry=None, reference_hash=None,
+                               name=None):
+        stat, input_hash = self.input_state(encrypted_path, entry)
+        if self.is_done(encrypted_path, output_folder, entry, input_hash, reference_hash):
+            if self.outputText is not None:
+                self.outputText.append(f"Skipping {encrypted_path}, already processed.")
+            return None
+
+        stages = self.process_file(reference_jpeg, encrypted_path, output_folder)
+        return self.manifest_entry(encrypted_path, name, stat, input_hash, reference_hash, stages)
+
+    # Function to get the stat and content hash of an encrypted file, reusing the entry's hash when it is unchanged
+    def input_state(self, encrypted_path, entry):
+        stat = os.stat(encrypted_path)
+        return stat, current_hash(encrypted_path, stat, entry)
+
+    # Function to check whether a file's manifest entry shows it was already done with the same inputs
+    def is_done(self, encrypted_path, output_folder, entry, input_hash, reference_hash):
+        # The color stage edits the repaired file in place, so a file is either skipped whole or redone from the repair
+        return (not self.force and is_complete(entry, input_hash, reference_hash, self.parameters(), STAGES)
+                and os.path.isfile(self.repaired_filename(encrypted_path, output_folder)))
+
+    def manifest_entry(self, encrypted_path, name, stat, input_hash, reference_hash, stages):
+        return {"file": name or os.path.basename(encrypted_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                "input_hash": input_hash, "reference_hash": reference_hash, "parameters": self.parameters(),
+                "stages": stages}
 
-    def process_folder(self, folder_path, reference_jpeg):
+    # Function to set the encrypted start and trailer sizes from a sample of the files in a folder,
+    # for ransomware variants other than the one the defaults fit
+    def detect_offsets(self, folder_path, sample=OFFSET_SAMPLE):
+        if is_archive(folder_path):
+            # Members are sampled by their bytes, a compressed tar has to be read before moving on
+            members = itertools.islice(iter_members(folder_path, self.patterns, self.recursive), sample)
+            files = [read(0, stat.st_size) for _, stat, read in members]
+        else:
+            files = list(itertools.islice(iter_files(folder_path, self.patterns, self.recursive), sample))
+        try:
+            estimate = batch_offsets(files, sample)
+        except ValueError as e:
+            if self.outputText is not None:
+                self.outputText.append(f"Could not detect the offsets in {folder_path}: {str(e)}")
+            return None
+
+        # A start a few bytes off shifts every repaired image, so an uncertain one only narrows it down
+        if estimate["prefix_confidence"] >= OFFSET_CONFIDENCE:
+            self.start_offset = estimate["prefix_length"]
+            start = f"start {self.start_offset} (confidence {estimate['prefix_confidence']:.2f})"
+        else:
+            start = (f"start between {estimate['prefix_low']} and {estimate['prefix_high']}, "
+                     f"keeping {self.start_offset}")
+            if not estimate["prefix_low"] <= self.start_offset <= estimate["prefix_high"]:
+                start += " although it lies outside"
+        if estimate["trailer_confidence"] >= OFFSET_CONFIDENCE:
+            self.trailer_size = estimate["trailer_length"]
+            trailer = f"trailer {self.trailer_size} (confidence {estimate['trailer_confidence']:.2f})"
+        else:
+            trailer = (f"trailer {estimate['trailer_length']} (confidence {estimate['trailer_confidence']:.2f}), "
+                       f"keeping {self.trailer_size}")
+        if self.outputText is not None:
+            self.outputText.append(f"Detected offsets from {estimate['files']} files: {start}, {trailer}")
+        return estimate
+
+    def process_folder(self, folder_path, reference_jpeg, jobs=1, io_jobs=0):
+        if is_archive(folder_path):
+            return self.process_archive(folder_path, reference_jpeg, jobs)
         output_folder = os.path.join(folder_path, "Repaired")
         os.makedirs(output_folder, exist_ok=True)
 
-        # Process each encrypted JPEG file in the specified folder
-        for filename in os.listdir(folder_path):
-            if filename.lower().endswith((".jpg", ".jpeg")):
-                encrypted_jpeg_path = os.path.join(folder_path, filename)
-                self.repair_jpeg(reference_jpeg, encrypted_jpeg_path, output_folder)
+        if jobs is None or jobs < 1:
+            jobs = os.cpu_count() or 1
+
+        # The manifest in the Repaired folder lets a re-run skip the files an earlier run finished
+        manifest = Manifest(os.path.join(output_folder, MANIFEST_NAME))
+
+        # A folder of references is indexed once and each file gets the reference that fits it best
+        library = ReferenceLibrary.load(reference_jpeg) if os.path.isdir(reference_jpeg) else None
+
+        # Files are handed out as the folders are read, so work starts before a large tree is fully listed;
+        # with sort, once each folder is read
+        work_items = self.folder_work_items(folder_path, output_folder, reference_jpeg, manifest, library)
+        duplicates = []
+        self.payload_hashes = {}
+        if self.dedupe:
+            work_items = self.dedupe_work_items(work_items, duplicates)
+
+        # Every file is one work item; logs come back in input order whatever the worker count
+        if io_jobs > 0:
+            if library is None:
+                self.preload_references([reference_jpeg])
+            count = asyncio.run(self.process_files_async(work_items, manifest, jobs, io_jobs))
+        elif jobs == 1:
+            count = self._append_results((_run_file(self, *item) for item in work_items), manifest)
+        else:
+            # Parse a single reference once here and hand the header to every worker
+            if library is None:
+                self.preload_references([reference_jpeg])
+            def start_workers():
+                return ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                           initargs=(ImageProcessor.reference_headers(), self.options()))
+            results = _bounded_map(start_workers, _process_file_worker, work_items, jobs * JOBS_AHEAD, _died_result)
+            count = self._append_results(results, manifest)
+
+        # Duplicates are linked once every original has finished, whichever worker it went to
+        if self.dedupe:
+            self.dedupe_stats = self.link_duplicates(duplicates, manifest)
+            if self.outputText is not None:
+                self.outputText.append(dedupe_summary(self.dedupe_stats))
+
+        manifest.compact()
+        summary_lines = self.tracer.finish()
+        if self.outputText is not None:
+            self.outputText.append(f"Processed {count} files with {jobs} job(s).")
+            for line in summary_lines:
+                self.outputText.append(line)
+
+    # Function to run work items with their reads, writes and the folder listing overlapped on io_jobs threads,
+    # for folders on network shares where every file operation waits on the link. Files go through the
+    # in-memory stages on a worker thread, or on jobs processes, and at most io_jobs + jobs * JOBS_AHEAD
+    # files are held in memory at once. Logs come back in the order files finish; returns the number of files
+    async def process_files_async(self, work_items, manifest, jobs, io_jobs):
+        loop = asyncio.get_running_loop()
+        in_flight = io_jobs + jobs * JOBS_AHEAD
+        queue = asyncio.Queue(maxsize=in_flight)
+        options = dict(self.options(), in_memory=True)
+        if jobs == 1:
+            cpu_executor = ThreadPoolExecutor(max_workers=1, initializer=_init_worker,
+                                              initargs=(ImageProcessor.reference_headers(), options))
+        else:
+            cpu_executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                               initargs=(ImageProcessor.reference_headers(), options))
+
+        async def list_files(items):
+            while (item := await loop.run_in_executor(io_executor, next, items, None)) is not None:
+                await queue.put(item)
+            for _ in range(in_flight):
+                await queue.put(None)
+
+        async def handle_files():
+            count = 0
+            while (item := await queue.get()) is not None:
+                reference_path, encrypted_path, output_folder, entry, reference_hash, name = item
+                try:
+                    prefetched = await loop.run_in_executor(io_executor, self.prefetch_file, *item)
+                    if prefetched is None:
+                        result = ([f"Skipping {encrypted_path}, already processed."], None, [])
+                    else:
+                        *result, writes = await loop.run_in_executor(cpu_executor, _process_repaired_worker,
+                                                                     *item, *prefetched)
+                        await loop.run_in_executor(io_executor, write_files, writes)
+                except Exception as e:
+                    result = ([f"Error processing {encrypted_path}: {str(e)}"], None, [])
+                count += self._append_results([result], manifest)
+            return count
+
+        with ThreadPoolExecutor(max_workers=io_jobs) as io_executor, cpu_executor:
+            counts = await asyncio.gather(list_files(iter(work_items)), *(handle_files() for _ in range(in_flight)))
+        return sum(counts[1:])
+
+    # Function to do the reads of one work item: returns None when the manifest shows the file is done,
+    # else (stat, input hash, merged repair bytes or None when the reference has no header)
+    def prefetch_file(self, reference_path, encrypted_path, output_folder, entry, reference_hash, name):
+        stat, input_hash = self.input_state(encrypted_path, entry)
+        if self.is_done(encrypted_path, output_folder, entry, input_hash, reference_hash):
+            return None
+        ref_part = self.load_reference_header(reference_path)
+        return stat, input_hash, self.read_merged(ref_part, encrypted_path) if ref_part is not None else None
+
+    # Function to run as a service: poll the drop folders and process each new file once it is fully written,
+    # on workers started once with the reference headers already loaded. Runs until stop is set or the process
+    # is interrupted; queue depth and throughput go to status_path and, given status_port, to a local HTTP endpoint
+    def watch_folders(self, folder_paths, reference_jpeg, jobs=1, poll_interval=POLL_INTERVAL, status_path=None,
+                      status_port=None, stop=None):
+        if jobs is None or jobs < 1:
+            jobs = os.cpu_count() or 1
+        stop = stop or threading.Event()
+
+        # References are loaded once; a reference library is not indexed again while the service runs
+        library = ReferenceLibrary.load(reference_jpeg) if os.path.isdir(reference_jpeg) else None
+        if library is None:
+            self.preload_references([reference_jpeg])
+        else:
+            self.preload_references([os.path.join(library.folder, name) for name in library.entries])
+
+        folders = []
+        for folder_path in folder_paths:
+            output_folder = os.path.join(folder_path, "Repaired")
+            os.makedirs(output_folder, exist_ok=True)
+            manifest = Manifest(os.path.join(output_folder, MANIFEST_NAME))
+            watcher = DropFolderWatcher(folder_path, self.patterns, self.recursive, self.min_input_size())
+            folders.append((folder_path, output_folder, manifest, watcher))
+        status = ServiceStatus(folder_paths, status_path or os.path.join(folders[0][1], STATUS_NAME), status_port)
+
+        # A single worker is a thread, so the polling and the status updates go on while it works
+        initargs = (ImageProcessor.reference_headers(), self.options())
+
+        def start_workers():
+            if jobs == 1:
+                workers = ThreadPoolExecutor(max_workers=1, initializer=_init_worker, initargs=initargs)
+            else:
+                workers = ProcessPoolExecutor(max_workers=jobs, initializer=_init_service_worker, initargs=initargs)
+            # Start every worker now, so the first file dropped does not wait for the imports
+            wait([workers.submit(_warm_worker) for _ in range(jobs)])
+            return workers
+
+        executor = start_workers()
+        if self.outputText is not None:
+            self.outputText.append(f"Watching {', '.join(folder_paths)} with {jobs} job(s).")
+
+        queue = deque()  # (work item, manifest) of the fully written files not yet handed to a worker
+        running = {}  # future: (encrypted path, manifest, start time)
+        reference_hashes = {}
+        claimed = {}
+        next_poll = time.monotonic()
+        try:
+            while not stop.is_set():
+                if time.monotonic() >= next_poll:
+                    next_poll = time.monotonic() + poll_interval
+                    for folder_path, output_folder, manifest, watcher in folders:
+                        for encrypted_path in watcher.poll():
+                            item = self.work_item(folder_path, output_folder, reference_jpeg, manifest, library,
+                                                  encrypted_path, reference_hashes, claimed)
+                            if item is not None:
+                                queue.append((item, manifest))
+
+                # Only a few files per worker are submitted, the rest wait in the queue the status reports
+                while queue and len(running) < jobs * JOBS_AHEAD:
+                    item, manifest = queue.popleft()
+                    running[executor.submit(_process_file_worker, *item)] = (item[1], manifest, time.time())
+                status.update(growing=sum(folder[3].growing() for folder in folders), queued=len(queue),
+                              in_flight=len(running))
+
+                timeout = max(0.0, next_poll - time.monotonic())
+                if not running:
+                    stop.wait(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    encrypted_path, manifest, started = running.pop(future)
+                    result, failed = self._service_result(future, encrypted_path)
+                    broken = broken or failed
+                    self._append_results([result], manifest)
+                    status.finish(encrypted_path, _result_outcome(result), time.time() - started)
+
+                if broken:
+                    # A worker died, e.g. killed for running out of memory, and took the pool and every file
+                    # in flight with it; those are recorded as failed and a new pool takes the queue on
+                    for future in wait(running).done:
+                        encrypted_path, manifest, started = running.pop(future)
+                        result, _ = self._service_result(future, encrypted_path)
+                        self._append_results([result], manifest)
+                        status.finish(encrypted_path, _result_outcome(result), time.time() - started)
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = start_workers()
+                    if self.outputText is not None:
+                        self.outputText.append(f"Restarted the {jobs} worker(s) after one of them died.")
+        except KeyboardInterrupt:
+            pass  # The files in flight are not recorded, so the manifest lets the next run redo them
+        finally:
+            executor.shutdown(cancel_futures=True)
+            for _, _, manifest, _ in folders:
+                manifest.compact()
+            status.close()
+            if self.outputText is not None:
+                snapshot = status.snapshot()
+                self.outputText.append(f"Stopped watching: {snapshot['processed']} processed, "
+                                       f"{snapshot['skipped']} skipped, {snapshot['failed']} failed.")
+
+    # Function to get the _run_file result of a service future, and whether its worker pool broke. A file whose
+    # worker died gets a failed result in its place, with no manifest entry so a later run redoes it
+    def _service_result(self, future, encrypted_path):
+        try:
+            return future.result(), False
+        except BrokenExecutor as e:
+            return _died_result((None, encrypted_path), e), True
+        except Exception as e:
+            return ([f"Error processing {encrypted_path}: {str(e)}"], None, []), False
+
+    # Function to process the encrypted JPEG files inside a zip or tar archive without extracting it. Each file's
+    # payload is read straight from the archive into the in-memory stages, on jobs worker processes; the results
+    # go to the Repaired folder named after the archive, or into output_archive, a zip file, when it is given
+    def process_archive(self, archive_path, reference_jpeg, jobs=1, output_archive=None):
+        output_folder = archive_output_folder(archive_path)
+        os.makedirs(output_folder, exist_ok=True)
+
+        if jobs is None or jobs < 1:
+            jobs = os.cpu_count() or 1
+
+        # The manifest stays in the Repaired folder. The output archive is written anew, so nothing is skipped for it
+        manifest = Manifest(os.path.join(output_folder, MANIFEST_NAME))
+        library = ReferenceLibrary.load(reference_jpeg) if os.path.isdir(reference_jpeg) else None
+        if library is None:
+            self.preload_references([reference_jpeg])
+        work_items = self.archive_work_items(archive_path, output_folder, reference_jpeg, manifest, library,
+                                             skip_done=output_archive is None)
+
+        # Members are read in archive order here, which a compressed tar needs, and handed to the workers
+        def start_workers():
+            return ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                       initargs=(ImageProcessor.reference_headers(), self.options()))
+
+        output_zip = zipfile.ZipFile(output_archive + ".tmp", 'w') if output_archive else None
+        try:
+            if jobs == 1:
+                results = (_run_repaired(self, *item) for item in work_items)
+            else:
+                results = _bounded_map(start_workers, _process_repaired_worker, work_items, jobs * JOBS_AHEAD,
+                                       lambda item, error: _died_result(item, error) + ([],))
+            count = self._append_results(store_outputs(results, output_folder, output_zip), manifest)
+        finally:
+            if output_zip is not None:
+                output_zip.close()
+        if output_archive:
+            os.replace(output_archive + ".tmp", output_archive)
+
+        manifest.compact()
+        summary_lines = self.tracer.finish()
+        if self.outputText is not None:
+            self.outputText.append(f"Processed {count} files from {archive_path} with {jobs} job(s).")
+            for line in summary_lines:
+                self.outputText.append(line)
+
+    # Function to yield the arguments of _run_repaired for each encrypted file in an archive, with the merged
+    # repair bytes read from it. With skip_done, a file the manifest shows done and unchanged is skipped without
+    # reading it, unless a reference library needs its payload to pick the reference
+    def archive_work_items(self, archive_path, output_folder, reference_jpeg, manifest, library=None, skip_done=True):
+        reference_hashes = {}
+        claimed = {}
+        for name, stat, read in iter_members(archive_path, self.patterns, self.recursive, self.min_input_size()):
+            encrypted_path = os.path.join(archive_path, name)
+            file_output_folder = os.path.normpath(os.path.join(output_folder, os.path.dirname(name)))
+            if not is_inside(file_output_folder, output_folder):
+                if self.outputText is not None:
+                    self.outputText.append(f"Skipping {encrypted_path}, its outputs would be outside {output_folder}.")
+                continue
+            if not self.claim_output(encrypted_path, file_output_folder, claimed):
+                continue
+            entry = manifest.get(name)
+            start, end = self.encrypted_payload_range(stat.st_size)
+
+            payload = None
+            reference_path = reference_jpeg
+            if library is not None:
+                payload = read(start, end)
+                hints = payload_hints(payload, stat.st_size - self.trailer_size)
+                reference_path, matched_on = library.match_hints(hints)
+                if self.outputText is not None:
+                    self.outputText.append(f"Using reference {reference_path} for {encrypted_path} (matched on {matched_on})")
+            reference_hash = self.reference_hash(reference_path, reference_hashes)
+
+            # Only the payload is read, so it is what the input hash covers
+            unchanged = entry is not None and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns
+            if skip_done and unchanged and self.is_done(encrypted_path, file_output_folder, entry, entry["input_hash"], reference_hash):
+                if self.outputText is not None:
+                    self.outputText.append(f"Skipping {encrypted_path}, already processed.")
+                continue
+
+            ref_part = self.load_reference_header(reference_path)
+            if ref_part is None:
+                if self.outputText is not None:
+                    self.outputText.append(f"Could not find FF DA marker in {reference_path}")
+                continue
+            if payload is None:
+                payload = read(start, end)
+            input_hash = entry["input_hash"] if unchanged else data_hash(payload)
+            yield (reference_path, encrypted_path, file_output_folder, entry, reference_hash, name, stat, input_hash,
+                   bytes(ref_part) + payload)
+
+    # Function to get the hash of the payload process_encrypted_jpeg keeps from a file, reusing the one in its
+    # manifest entry when neither the file nor the parameters changed
+    def payload_hash(self, encrypted_path, entry=None):
+        stat = os.stat(encrypted_path)
+        if (entry is not None and "payload_hash" in entry and entry.get("size") == stat.st_size
+                and entry.get("mtime_ns") == stat.st_mtime_ns and entry.get("parameters") == self.parameters()):
+            return entry["payload_hash"]
+        return region_hash(encrypted_path, *self.encrypted_payload_range(stat.st_size))
+
+    # Function to pass on the work items whose payload was not seen before with the same reference header;
+    # the others are appended to duplicates as (original item, duplicate item) for link_duplicates
+    def dedupe_work_items(self, work_items, duplicates):
+        originals = {}
+        for item in work_items:
+            reference_path, encrypted_path, output_folder, entry, reference_hash, name = item
+            try:
+                payload = self.payload_hash(encrypted_path, entry)
+            except OSError:
+                yield item  # The file's own run reports what is wrong with it
+                continue
+            self.payload_hashes[name] = payload
+            original = originals.setdefault((payload, reference_hash), item)
+            if original is item:
+                yield item
+            else:
+                duplicates.append((original, item))
+
+    # Function to give each duplicate its original's outputs, hardlinked where the file system allows and copied
+    # otherwise, and a manifest entry of its own; returns the work that was saved
+    def link_duplicates(self, duplicates, manifest):
+        stats = {"originals": len({original[1] for original, _ in duplicates}), "files": 0, "payload_bytes": 0,
+                 "linked": 0, "copied": 0}
+        for original, duplicate in duplicates:
+            _, original_path, original_folder, _, _, original_name = original
+            _, encrypted_path, output_folder, entry, reference_hash, name = duplicate
+            try:
+                stat, input_hash = self.input_state(encrypted_path, entry)
+                if not self.is_done(encrypted_path, output_folder, entry, input_hash, reference_hash):
+                    # An original whose run failed has no entry made with these parameters to share
+                    original_entry = manifest.get(original_name)
+                    if (original_entry is None or original_entry.get("parameters") != self.parameters()
+                            or original_entry.get("reference_hash") != reference_hash):
+                        if self.outputText is not None:
+                            self.outputText.append(f"Not linking {encrypted_path}: {original_path} was not processed.")
+                        continue
+                    for source, target in zip(self.output_paths(original_path, original_folder),
+                                              self.output_paths(encrypted_path, output_folder)):
+                        if os.path.isfile(source):
+                            stats["linked" if link_or_copy(source, target) else "copied"] += 1
+                    new_entry = self.manifest_entry(encrypted_path, name, stat, input_hash, reference_hash,
+                                                    original_entry["stages"])
+                    new_entry.update(payload_hash=self.payload_hashes[name], duplicate_of=original_name)
+                    manifest.record(new_entry)
+                    if self.outputText is not None:
+                        self.outputText.append(f"{encrypted_path} has the same payload as {original_path}, "
+                                               f"outputs linked.")
+            except OSError as e:
+                if self.outputText is not None:
+                    self.outputText.append(f"Error linking {encrypted_path}: {str(e)}")
+                continue
+            start, end = self.encrypted_payload_range(stat.st_size)
+            stats["files"] += 1
+            stats["payload_bytes"] += end - start
+        return stats
 
-        # After repairing, shift MCU and apply color adjustments
-        for repaired_file in os.listdir(output_folder):
-            if repaired_file.lower().endswith((".jpg", ".jpeg")):
-                repaired_file_path = os.path.join(output_folder, repaired_file)
-                self.shift_mcu(repaired_file_path)
+    # Function to yield the arguments of _run_file for each encrypted file under folder_path;
+    # files in subfolders are written to the same subfolders of output_folder
+    def folder_work_items(self, folder_path, output_folder, reference_jpeg, manifest, library=None):
+        reference_hashes = {}
+        claimed = {}
+
+        # Files with nothing between the encrypted start and the trailer are left out
+        for encrypted_path in iter_files(folder_path, self.patterns, self.recursive, self.min_input_size(),
+                                         sort=self.sort):
+            item = self.work_item(folder_path, output_folder, reference_jpeg, manifest, library, encrypted_path,
+                                  reference_hashes, claimed)
+            if item is not None:
+                yield item
+
+    # Function to get the arguments of _run_file for one encrypted file under folder_path, None when another
+    # file in claimed already has its output name
+    def work_item(self, folder_path, output_folder, reference_jpeg, manifest, library, encrypted_path,
+                  reference_hashes, claimed):
+        name = os.path.relpath(encrypted_path, folder_path)
+        file_output_folder = os.path.normpath(os.path.join(output_folder, os.path.dirname(name)))
+        if not self.claim_output(encrypted_path, file_output_folder, claimed):
+            return None
+
+        reference_path = reference_jpeg
+        if library is not None:
+            reference_path, matched_on = library.match(encrypted_path, self.start_offset, self.trailer_size)
+            if self.outputText is not None:
+                self.outputText.append(f"Using reference {reference_path} for {encrypted_path} (matched on {matched_on})")
+
+        return (reference_path, encrypted_path, file_output_folder, manifest.get(name),
+                self.reference_hash(reference_path, reference_hashes), name)
+
+    # Function to get the hash of a reference header, hashing each reference once into reference_hashes
+    def reference_hash(self, reference_path, reference_hashes):
+        if reference_path not in reference_hashes:
+            reference_header = self.load_reference_header(reference_path)
+            reference_hashes[reference_path] = data_hash(reference_header) if reference_header is not None else None
+        return reference_hashes[reference_path]
+
+    # Function to get the smallest encrypted file that has something between the encrypted start and the trailer
+    def min_input_size(self):
+        return self.start_offset + self.trailer_size
+
+    # Function to log each file's messages and record its manifest entry, returns the number of files
+    def _append_results(self, results, manifest):
+        count = 0
+        for log_messages, entry, events in results:
+            count += 1
+            self.tracer.record(events)
+            if entry is not None:
+                if entry["file"] in self.payload_hashes:
+                    entry["payload_hash"] = self.payload_hashes[entry["file"]]
+                manifest.record(entry)
+            if self.outputText is not None:
+                for message in log_messages:
+                    self.outputText.append(message)
+        return count
+
+
+# Run one file on the given processor, collecting its log lines and isolating its errors,
+# returns the log lines, the new manifest entry and the file's metrics events
+def _run_file(processor, reference_jpeg, encrypted_path, output_folder, entry=None, reference_hash=None, name=None):
+    return _run_logged(processor, encrypted_path, name, processor.process_file_resumable,
+                       reference_jpeg, encrypted_path, output_folder, entry, reference_hash, name)
+
+
+# Function to tell from a _run_file result whether its file was "processed", "skipped" as done or "failed"
+def _result_outcome(result):
+    log_messages, entry, _ = result
+    if entry is not None:
+        return "processed"
+    if any(message.startswith("Skipping ") for message in log_messages):
+        return "skipped"
+    return "failed"
+
+
+# Run fn(*args) for one file on the given processor the same way, fn returning the new manifest entry
+def _run_logged(processor, encrypted_path, name, fn, *args):
+    log_messages = []
+    output_text = processor.outputText
+    processor.outputText = log_messages
+    processor.tracer.file = name or encrypted_path
+    new_entry = None
+    try:
+        with processor.tracer.stage(FILE_STAGE):
+            new_entry = fn(*args)
+    except Exception as e:
+        log_messages.append(f"Error processing {encrypted_path}: {str(e)}")
+    finally:
+        processor.outputText = output_text
+    return log_messages, new_entry, processor.tracer.drain()
+
+
+# Run the stages of one file whose bytes were read ahead, holding its result files back for the caller;
+# returns the log lines, the new manifest entry, the metrics events and the [(path, bytes)] to write
+def _run_repaired(processor, reference_jpeg, encrypted_path, output_folder, entry, reference_hash, name,
+                  stat, input_hash, repaired_data):
+    def process():
+        stages = processor.process_file_in_memory(reference_jpeg, encrypted_path, output_folder, repaired_data)
+        return processor.manifest_entry(encrypted_path, name, stat, input_hash, reference_hash, stages)
+
+    processor.deferred_writes = []
+    try:
+        return _run_logged(processor, encrypted_path, name, process) + (processor.deferred_writes,)
+    finally:
+        processor.deferred_writes = None
+
+
+# Function to write result files, creating their folders
+def write_files(writes):
+    for path, data in writes:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'wb') as output_file:
+            output_file.write(data)
+
+
+# Function to get the Repaired folder of an archive, next to it and named after it with its extension, so
+# evidence.zip and evidence.tar.gz get evidence_zip_Repaired and evidence_tar_gz_Repaired and their own manifests
+def archive_output_folder(archive_path):
+    stem = archive_stem(archive_path)
+    suffix = os.path.basename(archive_path)[len(stem):].replace(".", "_")
+    return os.path.join(os.path.dirname(archive_path), stem + suffix + "_Repaired")
+
+
+# Function to check whether path resolves to a place inside folder, following links
+def is_inside(path, folder):
+    folder = os.path.realpath(folder)
+    try:
+        return os.path.commonpath([os.path.realpath(path), folder]) == folder
+    except ValueError:
+        return False  # On another drive
+
+
+# Function to write the result files of _run_repaired results, into output_zip when it is given, and pass on
+# the log lines, manifest entries and metrics events. A result with a file outside output_folder writes nothing
+def store_outputs(results, output_folder, output_zip=None):
+    for log_messages, entry, events, writes in results:
+        outside = [path for path, _ in writes if not is_inside(path, output_folder)]
+        if outside:
+            log_messages = log_messages + [f"Not writing {path}, it is outside {output_folder}." for path in outside]
+            entry, writes = None, []
+        if output_zip is None:
+            write_files(writes)
+        else:
+            for path, data in writes:
+                output_zip.writestr(os.path.relpath(path, output_folder).replace(os.sep, "/"), data)
+        yield log_messages, entry, events
+
+
+# Function to hardlink target to source, replacing target, or copy it where links are not possible;
+# returns True when it was linked
+def link_or_copy(source, target):
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    if os.path.exists(target):
+        if os.path.samefile(source, target):
+            return True
+        os.remove(target)
+    try:
+        os.link(source, target)
+        return True
+    except OSError:
+        shutil.copyfile(source, target)  # Another file system, or one without hardlinks such as FAT
+        return False
+
+
+# Function to describe the work deduplication saved
+def dedupe_summary(stats):
+    return (f"Deduplicated {stats['files']} files onto {stats['originals']} originals, "
+            f"{stats['payload_bytes'] / (1024 * 1024):.1f} MB not processed again "
+            f"({stats['linked']} outputs hardlinked, {stats['copied']} copied).")
+
+
+# Function to map fn over an iterable of argument tuples on the executor start_workers returns, yielding results
+# in order while keeping at most ahead items submitted, so a long listing is neither held in memory nor waited for.
+# A worker dying takes the pool and every item in flight with it: those get failed(item, error) in place of their
+# result and a new pool takes the remaining items on
+def _bounded_map(start_workers, fn, items, ahead, failed):
+    items = iter(items)
+    pending = deque()
+    executor = start_workers()
+    try:
+        while True:
+            while len(pending) < ahead and (item := next(items, None)) is not None:
+                pending.append((item, executor.submit(fn, *item)))
+            if not pending:
+                return
+            item, future = pending.popleft()
+            try:
+                yield future.result()
+            except BrokenExecutor as e:
+                yield failed(item, e)
+                # The items already finished keep their results, the others went down with the pool
+                while pending:
+                    item, future = pending.popleft()
+                    try:
+                        yield future.result()
+                    except BrokenExecutor as e:
+                        yield failed(item, e)
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = start_workers()
+    finally:
+        executor.shutdown()
+
+
+# Function to get the failed result of a work item whose worker died, with no manifest entry so a later run redoes it
+def _died_result(item, error):
+    return [f"Error processing {item[1]}: the worker died ({error})"], None, []
+
+
+# Log that prints each message as it comes, for the service mode where nothing else reports progress
+class ConsoleLog:
+    def append(self, message):
+        print(message, flush=True)
+
+
+# Each worker process keeps one processor for all the files it handles
+_worker_processor = None
+
+
+def _init_worker(reference_headers, options):
+    global _worker_processor
+    ImageProcessor._reference_headers.update(reference_headers)
+    _worker_processor = ImageProcessor(**options)
+
+
+# Function run once on each worker when a service starts, so each one has done its imports and setup
+def _warm_worker():
+    return os.getpid()
+
+
+# Service workers leave Ctrl+C to the service, which stops handing them files and waits for the ones they hold
+def _init_service_worker(reference_headers, options):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(reference_headers, options)
+
+
+def _process_file_worker(reference_jpeg, encrypted_path, output_folder, entry, reference_hash, name):
+    return _run_file(_worker_processor, reference_jpeg, encrypted_path, output_folder, entry, reference_hash, name)
+
+
+def _process_repaired_worker(*args):
+    return _run_repaired(_worker_processor, *args)
 
-        # After shifting, apply color adjustments
-        self.auto_color_images(output_folder)
 
 if __name__ == "__main__":
-    reference_image_path = input("Please enter the reference JPEG file path: ").strip()
-    folder_to_process = input("Please enter the encrypted folder path to process images: ").strip()
-    
-    processor = ImageProcessor()
-    processor.process_folder(folder_to_process, reference_image_path)
+    parser = argparse.ArgumentParser(description="Repair, MCU shift and auto color encrypted JPEG files.")
+    parser.add_argument("folders", nargs="*", metavar="folder",
+                        help="encrypted folder path to process images, a zip or tar archive of them, "
+                             "or with --watch the drop folders to watch")
+    parser.add_argument("-r", "--reference",
+                        help="reference JPEG file path, or a folder of references to pick the best match from")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes, 0 uses every core (default: 1)")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="pass each file between stages in memory and only write the results")
+    parser.add_argument("--keep-intermediates", action="store_true",
+                        help="with --in-memory, also write the intermediate files for debugging")
+    parser.add_argument("--force", action="store_true",
+                        help="process every file again, even those the manifest marks as done")
+    parser.add_argument("-R", "--recursive", action="store_true",
+                        help="also process the subfolders, writing their results to the same subfolders of Repaired")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="write per stage metrics of every file to this JSON lines file and print a summary")
+    parser.add_argument("--start-offset", type=int, default=START_OFFSET,
+                        help=f"encrypted bytes at the start of every file (default: {START_OFFSET})")
+    parser.add_argument("--trailer-size", type=int, default=TRAILER_SIZE,
+                        help=f"bytes appended after the JPEG data (default: {TRAILER_SIZE})")
+    parser.add_argument("--detect-offsets", action="store_true",
+                        help="estimate the start offset and trailer size from a sample of the files")
+    parser.add_argument("--io-jobs", type=int, default=0,
+                        help="overlap reads, writes and folder listing with up to this many file operations in flight, "
+                             "for folders on network shares; implies --in-memory (default: 0, off)")
+    parser.add_argument("--interval-jobs", type=int, default=1,
+                        help="split the restart intervals of each image between this many threads when decoding "
+                             "and processes when validating (default: 1)")
+    parser.add_argument("--memory-budget", type=int, metavar="MB",
+                        help="memory each worker may use on one image besides the decoded image itself; larger "
+                             "images are colored and analysed in strips (default: no cap)")
+    parser.add_argument("--lossless-crop", action="store_true",
+                        help="crop the grey tail on the compressed stream instead of re-encoding; keeps the "
+                             "quality but walks the whole scan in Python, several times slower")
+    parser.add_argument("--sorted", action="store_true",
+                        help="process each folder's files in name order, so the log comes out the same on every "
+                             "file system; a folder is read whole before its first file starts")
+    parser.add_argument("--triage", action="store_true",
+                        help="afterwards score the repaired files from downscaled previews and draw contact sheets "
+                             "in Repaired/Triage")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="process files with the same payload once and hardlink, or copy, the outputs "
+                             "to the duplicates")
+    parser.add_argument("--output-archive", action="store_true",
+                        help="write the results of an archive into NAME_EXT_Repaired.zip next to it instead of a folder")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process each new file in the folders once it is fully written")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                        help=f"with --watch, seconds between two listings of the folders (default: {POLL_INTERVAL})")
+    parser.add_argument("--status-file", metavar="PATH",
+                        help=f"with --watch, JSON file for the queue depth and throughput "
+                             f"(default: Repaired/{STATUS_NAME} in the first folder)")
+    parser.add_argument("--status-port", type=int, metavar="PORT",
+                        help="with --watch, also serve the status as JSON on http://127.0.0.1:PORT/")
+    parser.add_argument("-p", "--pattern", action="append", dest="patterns",
+                        help="name pattern of the encrypted files, can be given several times (default: *.jpg *.jpeg)")
+    args = parser.parse_args()
+    if args.watch and (not args.reference or not args.folders):
+        parser.error("--watch needs the reference and the folders on the command line")
+
+    reference_image_path = args.reference or input("Please enter the reference JPEG file path: ").strip()
+    folders_to_process = args.folders or [input("Please enter the encrypted folder path to process images: ").strip()]
+
+    processor = ImageProcessor(output_text_widget=ConsoleLog() if args.watch else None, in_memory=args.in_memory, keep_intermediates=args.keep_intermediates,
+                               force=args.force, recursive=args.recursive,
+                               patterns=tuple(args.patterns) if args.patterns else JPEG_PATTERNS,
+                               metrics_path=args.metrics, start_offset=args.start_offset,
+                               trailer_size=args.trailer_size, interval_jobs=args.interval_jobs,
+                               memory_budget=args.memory_budget * 1024 * 1024 if args.memory_budget else None,
+                               dedupe=args.dedupe, lossless_crop=args.lossless_crop, sort=args.sorted)
+    if args.detect_offsets:
+        estimate = processor.detect_offsets(folders_to_process[0])
+        if estimate is not None:
+            print(f"Detected start offset between {estimate['prefix_low']} and {estimate['prefix_high']} "
+                  f"(confidence {estimate['prefix_confidence']:.2f}), trailer size {estimate['trailer_length']} "
+                  f"(confidence {estimate['trailer_confidence']:.2f}); using start offset {processor.start_offset}, "
+                  f"trailer size {processor.trailer_size}")
+    if args.watch:
+        processor.watch_folders(folders_to_process, reference_image_path, jobs=args.jobs,
+                                poll_interval=args.poll_interval, status_path=args.status_file,
+                                status_port=args.status_port)
+    else:
+        for folder_to_process in folders_to_process:
+            if is_archive(folder_to_process):
+                output_archive = archive_output_folder(folder_to_process) + ".zip" if args.output_archive else None
+                processor.process_archive(folder_to_process, reference_image_path, jobs=args.jobs,
+                                          output_archive=output_archive)
+                continue
+            processor.process_folder(folder_to_process, reference_image_path, jobs=args.jobs, io_jobs=args.io_jobs)
+            if args.dedupe:
+                print(f"{folder_to_process}: {dedupe_summary(processor.dedupe_stats)}")
+    if args.metrics:
+        print("\n".join(processor.tracer.summary_lines()))
+    if args.triage:
+        for folder_to_process in folders_to_process:
+            if is_archive(folder_to_process):
+                if args.output_archive:
+                    continue  # The results are only in the output archive
+                repaired_folder = archive_output_folder(folder_to_process)
+            else:
+                repaired_folder = os.path.join(folder_to_process, "Repaired")
+            entries = triage_folder(repaired_folder, jobs=max(args.jobs, 1))
+            damaged = sum(1 for entry in entries if entry["score"] >= 0.5)
+            print(f"Triaged {len(entries)} repaired files in {folder_to_process}, {damaged} look damaged (score >= 0.5)")
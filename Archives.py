@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import struct
+import functools
+import tarfile
+import zipfile
+from typing import NamedTuple
+from Folders import JPEG_PATTERNS, SKIPPED_FOLDERS, name_matcher
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ZIP_LOCAL_HEADER_SIZE = 30  # Fixed part of a zip local file header, before the name and the extra field
+ZIP_ENCRYPTED = 0x1  # General purpose flag of members encrypted by the archiver
+
+
+# The parts of os.stat_result the manifest records, for a file inside an archive
+class MemberStat(NamedTuple):
+    st_size: int
+    st_mtime_ns: int
+
+
+# Function to check whether a path is an archive the tool can read files from
+def is_archive(path):
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+# Function to get the name of an archive without its archive extension, e.g. "evidence" for evidence.tar.gz
+def archive_stem(path):
+    name = os.path.basename(path)
+    for suffix in sorted(ARCHIVE_SUFFIXES, key=len, reverse=True):
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+# Function to check whether a member name stays inside the folder it is extracted to: not absolute, no drive
+# and no ".." part, so its outputs cannot be written outside the Repaired folder
+def is_safe_member(name):
+    name = name.replace("\\", "/")
+    if name.startswith("/") or (name[:1].isalpha() and name[1:2] == ":"):
+        return False
+    return ".." not in name.split("/")
+
+
+# Function to check a member name against the name patterns and the folders that hold our own outputs;
+# members whose names would climb out of the output folder are never wanted
+def _wanted(name, matches, recursive):
+    if not is_safe_member(name):
+        return False
+    # Archivers that were given "." name their members ./IMG_1.jpg; those are still at the top
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or (not recursive and len(parts) > 1):
+        return False
+    return matches(parts[-1]) is not None and not any(part in SKIPPED_FOLDERS for part in parts[:-1])
+
+
+# Function to yield (member name, MemberStat, read) for each file in a zip or tar archive whose name matches
+# patterns. read(start, end) returns the member's bytes start..end; it seeks straight to start in zip members
+# stored without compression and in uncompressed tar files, and decompresses and drops the bytes before start
+# otherwise. Compressed tar files are read as one stream, so read must be called before the next member
+def iter_members(path, patterns=JPEG_PATTERNS, recursive=False, min_size=0):
+    matches = name_matcher(patterns)
+    if zipfile.is_zipfile(path):
+        yield from _iter_zip_members(path, matches, recursive, min_size)
+    else:
+        yield from _iter_tar_members(path, matches, recursive, min_size)
+
+
+def _iter_zip_members(path, matches, recursive, min_size):
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as raw:
+        for info in archive.infolist():
+            if info.is_dir() or info.file_size < min_size or not _wanted(info.filename, matches, recursive):
+                continue
+            mtime_ns = int(time.mktime(info.date_time + (0, 0, -1))) * 1_000_000_000
+            read = functools.partial(_read_zip_member, archive, raw, info)
+            yield info.filename, MemberStat(info.file_size, mtime_ns), read
+
+
+def _read_zip_member(archive, raw, info, start, end):
+    if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & ZIP_ENCRYPTED:
+        # The local header's name and extra field can differ in length from the central directory's
+        raw.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE - 4)
+        name_length, extra_length = struct.unpack("<HH", raw.read(4))
+        raw.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length + start)
+        return raw.read(max(0, end - start))
+    with archive.open(info) as member:
+        member.seek(start)
+        return member.read(max(0, end - start))
+
+
+def _iter_tar_members(path, matches, recursive, min_size):
+    try:
+        archive = tarfile.open(path, 'r:')
+        raw = open(path, 'rb')
+    except tarfile.ReadError:
+        archive, raw = tarfile.open(path, 'r|*'), None  # Compressed: one pass over the stream
+    try:
+        for info in archive:
+            if not info.isfile() or info.size < min_size or not _wanted(info.name, matches, recursive):
+                continue
+            if raw is not None:
+                read = functools.partial(_read_tar_range, raw, info)
+            else:
+                read = functools.partial(_read_tar_stream, archive, info)
+            yield info.name, MemberStat(info.size, int(info.mtime) * 1_000_000_000), read
+    finally:
+        archive.close()
+        if raw is not None:
+            raw.close()
+
+
+def _read_tar_range(raw, info, start, end):
+    raw.seek(info.offset_data + start)
+    return raw.read(max(0, min(end, info.size) - start))
+
+
+def _read_tar_stream(archive, info, start, end):
+    member = archive.extractfile(info)
+    member.read(start)
+    return member.read(max(0, end - start))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: Archives.py ARCHIVE...")
+        sys.exit(1)
+
+    for archive_path in sys.argv[1:]:
+        members = list(iter_members(archive_path, recursive=True))
+        print(f"{archive_path}: {len(members)} JPEG files, {sum(stat.st_size for _, stat, _ in members)} bytes")
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from Corpus import DEFAULT_SIZES, make_corpus, parse_size
+from Folders import iter_files
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ("repair", "shift", "crop_non_mcu_blocks", "auto_detect_shift", "color", "pipeline", "pipeline_in_memory")
+PERCENTILES = (50, 90, 99)
+REGRESSION_THRESHOLD = 0.10  # Slowdown against the baseline reported as a regression
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# Function to import All-in-one.py, whose name is not a module name
+def load_pipeline():
+    spec = importlib.util.spec_from_file_location("all_in_one", os.path.join(HERE, "All-in-one.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["all_in_one"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Function to get the peak resident set size of this process in bytes, or None where it is not available
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports kilobytes
+
+
+# Function to time fn(*args) in wall clock seconds
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+# Function to run one stage over every file of a corpus folder, returns the latency and bytes of each run.
+# Runs in its own process so the peak RSS it reports belongs to this stage and image size alone
+def run_stage(stage, folder, reference_path, repeat):
+    pipeline = load_pipeline()
+    processor = pipeline.ImageProcessor()
+    # Files too small to hold anything past the encrypted start are left out, as the pipeline leaves them out
+    encrypted_paths = sorted(iter_files(folder, min_size=processor.min_input_size()))
+    latencies, sizes = [], []
+    skipped = 0
+
+    with tempfile.TemporaryDirectory() as work_folder:
+        output_folder = os.path.join(work_folder, "Repaired")
+        if stage != "repair" and not stage.startswith("pipeline"):
+            # Every other stage starts from repaired files, made here outside the timings
+            repaired_paths = [processor.repair_jpeg(reference_path, path, output_folder) for path in encrypted_paths]
+
+        for _ in range(repeat):
+            for index, encrypted_path in enumerate(encrypted_paths):
+                if stage == "repair":
+                    latencies.append(timed(processor.repair_jpeg, reference_path, encrypted_path, output_folder))
+                    sizes.append(os.path.getsize(encrypted_path))
+                elif stage == "shift":
+                    latencies.append(timed(processor.shift_mcu, repaired_paths[index]))
+                    sizes.append(os.path.getsize(repaired_paths[index]))
+                elif stage in ("crop_non_mcu_blocks", "auto_detect_shift"):
+                    try:
+                        with Image.open(repaired_paths[index]) as img:
+                            data = np.asarray(img.convert("RGB"))
+                    except OSError:
+                        skipped += 1  # A repaired file cut too short to decode is no timing of the stage
+                        continue
+                    if stage == "auto_detect_shift":
+                        data = data[:processor.crop_non_mcu_blocks(data)]
+                    latencies.append(timed(getattr(processor, stage), data))
+                    sizes.append(data.nbytes)
+                elif stage == "color":
+                    # The color stage edits in place, so every run gets a fresh copy of the repaired file
+                    color_path = os.path.join(work_folder, "color.jpg")
+                    shutil.copyfile(repaired_paths[index], color_path)
+                    latencies.append(timed(processor.auto_color_image, color_path))
+                    sizes.append(os.path.getsize(color_path))
+                else:
+                    processor.in_memory = stage == "pipeline_in_memory"
+                    latencies.append(timed(processor.process_file, reference_path, encrypted_path, output_folder))
+                    sizes.append(os.path.getsize(encrypted_path))
+
+    return {"latencies": latencies, "bytes": sizes, "peak_rss": peak_rss(), "skipped": skipped}
+
+
+# Function to turn the latencies and bytes of a stage into throughput and latency percentiles
+def summarize(run):
+    latencies = np.array(run["latencies"])
+    total = float(latencies.sum())
+    summary = {
+        "files": len(latencies),
+        "skipped": run.get("skipped", 0),
+        "files_per_s": len(latencies) / total if total else None,
+        "mb_per_s": sum(run["bytes"]) / total / 1e6 if total else None,
+        "peak_rss_mb": run["peak_rss"] / 1e6 if run["peak_rss"] is not None else None,
+    }
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = float(np.percentile(latencies, percentile)) * 1000 if len(latencies) else None
+    return summary
+
+
+# Function to benchmark the stages over each image size of a corpus, returns {"WxH": {stage: summary}}
+def run_benchmark(corpus, stages=STAGES, repeat=1):
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for size, (folder, reference_path) in corpus.items():
+        name = f"{size[0]}x{size[1]}"
+        results[name] = {}
+        for stage in stages:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                run = executor.submit(run_stage, stage, folder, reference_path, repeat).result()
+            results[name][stage] = summarize(run)
+            print(format_line(name, stage, results[name][stage]), flush=True)
+    return results
+
+
+def format_line(name, stage, summary):
+    if not summary["files"]:
+        return f"{name:>10} {stage:<20} no files to time ({summary['skipped']} skipped)"
+    rss = f"{summary['peak_rss_mb']:.0f} MB" if summary["peak_rss_mb"] is not None else "n/a"
+    percentiles = " ".join(f"p{p} {summary[f'p{p}_ms']:.1f} ms" for p in PERCENTILES)
+    return (f"{name:>10} {stage:<20} {summary['files_per_s']:8.2f} files/s {summary['mb_per_s']:8.2f} MB/s "
+            f"{percentiles}  peak RSS {rss}")
+
+
+# Function to compare results with a saved baseline, returns the (size, stage, ratio) of each regression
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    regressions = []
+    for name, stages in results.items():
+        for stage, summary in stages.items():
+            before = baseline.get(name, {}).get(stage)
+            if not before or not before.get("files_per_s") or not summary["files_per_s"]:
+                continue
+            ratio = summary["files_per_s"] / before["files_per_s"]
+            marker = "REGRESSION" if ratio < 1 - threshold else ""
+            print(f"{name:>10} {stage:<20} {before['files_per_s']:8.2f} -> {summary['files_per_s']:8.2f} files/s "
+                  f"({ratio:.2f}x) {marker}")
+            if marker:
+                regressions.append((name, stage, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the repair, shift and color stages on a synthetic corpus.")
+    parser.add_argument("source", help="JPEG file the corpus is made from")
+    parser.add_argument("-o", "--corpus", help="folder to build the corpus in (default: a temporary folder)")
+    parser.add_argument("-s", "--size", action="append", type=parse_size, dest="sizes",
+                        help="image size as WIDTHxHEIGHT, can be given several times (default: 1600x1200 4000x3000 6000x4000)")
+    parser.add_argument("-n", "--count", type=int, default=4, help="files per size (default: 4)")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="times each file is run per stage (default: 1)")
+    parser.add_argument("--stage", action="append", choices=STAGES, dest="stages", help="stage to run (default: all)")
+    parser.add_argument("--save", help="write the results to this JSON file, e.g. as a baseline")
+    parser.add_argument("--compare", help="baseline JSON file to compare the results with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown reported as a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    corpus_folder = args.corpus or tempfile.mkdtemp(prefix="jpeg-corpus-")
+    try:
+        try:
+            corpus = make_corpus(args.source, corpus_folder, tuple(args.sizes or DEFAULT_SIZES), args.count)
+        except ValueError as e:
+            parser.error(str(e))
+        results = run_benchmark(corpus, tuple(args.stages or STAGES), args.repeat)
+    finally:
+        if not args.corpus:
+            shutil.rmtree(corpus_folder, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,150 @@
+import time
+import numpy as np
+
+BLOCK_SIZE = 8  # One DCT block; use 16 for a 4:2:0 MCU
+GRAY = 128  # Value a decoder fills missing blocks with
+GRAY_THRESHOLD = 20  # Mean deviation below which a block counts as grey
+
+# Number of block rows handled per step, bounds the temporaries to a band of the image
+BAND_BLOCK_ROWS = 64
+
+
+# Function to get the mean absolute deviation from grey of every full block in the image
+def block_deviation(data, block_size=BLOCK_SIZE, gray=GRAY):
+    height, width = data.shape[:2]
+    rows, cols = height // block_size, width // block_size
+    channels = data.shape[2] if data.ndim == 3 else 1
+
+    deviation = np.empty((rows, cols), dtype=np.float64)
+    for row in range(0, rows, BAND_BLOCK_ROWS):
+        count = min(BAND_BLOCK_ROWS, rows - row)
+        band = data[row * block_size:(row + count) * block_size, :cols * block_size]
+        band = band.reshape(count, block_size, cols, block_size, channels)
+
+        # |x - gray| without leaving uint8, then one reduction per block
+        diff = np.maximum(band, gray) - np.minimum(band, gray)
+        sums = diff.sum(axis=(1, 3, 4), dtype=np.int64)
+        deviation[row:row + count] = sums / (block_size * block_size * channels)
+
+    return deviation
+
+
+# Function to get the height left after cropping the fully grey block rows at the bottom
+def gray_tail_height(data, block_size=BLOCK_SIZE, gray=GRAY):
+    height = data.shape[0]
+
+    # Check bands of block rows from the bottom up, doubling the band each time it is all grey
+    count = 1
+    while height >= block_size:
+        count = min(count, height // block_size)
+        region = data[height - count * block_size:height]
+        region = region.reshape(count, -1)
+
+        # A band is all grey when its minimum and maximum both equal grey; min/max avoid a boolean temporary
+        is_gray = (region.min(axis=1) == gray) & (region.max(axis=1) == gray)
+
+        non_gray = np.flatnonzero(~is_gray)
+        if non_gray.size:
+            return height - (count - 1 - int(non_gray[-1])) * block_size
+
+        height -= count * block_size
+        count *= 2
+
+    return height
+
+
+# Function to count the grey blocks in the last block row of the image
+def count_gray_blocks(data, block_size=BLOCK_SIZE, gray=GRAY, threshold=GRAY_THRESHOLD):
+    height = data.shape[0]
+    if height < block_size:
+        return 0  # Not enough data to process
+
+    deviation = block_deviation(data[height - block_size:height], block_size, gray)
+    return int(np.count_nonzero(deviation[0] < threshold))
+
+
+# Function to get the rows top..bottom of a PIL image as an RGB array
+def image_rows(img, top, bottom):
+    band = img.crop((0, top, img.width, bottom))
+    if band.mode != "RGB":
+        band = band.convert("RGB")
+    return np.asarray(band)
+
+
+# Function to get (height_cropped, num_good_mcu) from a PIL image, only turning its bottom rows into arrays;
+# max_rows caps the rows turned into an array at once
+def detect_gray_tail(img, block_size=BLOCK_SIZE, gray=GRAY, threshold=GRAY_THRESHOLD, max_rows=None):
+    bottom = img.height
+    max_count = max(1, max_rows // block_size) if max_rows else None
+
+    # Walk up from the bottom in bands of doubling height until a band holds a non-grey block row
+    count = 1
+    while True:
+        top = max(0, bottom - count * block_size)
+        band_height = gray_tail_height(image_rows(img, top, bottom), block_size, gray)
+        if top == 0 or band_height > 0:
+            height_cropped = top + band_height
+            break
+        bottom = top
+        count = min(count * 2, max_count) if max_count else count * 2
+
+    if height_cropped < block_size:
+        return height_cropped, 0  # Not enough data to process
+
+    last_block_row = image_rows(img, height_cropped - block_size, height_cropped)
+    return height_cropped, count_gray_blocks(last_block_row, block_size, gray, threshold)
+
+
+# Reference versions of the per-block loops these functions replace, kept for the benchmark below
+def _loop_crop_non_mcu_blocks(data):
+    block_size = 8
+    height, width, _ = data.shape
+    while height >= block_size:
+        if not np.array_equal(data[height - block_size:height, :, :], np.ones((block_size, width, 3), dtype=np.uint8) * 128):
+            break
+        height -= block_size
+    return height
+
+
+def _loop_auto_detect_shift(data):
+    block_size = 8
+    height, width, _ = data.shape
+    if height - block_size < 0:
+        return 0
+    last_scanline = data[height - block_size:height, :, :]
+    num_mcus = 0
+    for j in range(0, width - block_size + 1, block_size):
+        diff = np.abs(last_scanline[:, j:j + block_size, :].astype(int) - np.ones((block_size, block_size, 3), dtype=int) * 128)
+        if np.mean(diff) < 20:
+            num_mcus += 1
+    return num_mcus
+
+
+def _best_time(function, *args, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    for width, height in ((1600, 1200), (4000, 3000), (6000, 4000)):
+        data = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+        # Grey-fill the last 40 block rows and the right half of the block row above them
+        data[-320:] = GRAY
+        data[-328:-320, width // 2:] = GRAY + 5
+
+        loop_crop, loop_height = _best_time(_loop_crop_non_mcu_blocks, data)
+        fast_crop, fast_height = _best_time(gray_tail_height, data)
+        cropped = data[:fast_height]
+        loop_shift, loop_count = _best_time(_loop_auto_detect_shift, cropped)
+        fast_shift, fast_count = _best_time(count_gray_blocks, cropped)
+
+        assert (loop_height, loop_count) == (fast_height, fast_count)
+        print(f"{width}x{height}: crop {loop_crop * 1000:.2f} ms -> {fast_crop * 1000:.2f} ms "
+              f"({loop_crop / fast_crop:.1f}x), shift {loop_shift * 1000:.2f} ms -> {fast_shift * 1000:.2f} ms "
+              f"({loop_shift / fast_shift:.1f}x)")
@@ -0,0 +1,97 @@
+import io
+import os
+import random
+import argparse
+from PIL import Image, ImageChops, ImageOps
+
+START_OFFSET = 153605  # Bytes the ransomware overwrites at the start of every file
+TRAILER_SIZE = 334  # Bytes the ransomware appends to every file
+MCU_SIZE = 16  # MCU height of the 4:2:0 files Pillow writes by default
+GRAY = 128
+
+DEFAULT_SIZES = ((1600, 1200), (4000, 3000), (6000, 4000))
+
+
+# Function to get the folder and reference file names the corpus uses for one image size
+def size_paths(output_folder, size):
+    name = f"{size[0]}x{size[1]}"
+    return os.path.join(output_folder, name), os.path.join(output_folder, name + "_reference.jpg")
+
+
+# Function to paint the bottom gray_rows MCU rows of an image grey, as a decoder leaves missing data
+def paint_gray_rows(im, gray_rows, mcu_size=MCU_SIZE):
+    if gray_rows > 0:
+        top = max(0, im.height - gray_rows * mcu_size)
+        im.paste((GRAY,) * len(im.getbands()), (0, top, im.width, im.height))
+    return im
+
+
+# Function to encrypt JPEG bytes the way the ransomware does: noise over the start and a trailer at the end
+def encrypt_jpeg(data, rng):
+    head = min(START_OFFSET, len(data))
+    return rng.randbytes(head) + data[head:] + rng.randbytes(TRAILER_SIZE)
+
+
+# Function to build a deterministic corpus from any JPEG: for each size, a reference JPEG and
+# count encrypted files made from shifted copies of the source, returns {size: (folder, reference path)}.
+# Raises ValueError for a size whose files encode too small to keep anything past the encrypted start
+def make_corpus(source_path, output_folder, sizes=DEFAULT_SIZES, count=4, quality=92, gray_rows=4, seed=0):
+    rng = random.Random(seed)
+    with Image.open(source_path) as source:
+        source = ImageOps.exif_transpose(source).convert("RGB")
+
+    corpus = {}
+    for size in sizes:
+        folder, reference_path = size_paths(output_folder, size)
+        os.makedirs(folder, exist_ok=True)
+        image = ImageOps.fit(source, size)
+
+        # Same size, quality and subsampling as the files, so its tables and frame header fit them
+        image.transpose(Image.Transpose.FLIP_LEFT_RIGHT).save(reference_path, "JPEG", quality=quality)
+
+        for index in range(count):
+            # Every file gets its own content so no two files compress the same
+            variant = ImageChops.offset(image, rng.randrange(size[0]), rng.randrange(size[1]))
+            variant = paint_gray_rows(variant, gray_rows)
+
+            buffer = io.BytesIO()
+            variant.save(buffer, "JPEG", quality=quality)
+            data = buffer.getvalue()
+            if len(data) <= START_OFFSET + TRAILER_SIZE:
+                # The noise would cover the whole file and the repair would have nothing left to work on
+                raise ValueError(f"{size[0]}x{size[1]} at quality {quality} encodes to {len(data)} bytes, not more "
+                                 f"than the {START_OFFSET + TRAILER_SIZE} the encryption covers; use a larger size")
+
+            encrypted_path = os.path.join(folder, f"IMG_{index:04d}.jpg")
+            with open(encrypted_path, 'wb') as file:
+                file.write(encrypt_jpeg(data, rng))
+
+        corpus[size] = (folder, reference_path)
+    return corpus
+
+
+# Function to parse "WIDTHxHEIGHT"
+def parse_size(text):
+    width, _, height = text.lower().partition("x")
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a synthetic encrypted JPEG corpus from any JPEG.")
+    parser.add_argument("source", help="JPEG file the corpus images are made from")
+    parser.add_argument("output", help="folder to write the corpus to")
+    parser.add_argument("-s", "--size", action="append", type=parse_size, dest="sizes",
+                        help="image size as WIDTHxHEIGHT, can be given several times (default: 1600x1200 4000x3000 6000x4000)")
+    parser.add_argument("-n", "--count", type=int, default=4, help="encrypted files per size (default: 4)")
+    parser.add_argument("-q", "--quality", type=int, default=92, help="JPEG quality (default: 92)")
+    parser.add_argument("-g", "--gray-rows", type=int, default=4, help="grey MCU rows painted at the bottom (default: 4)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the noise and the image offsets (default: 0)")
+    args = parser.parse_args()
+
+    try:
+        corpus = make_corpus(args.source, args.output, tuple(args.sizes or DEFAULT_SIZES), args.count,
+                             args.quality, args.gray_rows, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    for size, (folder, reference_path) in corpus.items():
+        print(f"{size[0]}x{size[1]}: {folder} (reference {reference_path})")
@@ -0,0 +1,115 @@
+from PIL import Image, ImageOps, ImageEnhance, ImageFilter
+
+# Weights of ImageFilter.SMOOTH, the degenerate image ImageEnhance.Sharpness blends against
+SMOOTH_WEIGHTS = (1, 1, 1, 1, 5, 1, 1, 1, 1)
+SMOOTH_SCALE = 13
+
+
+# Function to get one 3x3 kernel doing what ImageEnhance.Sharpness(im).enhance(factor) does in a filter and a blend
+def sharpen_kernel(factor):
+    weights = [factor * SMOOTH_SCALE * (i == 4) + (1 - factor) * w for i, w in enumerate(SMOOTH_WEIGHTS)]
+    return ImageFilter.Kernel((3, 3), weights, scale=SMOOTH_SCALE)
+
+
+# Rows of context a strip needs above and below it for the 3x3 sharpen kernel
+STRIP_OVERLAP = 1
+# Strip-sized images alive at once while a strip is processed: the strip and its copy with context, the
+# contrast and sharpen outputs, the two grey conversions the color blend uses, its output and the crop
+STRIP_COPIES = 8
+MIN_STRIP_ROWS = 16
+
+
+# Function to apply auto contrast, sharpness and color to an image with as few full-image passes as possible
+def auto_color(im, cutoff=1, sharpness=3, color=3, posterize_bits=8):
+    # Auto contrast takes one histogram and applies one lookup table per band
+    im = ImageOps.autocontrast(im, cutoff=cutoff)
+    return enhance(im, sharpness, color, posterize_bits)
+
+
+# Function to apply the sharpness, posterize and color steps of auto_color
+def enhance(im, sharpness=3, color=3, posterize_bits=8):
+    # Sharpness folded into a single convolution instead of a SMOOTH filter plus a blend
+    if sharpness != 1:
+        try:
+            im = im.filter(sharpen_kernel(sharpness))
+        except ValueError:
+            im = ImageEnhance.Sharpness(im).enhance(sharpness)  # Modes the kernel filter does not take
+
+    # Posterizing to 8 bits keeps every value, only fewer bits cost a pass
+    if posterize_bits < 8:
+        im = ImageOps.posterize(im, bits=posterize_bits)
+
+    # Color enhancement does nothing to single band images
+    if color != 1 and len(im.getbands()) > 1:
+        im = ImageEnhance.Color(im).enhance(color)
+
+    return im
+
+
+# Function to get the lookup table ImageOps.autocontrast builds from a histogram, band after band
+def autocontrast_lut(histogram, cutoff=1):
+    low_cut, high_cut = cutoff if isinstance(cutoff, tuple) else (cutoff, cutoff)
+    lut = []
+    for layer in range(0, len(histogram), 256):
+        h = list(histogram[layer:layer + 256])
+        n = sum(h)
+
+        # Cut the darkest and lightest pixels off the histogram
+        for cut, order in ((int(n * low_cut // 100), range(256)), (int(n * high_cut // 100), range(255, -1, -1))):
+            if not cut:
+                continue
+            for ix in order:
+                taken = min(cut, h[ix])
+                h[ix] -= taken
+                cut -= taken
+                if cut <= 0:
+                    break
+
+        lo = next((ix for ix in range(256) if h[ix]), 255)
+        hi = next((ix for ix in range(255, -1, -1) if h[ix]), 0)
+        if hi <= lo:
+            lut.extend(range(256))
+        else:
+            scale = 255.0 / (hi - lo)
+            offset = -lo * scale
+            lut.extend(min(255, max(0, int(ix * scale + offset))) for ix in range(256))
+    return lut
+
+
+# Function to get the strip height that keeps auto_color_strips within memory_budget bytes, besides the
+# decoded image itself; None when the whole image fits
+def strip_rows(im, memory_budget):
+    row_bytes = im.width * len(im.getbands())
+    if row_bytes * im.height * (STRIP_COPIES + 1) <= memory_budget:
+        return None
+    rows = (memory_budget - row_bytes * im.height) // (row_bytes * STRIP_COPIES) - 2 * STRIP_OVERLAP
+    return max(MIN_STRIP_ROWS, rows)
+
+
+# Function to apply auto_color in horizontal strips of rows rows, writing each strip back into im, so only a
+# strip's worth of intermediates is alive at a time; gives the same pixels as auto_color. The contrast
+# statistics come from one histogram pass over the whole image first
+def auto_color_strips(im, rows, cutoff=1, sharpness=3, color=3, posterize_bits=8):
+    if im.mode not in ("L", "RGB"):
+        return auto_color(im, cutoff, sharpness, color, posterize_bits)  # The modes autocontrast takes
+    im.load()
+    lut = autocontrast_lut(im.histogram(), cutoff)
+
+    width, height = im.size
+    context = None  # Last row of the previous strip as it was before that strip was written back
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        lower = min(bottom + STRIP_OVERLAP, height)
+        strip = im.crop((0, top, width, lower))
+        next_context = strip.crop((0, bottom - top - STRIP_OVERLAP, width, bottom - top))
+        if context is not None:
+            with_context = Image.new(im.mode, (width, lower - top + STRIP_OVERLAP))
+            with_context.paste(context, (0, 0))
+            with_context.paste(strip, (0, STRIP_OVERLAP))
+            strip = with_context
+
+        first = STRIP_OVERLAP if context is not None else 0
+        strip = enhance(strip.point(lut), sharpness, color, posterize_bits)
+        im.paste(strip.crop((0, first, width, first + bottom - top)), (0, top))
+        context = next_context
+    return im
@@ -0,0 +1,37 @@
+import os
+
+# Size of the buffer used when the kernel cannot copy between files for us
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+# Function to copy count bytes at offset of src_file to the current position of dst_file
+def copy_range(src_file, dst_file, offset, count):
+    dst_file.flush()
+    src_fd = src_file.fileno()
+    dst_fd = dst_file.fileno()
+
+    # Let the kernel move the bytes without them passing through Python
+    for kernel_copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        while kernel_copy is not None and count > 0:
+            try:
+                if kernel_copy is os.sendfile:
+                    copied = os.sendfile(dst_fd, src_fd, offset, count)
+                else:
+                    copied = kernel_copy(src_fd, dst_fd, count, offset)
+            except OSError:
+                break
+            if copied == 0:
+                break
+            offset += copied
+            count -= copied
+
+    # Fall back to chunked copies through a single reused buffer
+    if count > 0:
+        buffer = memoryview(bytearray(min(count, COPY_CHUNK_SIZE)))
+        src_file.seek(offset)
+        while count > 0:
+            read = src_file.readinto(buffer[:min(count, len(buffer))])
+            if not read:
+                break
+            dst_file.write(buffer[:read])
+            count -= read
@@ -0,0 +1,72 @@
+import os
+import re
+import fnmatch
+
+JPEG_PATTERNS = ("*.jpg", "*.jpeg")
+# Names ransomware gives encrypted JPEG files: a prefix (jpg.<id>) or an extra extension (IMG_1.jpg.<ext>)
+ENCRYPTED_PATTERNS = ("*.jpg", "*.jpeg", "jpg.*", "jpeg.*", "*.jpg.*", "*.jpeg.*")
+# The JPEG extension of a renamed file, followed by what the ransomware appended, and the prefix form
+RENAMED_EXTENSION = re.compile(r"\.jpe?g(?=\.|$)", re.IGNORECASE)
+RENAMED_PREFIX = re.compile(r"jpe?g\.(?=.)", re.IGNORECASE)
+# Folders holding our own outputs, never scanned for inputs
+SKIPPED_FOLDERS = ("Repaired",)
+
+
+# Function to turn shell-style name patterns into one case-insensitive matcher
+def name_matcher(patterns):
+    regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns), re.IGNORECASE)
+    return regex.match
+
+
+# Function to get the name of an encrypted file without what the ransomware added and without its extension:
+# IMG_1 for IMG_1.jpg and IMG_1.jpg.locked, id0 for jpg.id0, and the name minus its last extension otherwise
+def original_stem(name):
+    extension = RENAMED_EXTENSION.search(name, 1)
+    if extension:
+        return name[:extension.start()]
+    prefix = RENAMED_PREFIX.match(name)
+    if prefix:
+        return name[prefix.end():]
+    stem, dot, _ = name.rpartition('.')
+    return stem if dot and stem else name
+
+
+# Function to yield the paths of the files in folder whose names match patterns, as the directory is read.
+# Subfolders are walked depth first when recursive, files smaller than min_size are left out. With sort, each
+# directory's files come in name order, at the cost of reading the whole directory before its first file
+def iter_files(folder, patterns=JPEG_PATTERNS, recursive=False, min_size=0, skipped_folders=SKIPPED_FOLDERS,
+               sort=False):
+    matches = name_matcher(patterns)
+    pending = [folder]
+    while pending:
+        directory = pending.pop()
+        files, subfolders = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        # The entry type comes from the directory listing, only the size check needs a stat
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive and entry.name not in skipped_folders:
+                                subfolders.append(entry.path)
+                            continue
+                        if not matches(entry.name) or not entry.is_file():
+                            continue
+                        if min_size and entry.stat().st_size < min_size:
+                            continue
+                    except OSError:
+                        continue  # Removed or unreadable since the listing
+                    if sort:
+                        files.append(entry.path)
+                    else:
+                        yield entry.path
+        except OSError:
+            if directory == folder:
+                raise
+            continue  # An unreadable subfolder does not stop the walk
+
+        # scandir order depends on the file system
+        yield from sorted(files)
+
+        # Visit subfolders in name order once the files of this one are handed out
+        pending.extend(sorted(subfolders, reverse=True))
@@ -0,0 +1,221 @@
+import os
+import json
+import argparse
+import numpy as np
+from PIL import Image, ImageFile
+from Blocks import GRAY
+from Folders import JPEG_PATTERNS, iter_files
+
+BLOCK_SIZE = 8  # One DCT block; the decoder gives one pixel per block at 1/8 scale
+MCU_BLOCKS = (1, 1)  # Blocks per MCU (across, down) for images that do not say, e.g. PNG
+FILL_TOLERANCE = 1  # Levels a block mean may be off the fill colour and still count as fill
+# A row whose median second difference of the MCU DC exceeds this many levels, and ROW_SHIFT_FACTOR times the
+# image's median, starts a colour-shifted band: a desync leaves the DC predictors off by a constant, which
+# content seldom does across a whole row
+ROW_SHIFT_LIMIT = 3.0
+ROW_SHIFT_FACTOR = 4
+# Second difference of the luma DC above which a single MCU counts as a discontinuity
+DC_JUMP_LIMIT = 48
+HEATMAP_SCALE = 4  # Heatmap pixels per MCU side
+HEATMAP_GAIN = 4  # Heatmap levels per level of DC jump or chroma shift
+HEALTH_NAME = "health.jsonl"
+
+# RGB to the YCbCr of JFIF, without the 128 offset of the chroma
+YCBCR = np.array([[0.299, 0.587, 0.114],
+                  [-0.168736, -0.331264, 0.5],
+                  [0.5, -0.418688, -0.081312]], dtype=np.float32)
+
+
+# Function to get the MCU size of an opened image in blocks (across, down) from its sampling factors
+def mcu_blocks(im):
+    layers = getattr(im, "layer", None)
+    if not layers:
+        return MCU_BLOCKS
+    return max(layer[1] for layer in layers), max(layer[2] for layer in layers)
+
+
+# Function to get the mean colour of every block of an image as a (rows, columns, 3) uint8 array, and its MCU size
+# in blocks. JPEG files are decoded at 1/8 scale, where the decoder only computes the DC of each block
+def load_block_means(path):
+    with Image.open(path) as im:
+        blocks = mcu_blocks(im)
+        size = (-(-im.width // BLOCK_SIZE), -(-im.height // BLOCK_SIZE))
+        im.draft("RGB", size)
+        preview = im.convert("RGB") if im.mode != "RGB" else im
+        if preview.size != size:
+            preview = preview.reduce(BLOCK_SIZE)  # Not a JPEG, so the blocks are averaged here
+        return np.asarray(preview), blocks
+
+
+# Function to compute the health of every MCU from the block means of an image in one pass. Returns compact grids:
+#   gray: MCUs filled with the fill colour, data the decoder never got (bool)
+#   dc_jump: luma DC left over after the straight line through the two MCUs above or to the left (uint8 levels)
+#   chroma_shift: the same for the chroma, as the length of the Cb/Cr difference (uint8 levels)
+#   row_shift: per MCU row, the median signed second difference of Y, Cb and Cr as a length (float32 levels)
+# and the per-file fractions and score, between 0 (clean) and 1. fill is the colour missing data decodes to,
+# mid grey unless the color stage has changed it
+def mcu_health(block_means, mcu_size=MCU_BLOCKS, fill=(GRAY, GRAY, GRAY)):
+    across, down = mcu_size
+    data = np.asarray(block_means, dtype=np.float32)
+    rows, columns = max(1, data.shape[0] // down), max(1, data.shape[1] // across)
+
+    # Partial MCUs at the right and bottom edges are left out, unless the image is smaller than one MCU
+    data = np.pad(data, ((0, max(0, down - data.shape[0])), (0, max(0, across - data.shape[1])), (0, 0)), mode="edge")
+    data = data[:rows * down, :columns * across]
+    is_fill = np.ones(data.shape[:2], dtype=bool)
+    for channel, level in enumerate(fill):
+        values = data[..., channel]
+        is_fill &= (values >= level - FILL_TOLERANCE) & (values <= level + FILL_TOLERANCE)
+
+    # Sum the blocks of each MCU through strided views, much faster than reducing over a reshaped array
+    offsets = [(y, x) for y in range(down) for x in range(across)]
+    gray = sum(is_fill[y::down, x::across].astype(np.uint8) for y, x in offsets) * 2 >= len(offsets)
+    means = sum(data[y::down, x::across] for y, x in offsets) / len(offsets)
+
+    # Second differences of the MCU DC: a gradient leaves next to nothing, a DC offset the whole offset
+    ycc = means @ YCBCR.T
+    vertical = np.zeros_like(ycc)
+    vertical[2:] = ycc[2:] - 2 * ycc[1:-1] + ycc[:-2]
+    horizontal = np.zeros_like(ycc)
+    horizontal[:, 2:] = ycc[:, 2:] - 2 * ycc[:, 1:-1] + ycc[:, :-2]
+
+    dc_jump = np.maximum(np.abs(vertical[..., 0]), np.abs(horizontal[..., 0]))
+    chroma_shift = np.maximum(np.hypot(vertical[..., 1], vertical[..., 2]), np.hypot(horizontal[..., 1], horizontal[..., 2]))
+    row_shift = np.linalg.norm(np.median(vertical, axis=1), axis=-1).astype(np.float32)
+
+    # A shifted band runs to the end of the scan or the next restart marker. The rows next to a fill are left
+    # out, as the edges of a fill are already counted as fill
+    has_gray = gray.any(axis=1)
+    near_gray = has_gray.copy()
+    near_gray[1:] |= has_gray[:-1]
+    near_gray[2:] |= has_gray[:-2]
+    gray_rows = np.flatnonzero(has_gray)
+    shift_limit = max(ROW_SHIFT_LIMIT, ROW_SHIFT_FACTOR * float(np.median(row_shift)))
+    shifted_rows = np.flatnonzero((row_shift > shift_limit) & ~near_gray)
+    candidates = [int(found[0]) for found in (gray_rows, shifted_rows) if found.size]
+    first_bad_row = min(candidates) if candidates else None
+
+    gray_fraction = float(gray.mean())
+    shifted_fraction = 1 - int(shifted_rows[0]) / rows if shifted_rows.size else 0.0
+    jump_fraction = float(((dc_jump > DC_JUMP_LIMIT) & ~gray).mean())
+    return {
+        "mcu_blocks": (across, down),
+        "gray": gray,
+        "dc_jump": np.clip(np.rint(dc_jump), 0, 255).astype(np.uint8),
+        "chroma_shift": np.clip(np.rint(chroma_shift), 0, 255).astype(np.uint8),
+        "row_shift": row_shift,
+        "shift_limit": round(shift_limit, 2),
+        "first_bad_row": first_bad_row,
+        "gray_fraction": round(gray_fraction, 4),
+        "shifted_fraction": round(shifted_fraction, 4),
+        "jump_fraction": round(jump_fraction, 4),
+        "score": round(max(gray_fraction, shifted_fraction, jump_fraction), 4),
+    }
+
+
+# Function to get the health of one image file
+def file_health(path, fill=(GRAY, GRAY, GRAY)):
+    block_means, blocks = load_block_means(path)
+    return mcu_health(block_means, blocks, fill)
+
+
+# Function to get the JSON report entry of a health result: everything but the grids
+def health_entry(path, health):
+    entry = {"file": path, "mcu_rows": int(health["gray"].shape[0]), "mcu_columns": int(health["gray"].shape[1])}
+    entry.update((key, value) for key, value in health.items() if not isinstance(value, np.ndarray))
+    entry["mcu_blocks"] = list(entry["mcu_blocks"])
+    return entry
+
+
+# Function to draw a health result as an image, HEATMAP_SCALE pixels per MCU: red for DC jumps, green for chroma
+# shifts, blue for fill; the rows that start a shifted band are full red
+def heatmap(health, scale=HEATMAP_SCALE):
+    gray = health["gray"]
+    image = np.zeros(gray.shape + (3,), dtype=np.uint8)
+    image[..., 0] = np.minimum(health["dc_jump"].astype(np.uint16) * HEATMAP_GAIN, 255)
+    image[..., 1] = np.minimum(health["chroma_shift"].astype(np.uint16) * HEATMAP_GAIN, 255)
+    image[..., 2] = gray * 255
+    image[(health["row_shift"] > health["shift_limit"]) & ~gray.any(axis=1), :, 0] = 255
+    return Image.fromarray(image).resize((gray.shape[1] * scale, gray.shape[0] * scale), Image.NEAREST)
+
+
+# Function to save the grids of a health result, compressed; they load back with np.load
+def save_grids(path, health):
+    np.savez_compressed(path, gray=health["gray"], dc_jump=health["dc_jump"], chroma_shift=health["chroma_shift"],
+                        row_shift=health["row_shift"])
+
+
+# Function to check the health of every image in a folder, writing a report line per file, the most damaged
+# first, and optionally a heatmap and the grids per file; returns the report entries in that order
+def health_folder(folder, output_folder=None, recursive=False, fill=(GRAY, GRAY, GRAY), heatmaps=False, grids=False):
+    output_folder = output_folder or folder
+    os.makedirs(output_folder, exist_ok=True)
+
+    entries = []
+    for path in iter_files(folder, JPEG_PATTERNS, recursive):
+        try:
+            health = file_health(path, fill)
+        except Exception as e:
+            entries.append({"file": path, "score": 1.0, "error": str(e)})
+            continue
+        entries.append(health_entry(path, health))
+
+        stem = os.path.splitext(os.path.relpath(path, folder))[0].replace(os.sep, "_")
+        if heatmaps:
+            heatmap(health).save(os.path.join(output_folder, stem + "_health.png"))
+        if grids:
+            save_grids(os.path.join(output_folder, stem + "_health.npz"), health)
+
+    entries.sort(key=lambda entry: entry["score"], reverse=True)
+    with open(os.path.join(output_folder, HEALTH_NAME), 'w', encoding='utf-8') as report_file:
+        for entry in entries:
+            report_file.write(json.dumps(entry) + "\n")
+    return entries
+
+
+# Function to parse a fill colour given as one grey level or as R,G,B
+def parse_fill(text):
+    levels = [int(level) for level in text.split(",")]
+    if len(levels) == 1:
+        levels *= 3
+    if len(levels) != 3 or not all(0 <= level <= 255 for level in levels):
+        raise ValueError(f"Fill colour must be one level or R,G,B between 0 and 255: {text}")
+    return tuple(levels)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map the damage of JPEG files MCU by MCU: grey fill, DC jumps and "
+                                                 "colour-shifted bands, ranked by a per-file score.")
+    parser.add_argument("paths", nargs="+", metavar="FILE_OR_FOLDER", help="JPEG files, or folders of them")
+    parser.add_argument("-o", "--output", help="folder for the report, heatmaps and grids (default: each folder)")
+    parser.add_argument("-R", "--recursive", action="store_true", help="also check the subfolders")
+    parser.add_argument("--fill", type=parse_fill, default=(GRAY, GRAY, GRAY),
+                        help=f"colour missing data decodes to, one level or R,G,B (default: {GRAY})")
+    parser.add_argument("--heatmaps", action="store_true",
+                        help="write a heatmap per file: red DC jumps, green chroma shifts, blue fill")
+    parser.add_argument("--grids", action="store_true", help="write the grids per file as compressed .npz")
+    args = parser.parse_args()
+
+    # Cut-short files are what this maps, so let the decoder fill what is missing instead of failing
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    entries = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            entries.extend(health_folder(path, args.output, args.recursive, args.fill, args.heatmaps, args.grids))
+        else:
+            health = file_health(path, args.fill)
+            entries.append(health_entry(path, health))
+            stem = os.path.join(args.output or os.path.dirname(path), os.path.splitext(os.path.basename(path))[0])
+            if args.heatmaps:
+                heatmap(health).save(stem + "_health.png")
+            if args.grids:
+                save_grids(stem + "_health.npz", health)
+
+    entries.sort(key=lambda entry: entry["score"], reverse=True)
+    for entry in entries:
+        if "error" in entry:
+            print(f"1.00 {entry['file']} ({entry['error']})")
+        else:
+            first_bad = "clean" if entry["first_bad_row"] is None else f"bad from MCU row {entry['first_bad_row']}"
+            print(f"{entry['score']:.2f} {entry['file']}: {first_bad}, fill {entry['gray_fraction']:.2f}, "
+                  f"shifted {entry['shifted_fraction']:.2f}, jumps {entry['jump_fraction']:.2f}")
@@ -0,0 +1,90 @@
+import os
+import json
+import mmap
+import hashlib
+
+MANIFEST_NAME = "manifest.jsonl"  # Kept in the Repaired folder next to the outputs it describes
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+# Function to hash bytes the same way file_hash hashes a file
+def data_hash(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+# Function to hash a file in chunks without loading it whole
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=20)
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb') as file:
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+# Function to hash the bytes of a file between start and end, mapped rather than read into memory
+def region_hash(path, start, end):
+    digest = hashlib.blake2b(digest_size=20)
+    if end > start:
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+                memoryview(mapped) as view:
+            digest.update(view[start:end])
+    return digest.hexdigest()
+
+
+# Function to get the hash of a file, reusing the one in entry when the file's size and mtime have not changed
+def current_hash(path, stat, entry=None):
+    if entry is not None and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+        return entry["input_hash"]
+    return file_hash(path)
+
+
+# Function to check that a manifest entry covers these inputs and parameters and finished every stage
+def is_complete(entry, input_hash, reference_hash, parameters, stages):
+    return (entry is not None
+            and entry.get("input_hash") == input_hash
+            and entry.get("reference_hash") == reference_hash
+            and entry.get("parameters") == parameters
+            and all(stage in entry.get("stages", ()) for stage in stages))
+
+
+# Append-only JSON lines record of the files a batch has processed; the last line for a file wins
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as manifest_file:
+                for line in manifest_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short when an earlier run died
+                    if isinstance(entry, dict) and "file" in entry:
+                        self.entries[entry["file"]] = entry
+        except FileNotFoundError:
+            pass
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    # Function to add an entry, written through at once so a crash loses at most the file in progress
+    def record(self, entry):
+        self.entries[entry["file"]] = entry
+        with open(self.path, 'a', encoding='utf-8') as manifest_file:
+            manifest_file.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    # Function to rewrite the manifest with one line per file
+    def compact(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+            for name in sorted(self.entries):
+                manifest_file.write(json.dumps(self.entries[name], sort_keys=True) + "\n")
+        os.replace(temp_path, self.path)
@@ -0,0 +1,160 @@
+import json
+import time
+
+SLOWEST_FILES = 10  # Files listed in the summary
+FILE_STAGE = "file"  # Stage covering one input file from start to end
+
+
+# Function to get the nearest-rank percentile of sorted values
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+# One timed stage; counts added while it is the innermost open stage go into its event
+class Span:
+    enabled = True
+
+    def __init__(self, tracer, stage):
+        self.tracer = tracer
+        self.stage = stage
+        self.counts = {}
+
+    def __enter__(self):
+        self.tracer.open_spans.append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event = {"event": "stage", "file": self.tracer.file, "stage": self.stage,
+                 "wall_s": time.perf_counter() - self.wall, "cpu_s": time.process_time() - self.cpu,
+                 "ok": exc_type is None}
+        event.update(self.counts)
+        self.tracer.open_spans.pop()
+        self.tracer.events.append(event)
+        return False
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+
+# Records stage events as they happen; record() is called where they are gathered, and writes them as JSON lines
+class Tracer:
+    enabled = True
+
+    def __init__(self, path=None):
+        self.path = path  # JSON lines file the events and the summary are appended to, None keeps them in memory
+        self.file = None  # Input file the next events belong to
+        self.events = []  # Events not yet handed to record()
+        self.open_spans = []
+        self.stage_walls = {}
+        self.stage_totals = {}
+        self.file_walls = []
+        self.failures = 0
+
+    def stage(self, name):
+        return Span(self, name)
+
+    # Function to add counts such as bytes_read, bytes_written or pixels to the innermost open stage
+    def count(self, **counts):
+        if self.open_spans:
+            self.open_spans[-1].add(**counts)
+
+    # Function to take the events recorded since the last call, e.g. to send them back from a worker process
+    def drain(self):
+        events, self.events = self.events, []
+        return events
+
+    # Function to write events and add them to the summary
+    def record(self, events):
+        for event in events:
+            stage = event["stage"]
+            self.stage_walls.setdefault(stage, []).append(event["wall_s"])
+            totals = self.stage_totals.setdefault(stage, {})
+            for name, value in event.items():
+                if name.endswith("_s") or name in ("bytes_read", "bytes_written", "pixels"):
+                    totals[name] = totals.get(name, 0) + value
+            if not event["ok"]:
+                self.failures += 1
+            if stage == FILE_STAGE:
+                self.file_walls.append((event["wall_s"], event["file"]))
+        self.write(events)
+
+    def write(self, events):
+        if self.path is not None and events:
+            with open(self.path, 'a', encoding='utf-8') as metrics_file:
+                for event in events:
+                    metrics_file.write(json.dumps(event) + "\n")
+
+    # Function to get the end of run summary: counts and percentiles per stage and the slowest files
+    def summary(self):
+        stages = {}
+        for stage, walls in self.stage_walls.items():
+            walls = sorted(walls)
+            stages[stage] = dict(self.stage_totals[stage], count=len(walls),
+                                 p50_s=percentile(walls, 0.50), p95_s=percentile(walls, 0.95))
+        slowest = sorted(self.file_walls, reverse=True)[:SLOWEST_FILES]
+        return {"event": "summary", "files": len(self.file_walls), "failures": self.failures, "stages": stages,
+                "slowest_files": [{"file": file, "wall_s": wall} for wall, file in slowest]}
+
+    # Function to write the summary after the events, returns it as log lines
+    def finish(self):
+        self.write([self.summary()])
+        return self.summary_lines()
+
+    def summary_lines(self):
+        summary = self.summary()
+        lines = [f"Metrics: {summary['files']} files, {summary['failures']} failed stages"]
+        for stage, totals in summary["stages"].items():
+            lines.append(f"  {stage}: {totals['count']} runs, {totals['wall_s']:.3f} s wall, {totals['cpu_s']:.3f} s CPU, "
+                         f"p50 {totals['p50_s'] * 1000:.1f} ms, p95 {totals['p95_s'] * 1000:.1f} ms, "
+                         f"{totals.get('bytes_read', 0)} bytes read, {totals.get('bytes_written', 0)} bytes written, "
+                         f"{totals.get('pixels', 0)} pixels")
+        for slow in summary["slowest_files"]:
+            lines.append(f"  slow: {slow['file']} {slow['wall_s']:.3f} s")
+        return lines
+
+
+class _NullSpan:
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, **counts):
+        pass
+
+
+# Stands in for a Tracer when metrics are off, so each instrumented stage costs one call and an empty with block
+class NullTracer:
+    enabled = False
+    file = None
+    _span = _NullSpan()
+
+    def stage(self, name):
+        return self._span
+
+    def count(self, **counts):
+        pass
+
+    def drain(self):
+        return []
+
+    def record(self, events):
+        pass
+
+    def finish(self):
+        return []
+
+    def summary_lines(self):
+        return []
+
+
+NULL_TRACER = NullTracer()
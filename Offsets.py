@@ -0,0 +1,160 @@
+import os
+import sys
+import math
+import numpy as np
+
+# Bytes scanned per step, bounds the temporaries when scanning large memory-mapped files
+CHUNK_SIZE = 64 * 1024 * 1024
+ENTROPY_WINDOW = 4096
+NOISE_ENTROPY = 7.9  # Windows of random bytes measure above this, text, padding and headers well below
+# Rate of 0xFF followed by anything but 0x00 or RST0-7 in random bytes; entropy-coded data never has one
+NOISE_MARKER_RATE = (1 / 256) * (247 / 256)
+# Estimates within this many bytes of the true boundary count as right in the confidence scores
+PREFIX_TOLERANCE = 64
+# Batch estimates more than this many mean marker gaps past the median are treated as outliers
+OUTLIER_GAPS = 8
+# Bytes after a file's prefix estimate searched for the stuffed FF bytes that bound the true boundary from above
+STUFFING_WINDOW = 64 * 1024
+EOI = 0xD9
+
+
+# Function to open a file as a read-only byte array without reading it into memory
+def map_file(path):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+# Function to get the offsets of every 0xFF that starts something other than stuffing (FF 00) or a
+# restart marker (FF D0-D7); entropy-coded scan data has none, random bytes one every ~265 bytes
+def marker_positions(data, chunk_size=CHUNK_SIZE):
+    positions = []
+    for start in range(0, max(len(data) - 1, 0), chunk_size):
+        block = np.asarray(data[start:start + chunk_size + 1])
+        ff = np.flatnonzero(block[:-1] == 0xFF)
+        following = block[ff + 1]
+        is_marker = (following != 0) & ((following < 0xD0) | (following > 0xD7))
+        positions.append(ff[is_marker] + start)
+    return np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+
+
+# Function to get the Shannon entropy in bits per byte of each full window of data
+def window_entropy(data, window=ENTROPY_WINDOW, chunk_size=CHUNK_SIZE):
+    count = len(data) // window
+    entropy = np.empty(count, dtype=np.float64)
+    windows_per_chunk = max(1, chunk_size // window)
+    for first in range(0, count, windows_per_chunk):
+        last = min(count, first + windows_per_chunk)
+        block = np.asarray(data[first * window:last * window]).reshape(last - first, window)
+
+        # One bincount for the histograms of every window in the chunk
+        keys = block + (np.arange(last - first, dtype=np.int64)[:, None] << 8)
+        histograms = np.bincount(keys.ravel(), minlength=(last - first) << 8).reshape(last - first, 256)
+        p = histograms / window
+        with np.errstate(divide='ignore', invalid='ignore'):
+            entropy[first:last] = -np.where(p > 0, p * np.log2(p), 0).sum(axis=1)
+    return entropy
+
+
+# Function to estimate how many encrypted bytes start a file and how many bytes follow its EOI.
+# The scan data is the longest run without a marker; the prefix ends at the marker before it,
+# and the trailer starts after the EOI closing it
+def scan_offsets(data):
+    size = len(data)
+    markers = marker_positions(data)
+
+    # Run i lies between markers[i - 1] + 2 and markers[i], with the file ends as sentinels
+    starts = np.concatenate(([0], markers + 2))
+    ends = np.concatenate((markers, [size]))
+    lengths = ends - starts
+    run = int(np.argmax(lengths)) if len(lengths) else 0
+    prefix, scan_end = int(starts[run]), int(ends[run])
+    scan_length = max(0, scan_end - prefix)
+
+    if scan_end < size - 1 and data[scan_end + 1] == EOI:
+        trailer = size - scan_end - 2
+        trailer_confidence = 1.0
+    else:
+        trailer = size - scan_end  # No EOI: the file ends in the scan, or in data we cannot tell from it
+        trailer_confidence = 0.5 if trailer == 0 else 0.0
+
+    # The bytes before the boundary must look like noise, the scan must be too long to be noise itself
+    entropy = window_entropy(data[:prefix])
+    noisy = float(np.mean(entropy > NOISE_ENTROPY)) if len(entropy) else 0.0
+    not_noise = 1 - math.exp(-NOISE_MARKER_RATE * scan_length)
+    exact = 1 - math.exp(-NOISE_MARKER_RATE * PREFIX_TOLERANCE)
+
+    # Stuffed FF 00 pairs are scan data, so the scan starts at the first of them at the latest; batch_offsets
+    # uses them. RSTn are left out, noise holds 8 times as many of them
+    head = np.asarray(data[prefix:min(scan_end, prefix + STUFFING_WINDOW) + 1])
+    stuffing = np.flatnonzero((head[:-1] == 0xFF) & (head[1:] == 0)) + prefix
+
+    return {"size": size, "prefix_length": prefix, "trailer_length": trailer, "scan_length": scan_length,
+            "prefix_confidence": noisy * not_noise * exact, "trailer_confidence": trailer_confidence * not_noise,
+            "stuffing": stuffing}
+
+
+# Function to estimate the offsets of one file, given as a path or as its bytes
+def file_offsets(path):
+    return scan_offsets(map_file(path) if isinstance(path, str) else np.frombuffer(path, dtype=np.uint8))
+
+
+# Function to estimate the offsets shared by a batch of files, given as paths or bytes, from a sample of them.
+# The files share the boundary, so it lies after the FF of every file's last marker and at or before the first
+# stuffed FF that two files have past that ("prefix_low" and "prefix_high"). Only when those meet is the prefix
+# known exactly; the confidence is the chance of the estimate being exact with every byte of the range as
+# likely. The trailer is the size most files agree on
+def batch_offsets(paths, sample=32):
+    paths = list(paths)
+    if sample and len(paths) > sample:
+        step = len(paths) / sample
+        paths = [paths[int(i * step)] for i in range(sample)]
+
+    estimates = [file_offsets(path) for path in paths]
+    estimates = [estimate for estimate in estimates if estimate["scan_length"] > 0]
+    if not estimates:
+        raise ValueError("No scan data found in the sample")
+
+    # Files whose estimate lies far past the others (e.g. damage inside the scan) are left out of the prefix
+    median = np.median([estimate["prefix_length"] for estimate in estimates])
+    kept = [estimate for estimate in estimates if estimate["prefix_length"] <= median + OUTLIER_GAPS / NOISE_MARKER_RATE]
+    prefix = max(estimate["prefix_length"] for estimate in kept)
+
+    # The byte after a marker's FF may already be scan data, so the boundary is only known to lie past the FF
+    low = prefix - 1
+
+    # A random FF 00 in one file's prefix looks like stuffing too, so the bound needs a second file to agree
+    firsts = sorted(int(estimate["stuffing"][estimate["stuffing"] >= low][0]) for estimate in kept
+                    if (estimate["stuffing"] >= low).any())
+    high = firsts[1] if len(firsts) > 1 else prefix + STUFFING_WINDOW
+
+    trailers = [estimate["trailer_length"] for estimate in estimates if estimate["trailer_confidence"] > 0]
+    trailer = max(set(trailers), key=trailers.count) if trailers else 0
+
+    return {"files": len(estimates), "prefix_length": min(prefix, high), "prefix_low": low, "prefix_high": high,
+            "trailer_length": trailer,
+            "prefix_confidence": len(kept) / len(estimates) / (high - low + 1),
+            "trailer_confidence": trailers.count(trailer) / len(estimates) if trailers else 0.0}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: Offsets.py FILE_OR_FOLDER...")
+        sys.exit(1)
+
+    paths = []
+    for argument in sys.argv[1:]:
+        if os.path.isdir(argument):
+            paths.extend(sorted(entry.path for entry in os.scandir(argument) if entry.is_file()))
+        else:
+            paths.append(argument)
+
+    for path in paths:
+        estimate = file_offsets(path)
+        print(f"{path}: prefix {estimate['prefix_length']} ({estimate['prefix_confidence']:.2f}), "
+              f"trailer {estimate['trailer_length']} ({estimate['trailer_confidence']:.2f})")
+    if len(paths) > 1:
+        estimate = batch_offsets(paths, sample=0)
+        print(f"Batch of {estimate['files']}: prefix {estimate['prefix_length']} ({estimate['prefix_confidence']:.2f}, "
+              f"between {estimate['prefix_low']} and {estimate['prefix_high']}), "
+              f"trailer {estimate['trailer_length']} ({estimate['trailer_confidence']:.2f})")
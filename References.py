@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import math
+import hashlib
+import numpy as np
+from PIL import Image
+from Scan import parse_header_segments
+from Segments import SOF_MARKERS, SEGMENT_MARKERS, SOS, DHT, DQT, DRI
+from Offsets import map_file, marker_positions, scan_offsets
+from Folders import iter_files
+
+INDEX_NAME = "references.json"  # Written in the library folder unless another path is given
+INDEX_VERSION = 1
+EXIF_MODEL = 0x0110
+EXIF_ORIENTATION = 0x0112
+SIZE_BUCKETS_PER_OCTAVE = 4  # File sizes within about 19% of each other share a size bucket
+
+
+# Function to hash the tables of some header segments, so files with the same tables get the same key
+def table_hash(data, segments, marker):
+    digest = hashlib.blake2b(digest_size=12)
+    for segment_marker, offset, length in segments:
+        if segment_marker == marker:
+            digest.update(bytes(data[offset + 4:offset + 2 + length]))
+    return digest.hexdigest()
+
+
+# Function to get the frame parameters found in header segments, or None without a SOF segment
+def frame_info(data, segments):
+    info = {"restart_interval": 0}
+    for marker, offset, length in segments:
+        body = bytes(data[offset + 4:offset + 2 + length])
+        if marker in SOF_MARKERS and len(body) >= 6:
+            info["sof"] = marker
+            info["height"] = int.from_bytes(body[1:3], 'big')
+            info["width"] = int.from_bytes(body[3:5], 'big')
+            info["sampling"] = ",".join(f"{body[7 + 3 * i] >> 4}x{body[7 + 3 * i] & 15}"
+                                        for i in range(body[5]) if 8 + 3 * i < len(body))
+        elif marker == DRI and len(body) >= 2:
+            info["restart_interval"] = int.from_bytes(body[:2], 'big')
+    if "sof" not in info:
+        return None
+    info["dqt"] = table_hash(data, segments, DQT)
+    info["dht"] = table_hash(data, segments, DHT)
+    return info
+
+
+# Function to get the size bucket of a file size
+def size_bucket(size):
+    return int(round(math.log2(max(size, 1)) * SIZE_BUCKETS_PER_OCTAVE))
+
+
+# Function to find the end of a JPEG header that survived after the encrypted bytes: the chain of
+# valid segments that ends with the SOS the scan data starts in, as [(marker, offset, length)]. A chain
+# of anything but SEGMENT_MARKERS is noise that looks like segments
+def surviving_segments(data, scan_start):
+    for start in marker_positions(data[:scan_start]).tolist():
+        segments = []
+        offset = start
+        while offset < scan_start and offset + 4 <= len(data) and data[offset] == 0xFF and data[offset + 1] in SEGMENT_MARKERS:
+            length = int(data[offset + 2]) << 8 | int(data[offset + 3])
+            segments.append((int(data[offset + 1]), offset, length))
+            if data[offset + 1] == SOS:
+                # The run without markers taken as the scan starts right after the SOS marker
+                if offset + 2 <= scan_start <= offset + 2 + length:
+                    return segments
+                break
+            offset += 2 + length
+    return []
+
+
+# Function to get what an encrypted file still tells about the camera and settings that made it
+def encrypted_hints(path, start_offset, trailer_size):
+    data = map_file(path)
+    region = data[min(start_offset, len(data)):max(len(data) - trailer_size, 0)]
+    return payload_hints(region, len(data) - trailer_size)
+
+
+# Function to get the same hints from the bytes kept between the encrypted start and the trailer, and the
+# file size without the trailer, e.g. for a file read from an archive
+def payload_hints(region, size):
+    if not isinstance(region, np.ndarray):
+        region = np.frombuffer(region, dtype=np.uint8)
+    estimate = scan_offsets(region)
+    scan_start = estimate["prefix_length"]
+    scan = region[scan_start:scan_start + estimate["scan_length"]]
+
+    ff = np.flatnonzero(scan[:-1] == 0xFF)
+    following = scan[ff + 1]
+    hints = {"size": size,
+             "has_restarts": bool(np.any((following >= 0xD0) & (following <= 0xD7)))}
+
+    frame = frame_info(region, surviving_segments(region, scan_start))
+    if frame is not None:
+        hints.update(frame)
+    return hints
+
+
+# Index of known-good reference JPEGs, matched to encrypted files by the hints that survive encryption
+class ReferenceLibrary:
+    def __init__(self, folder, index_path=None):
+        self.folder = folder
+        self.index_path = index_path or os.path.join(folder, INDEX_NAME)
+        self.entries = {}
+        self.by_tables = {}
+        self.by_frame = {}
+        self.by_size = {}
+        self.default = None
+
+    # Function to open a library, parsing only the references added or changed since the index was saved
+    @classmethod
+    def load(cls, folder, index_path=None):
+        library = cls(folder, index_path)
+        saved = {}
+        try:
+            with open(library.index_path, 'r', encoding='utf-8') as index_file:
+                index = json.load(index_file)
+            if index.get("version") == INDEX_VERSION:
+                saved = index["entries"]
+        except (OSError, ValueError):
+            pass
+
+        changed = False
+        for path in iter_files(folder, recursive=True):
+            name = os.path.relpath(path, folder)
+            stat = os.stat(path)
+            entry = saved.get(name)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                entry = library.describe(path, stat)
+                changed = True
+            if entry is not None:
+                library.entries[name] = entry
+        if changed or len(library.entries) != len(saved):
+            library.save()
+        library.build_lookups()
+        return library
+
+    # Function to parse one reference JPEG, returns its index entry or None when it is not usable
+    def describe(self, path, stat):
+        with open(path, 'rb') as file:
+            data = file.read()
+        try:
+            segments = parse_header_segments(data)
+        except ValueError:
+            return None
+        info = frame_info(data, segments)
+        if info is None:
+            return None
+
+        try:
+            with Image.open(path) as im:
+                exif = im.getexif()
+            info["model"] = str(exif.get(EXIF_MODEL, "")).strip("\x00 ")
+            info["orientation"] = int(exif.get(EXIF_ORIENTATION, 1))
+        except Exception:
+            info["model"], info["orientation"] = "", 1
+        info.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        return info
+
+    def save(self):
+        temp_path = self.index_path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as index_file:
+                json.dump({"version": INDEX_VERSION, "entries": self.entries}, index_file, indent=1, sort_keys=True)
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            pass  # A read-only library is still usable, it is only parsed again next time
+
+    # Function to build the lookup dictionaries, from the most to the least specific key
+    def build_lookups(self):
+        for name in sorted(self.entries):
+            entry = self.entries[name]
+            path = os.path.join(self.folder, name)
+            frame = (entry["width"], entry["height"], entry["sampling"])
+            self.by_tables.setdefault((entry["dqt"],) + frame, path)
+            self.by_frame.setdefault(frame, path)
+            self.by_size.setdefault((entry["restart_interval"] > 0, size_bucket(entry["size"])), path)
+            if self.default is None:
+                self.default = path
+
+    # Function to pick the reference for an encrypted file, returns (path, what it was matched on)
+    def match(self, encrypted_path, start_offset, trailer_size):
+        return self.match_hints(encrypted_hints(encrypted_path, start_offset, trailer_size))
+
+    # Function to pick the reference for the hints of an encrypted file, returns (path, what it was matched on)
+    def match_hints(self, hints):
+        if "width" in hints:
+            frame = (hints["width"], hints["height"], hints["sampling"])
+            path = self.by_tables.get((hints["dqt"],) + frame)
+            if path is not None:
+                return path, "tables"
+            path = self.by_frame.get(frame)
+            if path is not None:
+                return path, "frame"
+
+        # Only the size and the presence of restart markers are left; try the nearest size buckets
+        bucket = size_bucket(hints["size"])
+        for offset in (0, -1, 1, -2, 2):
+            path = self.by_size.get((hints["has_restarts"], bucket + offset))
+            if path is not None:
+                return path, "size"
+        return self.default, "default"
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: References.py LIBRARY_FOLDER [ENCRYPTED_FILE...]")
+        sys.exit(1)
+
+    library = ReferenceLibrary.load(sys.argv[1])
+    print(f"{len(library.entries)} references, {len(library.by_frame)} frame types, index {library.index_path}")
+    for encrypted_path in sys.argv[2:]:
+        path, matched_on = library.match(encrypted_path, 153605, 334)
+        print(f"{encrypted_path}: {path} ({matched_on})")
@@ -1,29 +1,42 @@
 import os
+from Folders import original_stem
+from Segments import header_end
+from Files import copy_range
 
 # Function to load a file
 def load_file(filepath):
     with open(filepath, 'rb') as file:
         return file.read()
 
-# Function to find the last FF DA + 12 bytes in a reference JPEG file
+# Function to find the header of a reference JPEG file, up to the end of its first SOS segment
 def find_ff_da_plus_12(data):
+    # The first SOS segment, whatever its length, so an embedded thumbnail's SOS is never picked
+    end = header_end(data)
+    if end is not None:
+        return data[:end]
+    # Fall back to the last SOS marker for references whose header cannot be walked
     marker = b'\xFF\xDA'
     index = data.rfind(marker)
     if index != -1:
         return data[:index + 12]  # Include FF DA + 12 bytes
     return None
 
-# Function to process the encrypted JPEG file
-def process_encrypted_jpeg(data):
+# Function to get the (start, end) byte range kept from an encrypted JPEG file of the given size
+def encrypted_payload_range(size):
     start_offset = 153605
     end_offset = -334
-    return data[start_offset:end_offset]
+    start, end, _ = slice(start_offset, end_offset).indices(size)
+    return start, max(start, end)
+
+# Function to process the encrypted JPEG file
+def process_encrypted_jpeg(data):
+    start, end = encrypted_payload_range(len(data))
+    return data[start:end]
 
 # Main function to repair the JPEG files
 def repair_jpeg(reference_path, encrypted_path, output_folder):
-    # Load reference JPEG and encrypted JPEG
+    # Load reference JPEG
     reference_data = load_file(reference_path)
-    encrypted_data = load_file(encrypted_path)
 
     # Get the (1) part from the reference JPEG
     ref_part = find_ff_da_plus_12(reference_data)
@@ -32,17 +45,15 @@ def repair_jpeg(reference_path, encrypted_path, output_folder):
         print(f"Could not find FF DA marker in {reference_path}")
         return
 
-    # Get the (2) part from the encrypted JPEG
-    encrypted_part = process_encrypted_jpeg(encrypted_data)
-
-    # Merge (1) and (2)
-    merged_data = ref_part + encrypted_part
-
     # Prepare the output file name and save it to the Repaired folder
     os.makedirs(output_folder, exist_ok=True)
-    output_filename = os.path.join(output_folder, os.path.basename(encrypted_path).split('.')[0] + '.JPG')
-    with open(output_filename, 'wb') as output_file:
-        output_file.write(merged_data)
+    output_filename = os.path.join(output_folder, original_stem(os.path.basename(encrypted_path)) + '.JPG')
+
+    # Merge (1) and the (2) part of the encrypted JPEG, streaming (2) straight from disk
+    with open(encrypted_path, 'rb') as encrypted_file, open(output_filename, 'wb') as output_file:
+        start, end = encrypted_payload_range(os.fstat(encrypted_file.fileno()).st_size)
+        output_file.write(ref_part)
+        copy_range(encrypted_file, output_file, start, end - start)
 
     print(f"Repaired file saved as {output_filename}")
 
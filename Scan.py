@@ -0,0 +1,851 @@
+import io
+import sys
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from Segments import SOF_SEQUENTIAL, SOF_MARKERS, DHT, DRI, SegmentIndex
+
+# SOF_SEQUENTIAL lists the Huffman-coded sequential frames (baseline and extended) the scan walker understands
+EOI = b'\xFF\xD9'
+
+# Zero bytes appended past the end of a scan; decoders read zeros once the data runs out and a
+# single MCU of zeros can never reach past this many bytes
+SCAN_PADDING = 4096
+
+# Huffman lookup entries: bits 0-4 hold the bits consumed by code plus magnitude, bits 5-12 the
+# zigzag step for AC codes (128 marks end of block) or the magnitude size for DC codes, bit 13 an invalid code
+ENTRY_STEP_SHIFT = 5
+ENTRY_EOB_STEP = 128
+ENTRY_INVALID = 1 << 13
+
+# Most 16-bit windows hold several short AC codes; decoding them in one lookup roughly halves the walk
+MAX_CODES_PER_LOOKUP = 8
+
+# A bad code makes the decoder read 17 bits and then treat it as symbol 0
+INVALID_CODE_BITS = 17
+
+# Largest DC magnitude size of 8-bit samples; DC coefficients stay within +-2047 (+-32767 for 12-bit)
+MAX_DC_SIZE = 11
+
+
+# Function to list the segments up to and including the first SOS as (marker, offset, length)
+def parse_header_segments(data):
+    return SegmentIndex(data, scans=False).header_segments()
+
+
+# Function to get {symbol: (code, length)} for one DHT table, used to write codes back into a scan
+def build_huffman_codes(counts, symbols):
+    codes = {}
+    code = 0
+    index = 0
+    for length in range(1, 17):
+        for _ in range(counts[length - 1]):
+            codes[symbols[index]] = (code, length)
+            index += 1
+            code += 1
+        code <<= 1
+    return codes
+
+
+# Function to build the walker lookup tables for one DHT table, indexed by the next 16 bits of the scan
+def build_huffman_lookup(counts, symbols, is_ac):
+    lookup = np.full(1 << 16, ENTRY_INVALID | INVALID_CODE_BITS, dtype=np.int32)
+    if is_ac:
+        lookup |= ENTRY_EOB_STEP << ENTRY_STEP_SHIFT
+
+    code = 0
+    index = 0
+    for length in range(1, 17):
+        for _ in range(counts[length - 1]):
+            symbol = symbols[index]
+            index += 1
+            size = symbol & 15
+            entry = length + size
+            if not is_ac:
+                entry |= size << ENTRY_STEP_SHIFT
+            else:
+                if symbol == 0x00:
+                    step = ENTRY_EOB_STEP
+                elif symbol == 0xF0:
+                    step = 16
+                else:
+                    step = (symbol >> 4) + 1
+                entry |= step << ENTRY_STEP_SHIFT
+            first = code << (16 - length)
+            lookup[first:first + (1 << (16 - length))] = entry
+            code += 1
+        code <<= 1
+
+    return lookup.tolist()
+
+
+# Function to build the multi-code AC lookup from a single-code one: every entry covers all the codes
+# that fit whole in the 16-bit window. Its step counts one extra for a closing EOB, so a walker that
+# is at zigzag index k may only use it while k + (step & 127) <= 64, and falls back to one code otherwise
+def build_multi_lookup(single):
+    single = np.array(single, dtype=np.int32)
+    windows = np.arange(1 << 16, dtype=np.int32)
+    bits = single & 31
+    steps = single >> ENTRY_STEP_SHIFT
+    total_bits = bits.copy()
+    total_steps = steps + (steps == ENTRY_EOB_STEP)
+    active = steps < ENTRY_EOB_STEP
+
+    for _ in range(MAX_CODES_PER_LOOKUP - 1):
+        # The bits left in the window move to the top; codes are only taken when they fit whole
+        entry = single[(windows << np.minimum(total_bits, 16)) & 0xFFFF]
+        entry_bits = entry & 31
+        entry_steps = entry >> ENTRY_STEP_SHIFT
+        taken = active & (entry_bits <= 16 - total_bits) & (entry & ENTRY_INVALID == 0)
+        total_bits = np.where(taken, total_bits + entry_bits, total_bits)
+        total_steps = np.where(taken, total_steps + entry_steps + (entry_steps == ENTRY_EOB_STEP), total_steps)
+        active = taken & (entry_steps < ENTRY_EOB_STEP)
+
+    return (total_bits | total_steps << ENTRY_STEP_SHIFT).tolist()
+
+
+class EntropyScan:
+    """Baseline JPEG scan split into restart intervals, ready for MCU-level walking without pixel decoding."""
+
+    def __init__(self, data, index=None):
+        self.data = data
+        self.index = index if index is not None else SegmentIndex(data)
+        self.segments = self.index.header_segments()
+        self.restart_interval = 0
+        self.dc_tables = {}
+        self.ac_tables = {}
+        self.dc_codes = {}
+        self.ac_codes = {}
+        self.frame = None
+
+        for marker, offset, length in self.segments:
+            body = data[offset + 4:offset + 2 + length]
+            if marker in SOF_MARKERS:
+                if marker not in SOF_SEQUENTIAL:
+                    raise ValueError(f"Unsupported frame type SOF{marker - 0xC0}, only sequential Huffman scans are handled")
+                self.frame = self._parse_frame(offset, body)
+            elif marker == DHT:
+                self._parse_huffman_tables(body)
+            elif marker == DRI:
+                self.restart_interval = int.from_bytes(body[:2], 'big')
+
+        if self.frame is None:
+            raise ValueError("No SOF marker found before the scan")
+
+        marker, offset, length = self.segments[-1]
+        self.scan_start = offset + 2 + length
+        self.scan_end = self.index.scans[0]["end"]
+        self.restart_offsets = self.index.scans[0]["restarts"]
+        self._parse_scan_header(data[offset + 4:offset + 2 + length])
+        self._split_intervals()
+
+    def _parse_frame(self, offset, body):
+        components = []
+        for i in range(body[5]):
+            component_id, sampling, table = body[6 + 3 * i:9 + 3 * i]
+            components.append({"id": component_id, "h": sampling >> 4, "v": sampling & 15, "tq": table})
+        return {
+            "offset": offset,
+            "precision": body[0],
+            "height": int.from_bytes(body[1:3], 'big'),
+            "width": int.from_bytes(body[3:5], 'big'),
+            "components": components,
+        }
+
+    def _parse_huffman_tables(self, body):
+        position = 0
+        while position + 17 <= len(body):
+            table_class, table_id = body[position] >> 4, body[position] & 15
+            counts = body[position + 1:position + 17]
+            total = sum(counts)
+            symbols = body[position + 17:position + 17 + total]
+            lookup = build_huffman_lookup(counts, symbols, is_ac=bool(table_class))
+            if table_class:
+                self.ac_tables[table_id] = (lookup, build_multi_lookup(lookup))
+                self.ac_codes[table_id] = build_huffman_codes(counts, symbols)
+            else:
+                self.dc_tables[table_id] = lookup
+                self.dc_codes[table_id] = build_huffman_codes(counts, symbols)
+            position += 17 + total
+
+    def _parse_scan_header(self, body):
+        components = {c["id"]: c for c in self.frame["components"]}
+        h_max = max(c["h"] for c in self.frame["components"])
+        v_max = max(c["v"] for c in self.frame["components"])
+        width, height = self.frame["width"], self.frame["height"]
+
+        scan_components = []
+        for i in range(body[0]):
+            component_id, tables = body[1 + 2 * i:3 + 2 * i]
+            if component_id not in components:
+                raise ValueError(f"Scan references unknown component {component_id}")
+            scan_components.append((components[component_id], tables >> 4, tables & 15))
+
+        if len(scan_components) != len(self.frame["components"]):
+            raise ValueError("Non-interleaved multi-scan files are not supported")
+
+        # Tables, codes and scan component index used by each block of one MCU, in scan order
+        self.mcu_blocks = []
+        self.mcu_codes = []
+        self.mcu_components = []
+        for index, (component, dc_id, ac_id) in enumerate(scan_components):
+            if dc_id not in self.dc_tables or ac_id not in self.ac_tables:
+                raise ValueError(f"Missing Huffman table for component {component['id']}")
+            blocks = 1 if len(scan_components) == 1 else component["h"] * component["v"]
+            self.mcu_blocks.extend([(self.dc_tables[dc_id],) + self.ac_tables[ac_id]] * blocks)
+            self.mcu_codes.extend([(self.dc_codes[dc_id], self.ac_codes[ac_id])] * blocks)
+            self.mcu_components.extend([index] * blocks)
+        self.scan_components = len(scan_components)
+
+        if len(scan_components) == 1:
+            # A single-component scan codes one block per MCU over that component's own grid
+            component = scan_components[0][0]
+            self.mcu_width = 8 * h_max // component["h"]
+            self.mcu_height = 8 * v_max // component["v"]
+        else:
+            self.mcu_width = 8 * h_max
+            self.mcu_height = 8 * v_max
+        self.mcus_per_row = -(-width // self.mcu_width)
+        self.mcu_rows = -(-height // self.mcu_height)
+
+    def _split_intervals(self):
+        # The index knows where the scan ends and where its RSTn markers are, only the stuffed bytes are left to find
+        scan_end = self.scan_end - self.scan_start
+        raw = np.frombuffer(self.data, dtype=np.uint8, count=scan_end, offset=self.scan_start)
+        ff = np.flatnonzero(raw[:-1] == 0xFF)
+        stuffed = ff[raw[ff + 1] == 0x00]
+        restarts = np.array(self.restart_offsets, dtype=np.int64) - self.scan_start
+
+        # Each interval keeps its original start, its unstuffed bytes and the unstuffed index of every stuffed FF
+        self.intervals = []
+        bounds = [0] + (restarts + 2).tolist()
+        stops = restarts.tolist() + [scan_end]
+        for start, stop in zip(bounds, stops):
+            zeros = stuffed[(stuffed >= start) & (stuffed < stop)]
+            keep = np.ones(stop - start, dtype=bool)
+            keep[zeros - start + 1] = False
+            unstuffed = raw[start:stop][keep]
+            stuffed_ff = zeros - start - np.arange(zeros.size)
+            self.intervals.append((self.scan_start + start, unstuffed, stuffed_ff))
+
+    # Function to get the 32-bit big-endian window starting at every byte of an interval
+    def windows(self, interval):
+        unstuffed = self.intervals[interval][1]
+        padded = np.zeros(unstuffed.size + SCAN_PADDING, dtype=np.uint32)
+        padded[:unstuffed.size] = unstuffed
+        return memoryview(padded[:-3] << 24 | padded[1:-2] << 16 | padded[2:-1] << 8 | padded[3:])
+
+    # Function to skip count MCUs from bit position, returns the new position or None once the data runs out
+    def skip_mcus(self, windows, position, count, data_bits):
+        blocks = self.mcu_blocks
+        for _ in range(count):
+            for dc, ac, ac_multi in blocks:
+                position += dc[(windows[position >> 3] >> (16 - (position & 7))) & 0xFFFF] & 31
+                k = 1
+                while k < 64:
+                    peek = (windows[position >> 3] >> (16 - (position & 7))) & 0xFFFF
+                    entry = ac_multi[peek]
+                    if k + (entry >> 5 & 127) > 64:
+                        entry = ac[peek]
+                    position += entry & 31
+                    k += entry >> 5
+            if position > data_bits:
+                return None
+        return position
+
+    # Function to walk count MCUs of an interval checking every code, without pixel decoding. Returns
+    # (MCUs whose bits lie inside the data, bit position after them, first problem as (MCU, bit position,
+    # reason) or None). Like a decoder it reads on past a bad code, unless stop is set
+    def check_mcus(self, interval, count, stop=True):
+        windows = self.windows(interval)
+        data_bits = self.intervals[interval][1].size * 8
+        dc_limit = (1 << (self.frame["precision"] + 3)) - 1
+        max_dc_size = MAX_DC_SIZE + self.frame["precision"] - 8
+        blocks = list(zip(self.mcu_blocks, self.mcu_components))
+        predictors = [0] * self.scan_components
+        problem = None
+        position = 0
+
+        for mcu in range(count):
+            start = position
+            for (dc, ac, ac_multi), component in blocks:
+                entry = dc[(windows[position >> 3] >> (16 - (position & 7))) & 0xFFFF]
+                size = (entry >> ENTRY_STEP_SHIFT) & 15
+                position += entry & 31
+                if entry & ENTRY_INVALID or size > max_dc_size:
+                    problem = problem or (mcu, start, "invalid DC code")
+                elif size:
+                    value = (windows[(position - size) >> 3] >> (32 - ((position - size) & 7) - size)) & ((1 << size) - 1)
+                    if value < 1 << (size - 1):
+                        value -= (1 << size) - 1
+                    predictors[component] += value
+                    if not -dc_limit <= predictors[component] <= dc_limit:
+                        problem = problem or (mcu, start, "DC coefficient out of range")
+
+                k = 1
+                while k < 64:
+                    peek = (windows[position >> 3] >> (16 - (position & 7))) & 0xFFFF
+                    entry = ac_multi[peek]
+                    if k + (entry >> 5 & 127) > 64:
+                        # Only single codes can be bad; the multi-code lookup never takes one
+                        entry = ac[peek]
+                        step = entry >> ENTRY_STEP_SHIFT
+                        if entry & ENTRY_INVALID:
+                            problem = problem or (mcu, start, "invalid AC code")
+                        elif step < ENTRY_EOB_STEP and k + step > 64:
+                            problem = problem or (mcu, start, "AC run past the end of the block")
+                    position += entry & 31
+                    k += entry >> ENTRY_STEP_SHIFT
+
+            if position > data_bits:
+                return mcu, start, problem or (mcu, start, "scan data ends inside the MCU")
+            if problem and stop:
+                return mcu, start, problem
+        return count, position, problem
+
+    # Function to check the restart intervals first..last - 1, returns (MCUs walked, problem) for each,
+    # the problem being None or (MCU, file offset, reason). With stop set the list ends at the first problem.
+    # total is the MCU count of the frame, the scan's own unless the frame is cut shorter
+    def check_intervals(self, first, last, stop=True, total=None):
+        total = total or self.mcus_per_row * self.mcu_rows
+        per_interval = self.restart_interval or total
+        results = []
+        for interval in range(first, last):
+            start_mcu = interval * per_interval
+            expected = min(per_interval, total - start_mcu)
+            if expected <= 0:
+                walked, problem = 0, (0, 0, "restart marker after the last MCU")
+            else:
+                walked, position, problem = self.check_mcus(interval, expected, stop)
+                if problem is None and walked == expected and self.intervals[interval][1].size * 8 - position >= 8:
+                    # Every MCU decoded yet whole bytes are left before the next marker: the codes desynced
+                    problem = (expected - 1, position, "data left after the last MCU of the interval")
+
+            if problem is not None:
+                mcu, position, reason = problem
+                problem = (start_mcu + mcu, self.file_offset(interval, position >> 3), reason)
+            results.append((walked, problem))
+            if problem is not None and stop:
+                break
+        return results
+
+    # Function to walk the whole scan without pixel decoding, returns a report with the MCU count of the
+    # frame ("mcus"), the MCUs the data holds ("decoded"), those missing at the end ("missing"), the first
+    # MCU that fails to decode or desyncs with its file offset and the reason ("mcu", "offset", "reason"),
+    # and the restart intervals holding a problem ("damaged"). With stop set the walk ends at the first
+    # problem and "decoded" only counts the MCUs before it. Restart intervals decode independently, so
+    # with jobs > 1 they are split between that many processes
+    def validate(self, stop=True, jobs=1):
+        results = self.check_split(len(self.intervals), stop, jobs)
+        return self.report(results, self.mcus_per_row * self.mcu_rows, self.scan_end, stop)
+
+    # Function to check the first count restart intervals, split between jobs processes when above 1
+    def check_split(self, count, stop=True, jobs=1, total=None):
+        if jobs > 1 and count > 1:
+            jobs = min(jobs, count)
+            bounds = [count * job // jobs for job in range(jobs + 1)]
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                parts = executor.map(_check_intervals, itertools.repeat(self.data), bounds[:-1], bounds[1:],
+                                     itertools.repeat(stop), itertools.repeat(total))
+                return list(itertools.chain.from_iterable(parts))
+        return self.check_intervals(0, count, stop, total)
+
+    # Function to sum the (MCUs walked, problem) of each interval up into the report of validate, for a
+    # frame of total MCUs whose scan data ends at file offset scan_end
+    def report(self, results, total, scan_end, stop=True):
+        report = {"mcus": total, "decoded": 0, "missing": 0, "mcu": None, "offset": None, "reason": None,
+                  "damaged": []}
+        for interval, (walked, problem) in enumerate(results):
+            report["decoded"] += walked
+            if problem is not None:
+                report["damaged"].append(interval)
+                if report["mcu"] is None:
+                    report.update(mcu=problem[0], offset=problem[1], reason=problem[2])
+                if stop:
+                    break
+
+        report["missing"] = total - report["decoded"]
+        if report["missing"] and report["mcu"] is None:
+            report.update(mcu=report["decoded"], offset=scan_end, reason="scan data ends before the last MCU")
+        return report
+
+    # Function to read one MCU from bit position, returns [(dc_end, dc_value, block_end)] per block
+    def read_mcu(self, windows, position):
+        blocks = []
+        for dc, ac, _ in self.mcu_blocks:
+            entry = dc[(windows[position >> 3] >> (16 - (position & 7))) & 0xFFFF]
+            total, size = entry & 31, (entry >> ENTRY_STEP_SHIFT) & 15
+            position += total
+            value = 0
+            if size and not entry & ENTRY_INVALID:
+                value = (windows[(position - size) >> 3] >> (32 - ((position - size) & 7) - size)) & ((1 << size) - 1)
+                if value < 1 << (size - 1):
+                    value -= (1 << size) - 1
+            dc_end = position
+
+            k = 1
+            while k < 64:
+                entry = ac[(windows[position >> 3] >> (16 - (position & 7))) & 0xFFFF]
+                position += entry & 31
+                k += entry >> ENTRY_STEP_SHIFT
+            blocks.append((dc_end, value, position))
+        return blocks
+
+    # Function to read count bits of an interval from bit position as an int
+    def read_bits(self, interval, position, count):
+        unstuffed = self.intervals[interval][1]
+        first, last = position >> 3, (position + count + 7) >> 3
+        value = int.from_bytes(unstuffed[first:last].tobytes().ljust(last - first, b'\x00'), 'big')
+        return (value >> (8 * (last - first) - (position & 7) - count)) & ((1 << count) - 1)
+
+    # Function to build scan bytes from bits [0, start) of interval 0, the middle bits and bits [end, ...)
+    def splice(self, start, middle, middle_bits, end):
+        unstuffed = self.intervals[0][1]
+
+        # Whole bytes before start are copied as they are in the file, still stuffed
+        head_bytes, head_bits = divmod(start, 8)
+        head = self.data[self.scan_start:self.file_offset(0, head_bytes)]
+        if head_bits:
+            middle |= (int(unstuffed[head_bytes]) >> (8 - head_bits)) << middle_bits
+            middle_bits += head_bits
+
+        # Finish the byte end falls in so the tail starts on a byte boundary
+        tail_bytes, tail_bits = divmod(end, 8)
+        if tail_bits:
+            keep = 8 - tail_bits
+            middle = (middle << keep) | (int(unstuffed[tail_bytes]) & ((1 << keep) - 1))
+            middle_bits += keep
+            tail_bytes += 1
+        tail = unstuffed[tail_bytes:]
+
+        # Shift the tail right by the bits left over from the middle, padding the end with 1 bits
+        full, shift = divmod(middle_bits, 8)
+        leftover = middle & ((1 << shift) - 1)
+        previous = np.concatenate(([leftover], tail)).astype(np.uint16)
+        current = np.concatenate((tail, [0xFF])).astype(np.uint16)
+        shifted = ((previous << 8 | current) >> shift & 0xFF).astype(np.uint8)
+        if not shift:
+            shifted = shifted[:-1]
+
+        body = np.concatenate((np.frombuffer((middle >> shift).to_bytes(full, 'big'), dtype=np.uint8), shifted))
+        return head + np.insert(body, np.flatnonzero(body == 0xFF) + 1, 0).tobytes()
+
+    # Function to map an unstuffed byte index of an interval back to its offset in the file
+    def file_offset(self, interval, index):
+        start, _, stuffed_ff = self.intervals[interval]
+        return start + index + int(np.searchsorted(stuffed_ff, index, side='left'))
+
+    # Function to get the scan bytes holding the first mcu_count MCUs, padded with 1 bits to a byte boundary
+    def scan_prefix(self, mcu_count):
+        interval, within = self.cut_point(mcu_count)
+        if interval >= len(self.intervals):
+            return self.data[self.scan_start:self.scan_end]
+        if within == 0:
+            # Cut right before the RSTn that opens this interval
+            return self.data[self.scan_start:self.intervals[interval][0] - 2]
+
+        unstuffed = self.intervals[interval][1]
+        return self.cut_interval(interval, self.skip_mcus(self.windows(interval), 0, within, unstuffed.size * 8))
+
+    # Function to get scan_prefix(mcu_count) together with the validate(stop=False) report of a frame cut to
+    # mcu_count MCUs. The MCUs are checked on the walk that finds the cut, so the cut file is never walked again
+    def check_prefix(self, mcu_count, jobs=1):
+        interval, within = self.cut_point(mcu_count)
+        if interval >= len(self.intervals) or within == 0:
+            prefix = self.scan_prefix(mcu_count)
+            results = self.check_split(min(interval, len(self.intervals)), False, jobs, mcu_count)
+            return prefix, self.report(results, mcu_count, self.scan_start + len(prefix), stop=False)
+
+        # The intervals before the cut are checked whole, the cut one up to the cut; no bits are left after it
+        results = self.check_split(interval, False, jobs, mcu_count)
+        walked, position, problem = self.check_mcus(interval, within, stop=False)
+        prefix = self.cut_interval(interval, position if walked == within else None)
+        if problem is not None:
+            mcu, offset, reason = problem
+            problem = (interval * self.restart_interval + mcu, self.file_offset(interval, offset >> 3), reason)
+        results.append((walked, problem))
+        return prefix, self.report(results, mcu_count, self.scan_start + len(prefix), stop=False)
+
+    # Function to get the restart interval the cut after mcu_count MCUs falls in and the MCUs kept of it
+    def cut_point(self, mcu_count):
+        if mcu_count >= self.mcus_per_row * self.mcu_rows:
+            return len(self.intervals), 0
+        if self.restart_interval:
+            return divmod(mcu_count, self.restart_interval)
+        return 0, mcu_count
+
+    # Function to get the scan bytes up to bit position of an interval, the whole interval when position is None
+    def cut_interval(self, interval, position):
+        if position is None:
+            stop = self.restart_offsets[interval] if interval < len(self.restart_offsets) else self.scan_end
+            return self.data[self.scan_start:stop]
+
+        # Keep the whole bytes, then the partial byte with its unused low bits set to 1
+        unstuffed = self.intervals[interval][1]
+        whole, bits = divmod(position, 8)
+        prefix = self.data[self.scan_start:self.file_offset(interval, whole)]
+        if bits:
+            last = int(unstuffed[whole]) | ((1 << (8 - bits)) - 1)
+            prefix += bytes([last]) + (b'\x00' if last == 0xFF else b'')
+        return prefix
+
+
+# Function to crop a baseline JPEG to its top rows without decoding pixels, returns the new file bytes;
+# index is the SegmentIndex of data when the caller already has one
+def crop_rows(data, height, index=None):
+    scan = EntropyScan(data, index)
+    mcu_rows = _crop_mcu_rows(scan, height)
+    if mcu_rows >= scan.mcu_rows:
+        prefix = data[scan.scan_start:scan.scan_end]
+    else:
+        prefix = scan.scan_prefix(mcu_rows * scan.mcus_per_row)
+    return _cropped_file(data, scan, height, prefix)
+
+
+# Function to crop like crop_rows and check the kept MCUs on the same walk, returns the new file bytes and
+# the report locate_corruption(stop=False) gives for them
+def check_crop(data, height, index=None, jobs=1):
+    scan = EntropyScan(data, index)
+    mcu_rows = _crop_mcu_rows(scan, height)
+    prefix, report = scan.check_prefix(mcu_rows * scan.mcus_per_row, jobs)
+    return _cropped_file(data, scan, height, prefix), report
+
+
+# Function to get the MCU rows a crop to height keeps: up to the one holding the last kept pixel row
+def _crop_mcu_rows(scan, height):
+    if not 0 < height <= scan.frame["height"]:
+        raise ValueError(f"Crop height {height} is outside the image height {scan.frame['height']}")
+    return -(-height // scan.mcu_height)
+
+
+# Function to patch the frame height of data to height and close the cut scan data prefix with EOI
+def _cropped_file(data, scan, height, prefix):
+    header = bytearray(data[:scan.scan_start])
+    height_offset = scan.frame["offset"] + 5
+    header[height_offset:height_offset + 2] = height.to_bytes(2, 'big')
+    return bytes(header) + prefix + EOI
+
+
+# Function to find the first MCU of a baseline JPEG that fails to decode or desyncs, walking the Huffman
+# codes without IDCT or color conversion; returns the report of EntropyScan.validate
+def locate_corruption(data, stop=True, index=None, jobs=1):
+    return EntropyScan(data, index).validate(stop, jobs)
+
+
+# Function to check a range of restart intervals in a worker process
+def _check_intervals(data, first, last, stop, total=None):
+    return EntropyScan(data).check_intervals(first, last, stop, total)
+
+
+# Function to get (MCU rows, MCU height, MCUs per row) of a single interleaved sequential scan with restart
+# markers, or None when the scan cannot be cut into bands of rows
+def restart_geometry(index):
+    frame = index.frame
+    if frame is None or frame["marker"] not in SOF_SEQUENTIAL or len(index.scans) != 1 or not index.restart_interval:
+        return None
+    if len(index.scans[0]["components"]) != len(frame["components"]) or not frame["components"]:
+        return None
+
+    h_max = max(c["h"] for c in frame["components"])
+    v_max = max(c["v"] for c in frame["components"])
+    if len(frame["components"]) == 1:
+        component = frame["components"][0]
+        mcu_width, mcu_height = 8 * h_max // component["h"], 8 * v_max // component["v"]
+    else:
+        mcu_width, mcu_height = 8 * h_max, 8 * v_max
+    mcus_per_row = -(-frame["width"] // mcu_width)
+    mcu_rows = -(-frame["height"] // mcu_height)
+
+    # A missing or extra RSTn would put every later band in the wrong place
+    intervals = -(-mcus_per_row * mcu_rows // index.restart_interval)
+    if len(index.scans[0]["restarts"]) != intervals - 1:
+        return None
+    return mcu_rows, mcu_height, mcus_per_row
+
+
+# Function to build a JPEG holding only the MCU rows first..last - 1 of a scan with restart markers; both
+# must start a restart interval. The RSTn markers are numbered again from RST0, as decoders expect
+def band_jpeg(data, index, first, last):
+    mcu_rows, mcu_height, mcus_per_row = restart_geometry(index)
+    scan = index.scans[0]
+    restarts = scan["restarts"]
+    first_interval = first * mcus_per_row // index.restart_interval
+    last_interval = -(-min(last, mcu_rows) * mcus_per_row // index.restart_interval)
+
+    start = restarts[first_interval - 1] + 2 if first_interval else scan["start"]
+    end = restarts[last_interval - 1] if last_interval - 1 < len(restarts) else scan["end"]
+    body = bytearray(data[start:end])
+    for number, offset in enumerate(restarts[first_interval:last_interval - 1]):
+        body[offset - start + 1] = 0xD0 + number % 8
+
+    height = min(last * mcu_height, index.frame["height"]) - first * mcu_height
+    header = bytearray(data[:scan["start"]])
+    height_offset = index.frame["offset"] + 5
+    header[height_offset:height_offset + 2] = height.to_bytes(2, 'big')
+    return bytes(header) + bytes(body) + EOI
+
+
+# Function to decode JPEG bytes into a loaded PIL image. When restart intervals start on MCU rows the scan
+# is cut into jobs bands of rows, decoded as separate JPEGs in threads (Pillow lets go of the GIL while it
+# decodes) and pasted together; anything else is decoded in one piece
+def decode_jpeg(data, jobs=1, index=None):
+    geometry = None
+    if jobs > 1:
+        try:
+            index = index if index is not None else SegmentIndex(data)
+            geometry = restart_geometry(index)
+        except ValueError:
+            geometry = None
+    if geometry is None:
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        return img
+
+    mcu_rows, mcu_height, mcus_per_row = geometry
+    aligned = [row for row in range(mcu_rows) if row * mcus_per_row % index.restart_interval == 0] + [mcu_rows]
+    cuts = sorted({aligned[len(aligned) * job // jobs] for job in range(jobs)} | {mcu_rows})
+    if len(cuts) < 3:
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        return img
+
+    # Each band is decoded with the aligned rows next to it, so chroma upsampling sees the same neighbours
+    # as in a whole-image decode, and those rows are dropped again
+    def decode_band(band):
+        top, bottom = cuts[band], cuts[band + 1]
+        first = aligned[aligned.index(top) - 1] if top else 0
+        last = aligned[aligned.index(bottom) + 1] if bottom < mcu_rows else mcu_rows
+        with Image.open(io.BytesIO(band_jpeg(data, index, first, last))) as img:
+            img.load()
+            offset = (top - first) * mcu_height
+            height = min(bottom * mcu_height, index.frame["height"]) - top * mcu_height
+            return img.crop((0, offset, img.width, offset + height))
+
+    with ThreadPoolExecutor(max_workers=min(jobs, len(cuts) - 1)) as executor:
+        bands = list(executor.map(decode_band, range(len(cuts) - 1)))
+
+    img = Image.new(bands[0].mode, (index.frame["width"], index.frame["height"]))
+    for top, band in zip(cuts, bands):
+        img.paste(band, (0, top * mcu_height))
+    return img
+
+
+# Function to encode a DC difference with the given code map, returns (bits, length)
+def encode_dc(codes, value):
+    size = abs(value).bit_length()
+    if size not in codes:
+        raise ValueError(f"DC table has no code for magnitude size {size}")
+    code, length = codes[size]
+    magnitude = value if value >= 0 else value + (1 << size) - 1
+    return (code << size) | magnitude, length + size
+
+
+class ScanWriter:
+    """Entropy-coded bits written one piece at a time, with runs copied from the same scan interval merged."""
+
+    def __init__(self, scan):
+        self.scan = scan
+        self.data = bytearray()
+        self.value = 0
+        self.bits = 0
+        self.pending = None  # [interval, start, end] of the bits to copy next
+
+    # Function to append the length low bits of value
+    def write(self, value, length):
+        if self.pending is not None:
+            interval, start, end = self.pending
+            self.pending = None
+            self.write(self.scan.read_bits(interval, start, end - start), end - start)
+        self.value = (self.value << length) | value
+        self.bits += length
+        whole, self.bits = divmod(self.bits, 8)
+        if whole:
+            self.data += (self.value >> self.bits).to_bytes(whole, 'big')
+            self.value &= (1 << self.bits) - 1
+
+    # Function to append the bits [start, end) of an interval of the scan
+    def copy(self, interval, start, end):
+        if self.pending is not None and self.pending[0] == interval and self.pending[2] == start:
+            self.pending[2] = end
+        else:
+            self.write(0, 0)
+            self.pending = [interval, start, end]
+
+    # Function to get the bytes written, padded with 1 bits to a byte boundary and with every FF stuffed
+    def stuffed(self):
+        self.write(0, 0)
+        if self.bits:
+            self.write((1 << (8 - self.bits)) - 1, 8 - self.bits)
+        return bytes(self.data).replace(b'\xFF', b'\xFF\x00')
+
+
+# Function to insert (count > 0) or delete (count < 0) MCUs at an MCU position of a baseline scan,
+# returns the new file bytes. Inserted MCUs carry no DC change or AC data, so they repeat the running
+# DC value (mid grey at position 0); deleting fixes the next MCU's DC so the rest decodes unchanged.
+# A scan with restart markers is written again with an RSTn every restart interval MCUs
+def shift_mcus(data, count, position=0, index=None):
+    scan = EntropyScan(data, index)
+    if position < 0 or count < -scan.mcus_per_row * scan.mcu_rows:
+        raise ValueError(f"Cannot shift {count} MCUs at position {position}")
+    if count == 0:
+        return data
+    if scan.restart_interval:
+        return _shift_restart_mcus(data, scan, count, position)
+
+    windows = scan.windows(0)
+    data_bits = scan.intervals[0][1].size * 8
+    start = scan.skip_mcus(windows, 0, position, data_bits)
+    if start is None:
+        raise ValueError(f"Scan data ends before MCU {position}")
+
+    if count > 0:
+        # An empty block is the DC code for size 0 followed by EOB
+        blank, blank_bits = 0, 0
+        for dc_codes, ac_codes in scan.mcu_codes:
+            if 0 not in dc_codes or 0 not in ac_codes:
+                raise ValueError("Huffman tables have no code for an empty block")
+            for code, length in (dc_codes[0], ac_codes[0]):
+                blank = (blank << length) | code
+                blank_bits += length
+        middle = int(bin(blank)[2:].zfill(blank_bits) * count, 2)
+        new_scan = scan.splice(start, middle, blank_bits * count, start)
+    else:
+        # Sum the DC differences of the deleted MCUs for each component
+        dc_offsets = [0] * scan.scan_components
+        end = start
+        for _ in range(-count):
+            blocks = scan.read_mcu(windows, end)
+            for component, (_, value, _) in zip(scan.mcu_components, blocks):
+                dc_offsets[component] += value
+            end = blocks[-1][2]
+            if end > data_bits:
+                raise ValueError("Scan data ends inside the MCUs to delete")
+
+        # Rewrite the first DC difference of each component in the next MCU onto the earlier predictor
+        middle, middle_bits = 0, 0
+        next_end = end
+        if end < data_bits:
+            seen = set()
+            block_start = end
+            for component, (dc_codes, _), (dc_end, value, block_end) in zip(
+                    scan.mcu_components, scan.mcu_codes, scan.read_mcu(windows, end)):
+                if component not in seen:
+                    seen.add(component)
+                    bits, length = encode_dc(dc_codes, value + dc_offsets[component])
+                else:
+                    length = dc_end - block_start
+                    bits = scan.read_bits(0, block_start, length)
+                ac_length = block_end - dc_end
+                middle = (middle << (length + ac_length)) | (bits << ac_length) | scan.read_bits(0, dc_end, ac_length)
+                middle_bits += length + ac_length
+                block_start = block_end
+            next_end = block_start
+        new_scan = scan.splice(start, middle, middle_bits, min(next_end, data_bits))
+
+    trailer = data[scan.scan_end:] or EOI
+    return data[:scan.scan_start] + new_scan + trailer
+
+
+# Function to shift MCUs like shift_mcus in a scan with restart markers. Every MCU moves to another place in
+# its interval, so the whole scan is written again: the MCU bits are copied and only the first DC difference
+# of each component is coded again where the predictor it follows changed, at the old and new interval starts
+def _shift_restart_mcus(data, scan, count, position):
+    for dc_codes, ac_codes in scan.mcu_codes:
+        if 0 not in dc_codes or 0 not in ac_codes:
+            raise ValueError("Huffman tables have no code for an empty block")
+    source = _read_restart_mcus(scan)
+
+    # The MCUs in their new order, the inserted ones empty with the running DC value at position
+    def shifted():
+        mcu = None
+        for _ in range(position):
+            mcu = next(source, None)
+            if mcu is None:
+                raise ValueError(f"Scan data ends before MCU {position}")
+            yield mcu
+        if count > 0:
+            running = [0] * scan.scan_components
+            for component, dc in zip(scan.mcu_components, mcu[3] if mcu else []):
+                running[component] = dc
+            dcs = [running[component] for component in scan.mcu_components]
+            yield from itertools.repeat((None, None, None, dcs), count)
+        elif any(next(source, None) is None for _ in range(-count)):
+            raise ValueError("Scan data ends inside the MCUs to delete")
+        yield from source
+
+    intervals = []
+    writer = ScanWriter(scan)
+    predictors = [0] * scan.scan_components
+    for number, (interval, block_start, blocks, dcs) in enumerate(
+            itertools.islice(shifted(), scan.mcus_per_row * scan.mcu_rows)):
+        if number and number % scan.restart_interval == 0:
+            intervals.append(writer.stuffed())
+            writer = ScanWriter(scan)
+            predictors = [0] * scan.scan_components
+
+        for block, component, (dc_codes, ac_codes), dc in zip(
+                range(len(dcs)), scan.mcu_components, scan.mcu_codes, dcs):
+            if blocks is None:
+                # An empty block: its DC and the end of block code
+                writer.write(*encode_dc(dc_codes, dc - predictors[component]))
+                writer.write(*ac_codes[0])
+            else:
+                dc_end, value, block_end = blocks[block]
+                if dc - predictors[component] == value:
+                    writer.copy(interval, block_start, block_end)
+                else:
+                    writer.write(*encode_dc(dc_codes, dc - predictors[component]))
+                    writer.copy(interval, dc_end, block_end)
+                block_start = block_end
+            predictors[component] = dc
+    intervals.append(writer.stuffed())
+
+    new_scan = b''.join(body + (bytes((0xFF, 0xD0 + number % 8)) if number < len(intervals) - 1 else b'')
+                        for number, body in enumerate(intervals))
+    trailer = data[scan.scan_end:] or EOI
+    return data[:scan.scan_start] + new_scan + trailer
+
+
+# Function to walk every MCU of a scan with restart markers, yielding (interval, start bit, read_mcu blocks,
+# DC value of each block) until the frame is full. The MCUs an interval's data runs out before come as
+# empty ones, (None, None, None, DC values), as a decoder fills them, and the next interval goes on as usual
+def _read_restart_mcus(scan):
+    total = scan.mcus_per_row * scan.mcu_rows
+    for interval in range(len(scan.intervals)):
+        windows = scan.windows(interval)
+        data_bits = scan.intervals[interval][1].size * 8
+        predictors = [0] * scan.scan_components
+        position = 0
+        for _ in range(min(scan.restart_interval, total - interval * scan.restart_interval)):
+            blocks = scan.read_mcu(windows, position) if position < data_bits else None
+            if blocks is None or blocks[-1][2] > data_bits:
+                yield None, None, None, [predictors[component] for component in scan.mcu_components]
+                position = data_bits
+                continue
+            dcs = []
+            for component, (_, value, _) in zip(scan.mcu_components, blocks):
+                predictors[component] += value
+                dcs.append(predictors[component])
+            yield interval, position, blocks, dcs
+            position = blocks[-1][2]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: Scan.py JPEG_FILE...")
+        sys.exit(1)
+
+    for path in sys.argv[1:]:
+        with open(path, 'rb') as file:
+            data = file.read()
+        try:
+            report = locate_corruption(data, stop=False)
+        except (ValueError, IndexError) as e:
+            print(f"{path}: cannot walk the scan: {e}")
+            continue
+        if report["mcu"] is None:
+            print(f"{path}: all {report['mcus']} MCUs decode")
+        else:
+            print(f"{path}: first bad MCU {report['mcu']} at byte {report['offset']} ({report['reason']}), "
+                  f"{report['decoded']} of {report['mcus']} MCUs in the data, {report['missing']} missing")
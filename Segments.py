@@ -0,0 +1,142 @@
+import numpy as np
+
+SOI = 0xD8
+EOI_MARKER = 0xD9
+SOS = 0xDA
+DHT = 0xC4
+DQT = 0xDB
+DRI = 0xDD
+SOF_SEQUENTIAL = (0xC0, 0xC1)
+SOF_MARKERS = tuple(range(0xC0, 0xC4)) + tuple(range(0xC5, 0xC8)) + tuple(range(0xC9, 0xCC)) + tuple(range(0xCD, 0xD0))
+RST_MARKERS = tuple(range(0xD0, 0xD8))
+
+# Markers that carry a length field and may appear between scans; anything else there is damage
+SEGMENT_MARKERS = frozenset(SOF_MARKERS) | {DHT, 0xCC, DQT, 0xDC, DRI, 0xDE, 0xDF, SOS, 0xFE} | set(range(0xE0, 0xF0))
+
+
+# Index of the markers of a JPEG file: every segment, the frame and scan parameters and the RSTn positions.
+# The header is walked segment by segment; each scan is jumped over with one vectorized search for the
+# next marker, so no byte search is repeated and a header-only index costs a few microseconds.
+class SegmentIndex:
+    def __init__(self, data, scans=True):
+        self.size = len(data)
+        self.segments = []  # (marker, offset, length) of every segment, length counting itself but not the marker
+        self.frame = None  # {"marker", "offset", "precision", "height", "width", "components": [{"id", "h", "v", "tq"}]}
+        self.scans = []  # {"offset", "length", "components": [(id, dc, ac)], "ss", "se", "ah", "al", "start", "end", "restarts"}
+        self.restart_interval = 0
+        self.eoi = None  # Offset of the EOI marker, None when the file ends without one
+        self.damage = None  # Offset of the first byte that is neither a marker nor scan data, None when there is none
+        self._markers = None
+        self._restarts = None
+
+        if bytes(data[:2]) != b'\xFF\xD8':
+            raise ValueError("Not a JPEG file: missing SOI marker")
+        self._walk(data, scans)
+
+    def _walk(self, data, scans):
+        offset = 2
+        while offset + 2 <= self.size:
+            if data[offset] != 0xFF:
+                self.damage = offset
+                return
+            marker = data[offset + 1]
+            if marker == 0xFF:
+                offset += 1  # Fill byte before a marker
+                continue
+            if marker == EOI_MARKER:
+                self.eoi = offset
+                return
+            if marker not in SEGMENT_MARKERS or offset + 4 > self.size:
+                self.damage = offset
+                return
+
+            marker = int(marker)
+            length = (int(data[offset + 2]) << 8) | int(data[offset + 3])
+            self.segments.append((marker, offset, length))
+            if marker in SOF_MARKERS and self.frame is None:
+                body = bytes(data[offset + 4:offset + 2 + length])
+                if len(body) >= 6:
+                    self.frame = self._parse_frame(marker, offset, body)
+            elif marker == DRI:
+                body = bytes(data[offset + 4:offset + 2 + length])
+                if len(body) >= 2:
+                    self.restart_interval = (body[0] << 8) | body[1]
+            elif marker == SOS:
+                scan = self._parse_scan_header(offset, length, bytes(data[offset + 4:offset + 2 + length]))
+                self.scans.append(scan)
+                if not scans:
+                    return
+                scan["end"], scan["restarts"] = self._scan_extent(data, scan["start"])
+                offset = scan["end"]
+                continue
+            offset += 2 + length
+
+        if offset < self.size:
+            self.damage = offset
+
+    def _parse_frame(self, marker, offset, body):
+        components = []
+        for i in range(body[5]):
+            if 9 + 3 * i > len(body):
+                break
+            component_id, sampling, table = body[6 + 3 * i:9 + 3 * i]
+            components.append({"id": component_id, "h": sampling >> 4, "v": sampling & 15, "tq": table})
+        return {
+            "marker": marker,
+            "offset": offset,
+            "precision": body[0],
+            "height": (body[1] << 8) | body[2],
+            "width": (body[3] << 8) | body[4],
+            "components": components,
+        }
+
+    def _parse_scan_header(self, offset, length, body):
+        count = body[0] if body else 0
+        components = [(body[1 + 2 * i], body[2 + 2 * i] >> 4, body[2 + 2 * i] & 15)
+                      for i in range(count) if 3 + 2 * i <= len(body)]
+        # Spectral selection and successive approximation, defaulting to a full sequential scan when cut short
+        tail = list(body[1 + 2 * count:4 + 2 * count])
+        ss, se, approximation = tail + [0, 63, 0][len(tail):]
+        return {"offset": offset, "length": length, "components": components, "ss": ss, "se": se,
+                "ah": approximation >> 4, "al": approximation & 15, "start": offset + 2 + length,
+                "end": None, "restarts": []}
+
+    # Function to get where the entropy-coded data starting at start ends, and the RSTn offsets inside it
+    def _scan_extent(self, data, start):
+        if self._markers is None:
+            # One pass over everything after the first scan header finds the markers of every scan
+            raw = data if isinstance(data, np.ndarray) else np.frombuffer(data, dtype=np.uint8)
+            ff = np.flatnonzero(raw[start:-1] == 0xFF) + start
+            following = raw[ff + 1]
+            is_rst = (following >= 0xD0) & (following <= 0xD7)
+            self._markers = ff[(following != 0x00) & ~is_rst]
+            self._restarts = ff[is_rst]
+
+        position = int(np.searchsorted(self._markers, start))
+        end = int(self._markers[position]) if position < len(self._markers) else self.size
+        restarts = self._restarts[np.searchsorted(self._restarts, start):np.searchsorted(self._restarts, end)]
+        return end, restarts.tolist()
+
+    # Function to get the segments up to and including the first SOS
+    def header_segments(self):
+        if not self.scans:
+            raise ValueError("No SOS marker found")
+        first_sos = self.scans[0]["offset"]
+        return [segment for segment in self.segments if segment[1] <= first_sos]
+
+    # Function to get the segments of one kind, e.g. every DQT
+    def find(self, marker):
+        return [segment for segment in self.segments if segment[0] == marker]
+
+
+# Function to get where the repair cuts a reference header: FF DA plus the segment length, as the
+# tool has always cut at FF DA + 12. For a 3-component scan that leaves out the last two bytes of the
+# segment (Se and Ah/Al), which the encrypted file's own bytes supply. None when there is no parsable SOS
+def header_end(data):
+    try:
+        index = SegmentIndex(data, scans=False)
+    except ValueError:
+        return None
+    if not index.scans:
+        return None
+    return index.scans[0]["offset"] + index.scans[0]["length"]
@@ -1,7 +1,9 @@
+import io
 import os
-import numpy as np
 from PIL import Image
 import subprocess
+from Blocks import gray_tail_height, count_gray_blocks, detect_gray_tail
+from Scan import check_crop, shift_mcus
 
 def shift_mcu(jpg_file):
     if not os.path.isfile(jpg_file) or not jpg_file.lower().endswith(".jpg"):
@@ -10,89 +12,94 @@ def shift_mcu(jpg_file):
 
     try:
         img = Image.open(jpg_file)
-        data = np.array(img, dtype=np.uint8)
+        img.load()
     except Exception as e:
         print(f"Error opening image {jpg_file}: {str(e)}")
         return
 
-    # Crop the height to remove bottom non-MCU corrupted blocks
-    height_cropped = crop_non_mcu_blocks(data)
-
-    # Re-calculate the data shape after cropping
-    data_cropped = data[:height_cropped, :, :]
-
-    # Detect the number of good MCU blocks after cropping
-    num_good_mcu = auto_detect_shift(data_cropped)
+    # Crop the height to remove bottom non-MCU corrupted blocks and detect the number of good MCU
+    # blocks after cropping, converting only the bottom rows of the image to arrays
+    height_cropped, num_good_mcu = detect_gray_tail(img)
     if num_good_mcu == 0:
         print(f"No MCU shift needed for {jpg_file}.")
         return
 
-    # Calculate the adjusted MCU value for jpegrepair
-    insert_value = max(num_good_mcu - 22, 0)  # Ensure the value does not go below 0
-    print(f"Detected MCU value for {jpg_file}: {num_good_mcu}, using adjusted value: {insert_value}")
-
     # Create the Repaired folder in the same directory as the JPEG file
     repaired_folder = os.path.join(os.path.dirname(jpg_file), "Repaired")
     os.makedirs(repaired_folder, exist_ok=True)  # Create the Repaired folder if it does not exist
 
     # Save the cropped image to the Repaired folder with the same name
     cropped_image_path = os.path.join(repaired_folder, os.path.basename(jpg_file))
-    output_img = Image.fromarray(data_cropped)
-    output_img.save(cropped_image_path, "JPEG")
+    cropped_data, report = crop_jpeg(img, jpg_file, height_cropped, cropped_image_path)
     print(f"Cropped image saved to: {cropped_image_path}")
 
-    # Call jpegrepair.exe with the detected adjusted insert value
+    if report is not None:
+        # The lossless crop keeps every MCU the scan holds, so exactly the missing ones are inserted
+        insert_value = report["missing"]
+        print(f"Scan of {jpg_file} holds {report['decoded']} of {report['mcus']} MCUs, inserting {insert_value}")
+    else:
+        # Calculate the adjusted MCU value for jpegrepair
+        insert_value = max(num_good_mcu - 22, 0)  # Ensure the value does not go below 0
+        print(f"Detected MCU value for {jpg_file}: {num_good_mcu}, using adjusted value: {insert_value}")
+
+    # Insert the detected adjusted number of MCUs in memory, jpegrepair.exe only covers what the engine cannot
     output_repaired_path = os.path.join(repaired_folder, os.path.basename(jpg_file))
-    command = f"jpegrepair.exe \"{cropped_image_path}\" \"{output_repaired_path}\" insert {insert_value}"
+    try:
+        repaired_data = shift_mcus(cropped_data, insert_value)
+    except (ValueError, IndexError) as e:
+        print(f"In-process MCU insert not possible for {cropped_image_path}: {str(e)}")
+        if not run_jpegrepair(cropped_image_path, output_repaired_path, insert_value):
+            print(f"MCU shift failed for {jpg_file}, {output_repaired_path} is only cropped")
+            return
+    else:
+        with open(output_repaired_path, 'wb') as output_file:
+            output_file.write(repaired_data)
+
+    print(f"Processed image saved to: {output_repaired_path}")
+
+# Function to run jpegrepair.exe, returns True when it succeeded and left its output
+def run_jpegrepair(input_path, output_path, insert_value):
+    # Call jpegrepair.exe with the detected adjusted insert value
+    command = f"jpegrepair.exe \"{input_path}\" \"{output_path}\" insert {insert_value}"
     print(f"Running command: {command}")
 
     # Run the command
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    try:
+        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    except Exception as e:
+        print(f"An error occurred while running jpegrepair: {str(e)}")
+        return False
 
     # Print the output and errors, if any
     print(result.stdout)
     if result.stderr:
         print("Error:", result.stderr)
+    return result.returncode == 0 and os.path.isfile(output_path)
 
-    print(f"Processed image saved to: {output_repaired_path}")
+# Function to crop a JPEG file to its top rows, on the compressed stream when the scan allows it,
+# writes the result to output_path and returns its bytes and the check_crop report of the kept MCUs,
+# None when it was re-encoded and so holds every MCU of its frame
+def crop_jpeg(img, jpg_file, height, output_path):
+    try:
+        with open(jpg_file, 'rb') as file:
+            cropped_data, report = check_crop(file.read(), height)
+    except (ValueError, IndexError):
+        # Progressive and other scans the walker does not handle are cropped by re-encoding
+        buffer = io.BytesIO()
+        img.crop((0, 0, img.width, height)).save(buffer, "JPEG")
+        cropped_data, report = buffer.getvalue(), None
+
+    with open(output_path, 'wb') as output_file:
+        output_file.write(cropped_data)
+    return cropped_data, report
 
 def crop_non_mcu_blocks(data):
-    block_size = 8
-    height, width, _ = data.shape
-
     # Start from the bottom and crop any non-MCU blocks
-    while height >= block_size:
-        if not np.array_equal(data[height - block_size:height, :, :], np.ones((block_size, width, 3), dtype=np.uint8) * 128):
-            break
-        height -= block_size
-
-    return height
+    return gray_tail_height(data)
 
 def auto_detect_shift(data):
-    block_size = 8
-    height, width, _ = data.shape
-
-    # Analyze the last scanline (last block row)
-    last_scanline_start = height - block_size
-    if last_scanline_start < 0:
-        return 0  # Not enough data to process
-
-    last_scanline = data[last_scanline_start:height, :, :]
-
-    num_mcus = 0
-    for j in range(0, width, block_size):
-        if j + block_size <= width:  # Ensure we don't go out of bounds
-            mcu = last_scanline[:, j:j + block_size, :]
-            gray_mcu = np.ones((block_size, block_size, 3), dtype=np.uint8) * 128
-
-            diff = np.abs(mcu.astype(int) - gray_mcu.astype(int))
-            avg_diff = np.mean(diff)
-
-            # Adjust threshold to allow for some variability in the image
-            if avg_diff < 20:  # Increased threshold to 20 for potential slight color variations
-                num_mcus += 1
-
-    return num_mcus
+    # Count the grey blocks in the last scanline (last block row)
+    return count_gray_blocks(data)
 
 if __name__ == "__main__":
     jpg_file = input("Please enter the JPEG file path to process (including .jpg): ").strip()
@@ -0,0 +1,140 @@
+import os
+import json
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw
+from Blocks import GRAY_THRESHOLD
+from Folders import JPEG_PATTERNS, iter_files
+
+TRIAGE_FOLDER = "Triage"  # Written in the triaged folder unless another one is given
+REPORT_NAME = "triage.jsonl"
+SCALE = 8  # At 1/8 the decoder only computes the DC of each block, so every preview pixel is one 8x8 block
+CELL_SIZE = (240, 180)
+LABEL_HEIGHT = 16
+COLUMNS = 8
+ROWS = 6
+SHEET_QUALITY = 85
+# Mean difference between neighbouring pixels of random bytes; data decoded out of sync looks like noise
+NOISE_ROUGHNESS = 85.0
+
+
+# Function to decode a JPEG at 1/scale of its size, letting the decoder skip most of the IDCT work;
+# returns (preview as an RGB image, full width, full height)
+def load_preview(path, scale=SCALE):
+    with Image.open(path) as im:
+        width, height = im.size
+        im.draft(im.mode, (max(1, width // scale), max(1, height // scale)))
+        im.load()
+        preview = im.convert("RGB") if im.mode != "RGB" else im.copy()
+    return preview, width, height
+
+
+# Function to get the height left after cutting the rows at the bottom that are one flat colour. Missing data
+# decodes to mid grey, which the color stage may since have turned into any other flat colour
+def flat_tail_height(data):
+    fill = data[-1, -1]
+    flat = (data == fill).reshape(data.shape[0], -1).all(axis=1)
+    non_flat = np.flatnonzero(~flat)
+    return int(non_flat[-1]) + 1 if non_flat.size else 0
+
+
+# Function to score how damaged a repair looks from its preview, between 0 (clean) and 1. Missing data leaves
+# a flat tail and data read out of sync block noise; the score is the larger of the two fractions. At scale 8
+# "gray_blocks" counts the 8x8 blocks of the last good row that look like the tail, as auto_detect_shift does
+def score_preview(preview, scale=SCALE):
+    data = np.asarray(preview)
+    height = data.shape[0]
+    good_height = flat_tail_height(data)
+    flat_tail = 1 - good_height / height
+
+    gray_blocks = 0
+    if 0 < good_height < height:
+        deviation = np.abs(data[good_height - 1].astype(np.int16) - data[-1, -1]).mean(axis=-1)
+        gray_blocks = int(np.count_nonzero(deviation < GRAY_THRESHOLD))
+
+    good = data[:good_height].astype(np.int16)
+    if good.shape[0] > 1 and good.shape[1] > 1:
+        roughness = (np.abs(np.diff(good, axis=0)).mean() + np.abs(np.diff(good, axis=1)).mean()) / 2
+    else:
+        roughness = 0.0
+    noise = min(1.0, float(roughness) / NOISE_ROUGHNESS)
+
+    return {"score": round(max(flat_tail, noise), 4), "flat_tail": round(flat_tail, 4), "noise": round(noise, 4),
+            "gray_blocks": gray_blocks}
+
+
+# Function to triage one file, returns its report entry and its preview (None when it cannot be decoded)
+def triage_file(path, scale=SCALE):
+    try:
+        preview, width, height = load_preview(path, scale)
+    except Exception as e:
+        return {"file": path, "score": 1.0, "error": str(e)}, None
+    entry = {"file": path, "width": width, "height": height}
+    entry.update(score_preview(preview, scale))
+    return entry, preview
+
+
+# Function to draw one contact sheet cell: the preview fitted into the cell and a label with its name and score
+def draw_cell(sheet, draw, position, preview, entry, folder):
+    x, y = position
+    if preview is not None:
+        thumbnail = preview.copy()
+        thumbnail.thumbnail(CELL_SIZE)
+        sheet.paste(thumbnail, (x + (CELL_SIZE[0] - thumbnail.width) // 2, y + (CELL_SIZE[1] - thumbnail.height) // 2))
+    name = os.path.relpath(entry["file"], folder)
+    label = f"{entry['score']:.2f} {name}"
+    draw.text((x + 2, y + CELL_SIZE[1] + 2), label[:40], fill=(255, 64, 64) if entry["score"] >= 0.5 else (255, 255, 255))
+
+
+# Function to triage the JPEG files of a folder: a report line per file and contact sheets of their previews,
+# the most damaged first; returns the report entries in that order
+def triage_folder(folder, output_folder=None, recursive=False, scale=SCALE, columns=COLUMNS, rows=ROWS, jobs=1):
+    output_folder = output_folder or os.path.join(folder, TRIAGE_FOLDER)
+    os.makedirs(output_folder, exist_ok=True)
+    skipped = (TRIAGE_FOLDER, os.path.basename(os.path.normpath(output_folder)))
+
+    # Previews are small, about 1/64 of the pixels, so a batch of them is held until it is sorted
+    paths = iter_files(folder, JPEG_PATTERNS, recursive, skipped_folders=skipped)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(triage_file, paths, itertools.repeat(scale), chunksize=16))
+    else:
+        results = [triage_file(path, scale) for path in paths]
+    results.sort(key=lambda result: result[0]["score"], reverse=True)
+
+    per_sheet = columns * rows
+    cell_width, cell_height = CELL_SIZE[0], CELL_SIZE[1] + LABEL_HEIGHT
+    for first in range(0, len(results), per_sheet):
+        sheet = Image.new("RGB", (columns * cell_width, rows * cell_height))
+        draw = ImageDraw.Draw(sheet)
+        sheet_name = f"contact_{first // per_sheet + 1:04d}.jpg"
+        for index, (entry, preview) in enumerate(results[first:first + per_sheet]):
+            draw_cell(sheet, draw, ((index % columns) * cell_width, (index // columns) * cell_height), preview, entry, folder)
+            entry["sheet"] = sheet_name
+        sheet.save(os.path.join(output_folder, sheet_name), quality=SHEET_QUALITY)
+
+    with open(os.path.join(output_folder, REPORT_NAME), 'w', encoding='utf-8') as report_file:
+        for entry, _ in results:
+            report_file.write(json.dumps(entry) + "\n")
+    return [entry for entry, _ in results]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score repaired JPEG files from downscaled previews and draw contact sheets.")
+    parser.add_argument("folder", help="folder of repaired JPEG files, e.g. the Repaired folder")
+    parser.add_argument("-o", "--output", help=f"folder for the report and the sheets (default: FOLDER/{TRIAGE_FOLDER})")
+    parser.add_argument("-R", "--recursive", action="store_true", help="also triage the subfolders")
+    parser.add_argument("-s", "--scale", type=int, choices=(1, 2, 4, 8), default=SCALE,
+                        help="decode at 1/SCALE of the size (default: 8)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes (default: 1)")
+    parser.add_argument("--columns", type=int, default=COLUMNS, help=f"previews per sheet row (default: {COLUMNS})")
+    parser.add_argument("--rows", type=int, default=ROWS, help=f"preview rows per sheet (default: {ROWS})")
+    args = parser.parse_args()
+
+    entries = triage_folder(args.folder, args.output, args.recursive, args.scale, args.columns, args.rows, args.jobs)
+    damaged = sum(1 for entry in entries if entry["score"] >= 0.5)
+    print(f"Triaged {len(entries)} files, {damaged} look damaged (score >= 0.5)")
+    for entry in entries[:10]:
+        print(f"  {entry['score']:.2f} {entry['file']}" + (f" ({entry['error']})" if "error" in entry else ""))
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Folders import JPEG_PATTERNS, iter_files
+
+POLL_INTERVAL = 2.0  # Seconds between two listings of the drop folders
+STABLE_POLLS = 2  # Listings in a row a file must keep its size and mtime in before it counts as fully written
+THROUGHPUT_WINDOW = 300  # Seconds of finished files the throughput is averaged over
+STATUS_NAME = "status.json"  # Written in the first watched folder's Repaired folder unless another path is given
+
+
+# Polls drop folders for files that have stopped growing. A file copied in over hours keeps changing size or
+# mtime until the copy is done, so it is only handed out once STABLE_POLLS listings in a row agree on both;
+# a file written again later with other contents is handed out again
+class DropFolderWatcher:
+    def __init__(self, folder, patterns=JPEG_PATTERNS, recursive=False, min_size=0, stable_polls=STABLE_POLLS):
+        self.folder = folder
+        self.patterns = patterns
+        self.recursive = recursive
+        self.min_size = min_size
+        self.stable_polls = stable_polls
+        self.pending = {}  # path: ((size, mtime_ns), listings in a row it was seen with them)
+        self.handed_out = {}  # path: (size, mtime_ns) when it was handed out
+
+    # Function to list the folder once, returns the paths of the files that became fully written since the last call
+    def poll(self):
+        ready = []
+        listed = set()
+        for path in iter_files(self.folder, self.patterns, self.recursive, self.min_size):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Removed since the listing
+            listed.add(path)
+            state = (stat.st_size, stat.st_mtime_ns)
+            if self.handed_out.get(path) == state:
+                continue
+
+            previous, polls = self.pending.get(path, (None, 0))
+            polls = polls + 1 if previous == state else 1
+            if polls >= self.stable_polls:
+                self.pending.pop(path, None)
+                self.handed_out[path] = state
+                ready.append(path)
+            else:
+                self.pending[path] = (state, polls)
+
+        # Forget files that were moved away, so one copied in again under the same name is picked up
+        for path in [path for path in self.pending if path not in listed]:
+            del self.pending[path]
+        for path in [path for path in self.handed_out if path not in listed]:
+            del self.handed_out[path]
+        return ready
+
+    # Files seen but not yet fully written
+    def growing(self):
+        return len(self.pending)
+
+
+# Queue depth and throughput of a running service, written to a JSON status file and served over local HTTP
+class ServiceStatus:
+    def __init__(self, folders, path=None, port=None):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.path = path  # JSON status file, rewritten whole on every update, None for none
+        self.counts = {"folders": list(folders), "growing": 0, "queued": 0, "in_flight": 0,
+                       "processed": 0, "skipped": 0, "failed": 0, "last_file": None}
+        self.finished = deque()  # (time, seconds from queued to done) of the files processed in the window
+        self.server = None
+        if port is not None:
+            self.serve(port)
+
+    # Function to update some counts, e.g. update(queued=3), and write the status file
+    def update(self, **counts):
+        with self.lock:
+            self.counts.update(counts)
+        self.write()
+
+    # Function to record a file that left the queue; outcome is "processed", "skipped" or "failed"
+    def finish(self, path, outcome, seconds):
+        now = time.time()
+        with self.lock:
+            self.counts[outcome] += 1
+            self.counts["last_file"] = path
+            if outcome == "processed":
+                self.finished.append((now, seconds))
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            while self.finished and self.finished[0][0] < now - THROUGHPUT_WINDOW:
+                self.finished.popleft()
+            window = min(THROUGHPUT_WINDOW, max(now - self.started, 1e-9))
+            snapshot = dict(self.counts)
+            snapshot.update(started=self.started, updated=now, uptime_s=round(now - self.started, 1),
+                            files_per_minute=round(len(self.finished) * 60 / window, 2),
+                            mean_turnaround_s=round(sum(seconds for _, seconds in self.finished) / len(self.finished), 3)
+                            if self.finished else None)
+        return snapshot
+
+    def write(self):
+        if self.path is None:
+            return
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as status_file:
+                json.dump(self.snapshot(), status_file, indent=1, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass  # A status file that cannot be written does not stop the service
+
+    # Function to serve the snapshot as JSON on http://127.0.0.1:port/ from a background thread
+    def serve(self, port):
+        status = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(status.snapshot(), sort_keys=True).encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Pollers hit the endpoint every few seconds; keep their requests out of the log
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), StatusHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
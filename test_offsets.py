@@ -0,0 +1,62 @@
+import sys
+import shutil
+import importlib.util
+import numpy as np
+import pytest
+from PIL import Image
+from Corpus import START_OFFSET, TRAILER_SIZE, make_corpus, size_paths
+from Offsets import batch_offsets
+from Folders import iter_files
+
+
+# Function to load All-in-one.py, whose name is not importable; workers unpickle its functions as "aio"
+def load_all_in_one():
+    if "aio" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("aio", "All-in-one.py")
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["aio"] = module
+        spec.loader.exec_module(module)
+    return sys.modules["aio"]
+
+
+# Function to build a corpus whose files encode well past the encrypted prefix
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    output = tmp_path_factory.mktemp("corpus")
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:600, 0:800]
+    pixels = np.stack([x * 255 // 800, y * 255 // 600, (x ^ y) % 256], axis=2) + rng.integers(0, 64, (600, 800, 3))
+    source = output / "source.png"
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(source)
+    make_corpus(str(source), str(output), sizes=((1600, 1200),), count=8)
+    return size_paths(str(output), (1600, 1200))[0]
+
+
+def test_batch_range_holds_the_boundary(corpus):
+    estimate = batch_offsets(list(iter_files(corpus)))
+    assert estimate["prefix_low"] <= START_OFFSET <= estimate["prefix_high"]
+    assert estimate["trailer_length"] == TRAILER_SIZE
+    assert estimate["trailer_confidence"] == 1.0
+
+
+def test_detection_never_applies_a_wrong_start(corpus):
+    aio = load_all_in_one()
+    processor = aio.ImageProcessor(start_offset=0, trailer_size=0)
+    estimate = processor.detect_offsets(corpus)
+
+    # The start is only taken when it is certain, so it is either exact or left alone
+    assert processor.start_offset in (START_OFFSET, 0)
+    assert processor.start_offset == START_OFFSET or estimate["prefix_confidence"] < aio.OFFSET_CONFIDENCE
+    assert processor.trailer_size == TRAILER_SIZE
+
+
+@pytest.mark.parametrize("archive_format", ["zip", "gztar"])
+def test_detection_samples_archive_members(corpus, tmp_path, archive_format):
+    aio = load_all_in_one()
+    archive = shutil.make_archive(str(tmp_path / "corpus"), archive_format, corpus)
+    processor = aio.ImageProcessor(start_offset=0, trailer_size=0)
+    estimate = processor.detect_offsets(archive)
+
+    assert estimate["files"] == 8
+    assert estimate["prefix_low"] <= START_OFFSET <= estimate["prefix_high"]
+    assert processor.trailer_size == TRAILER_SIZE
@@ -0,0 +1,44 @@
+import io
+import numpy as np
+import pytest
+from PIL import Image
+from Scan import EntropyScan, locate_corruption, shift_mcus
+
+
+# Function to encode the same pixels twice, without and with restart markers, so both scans hold the same blocks
+def encode_pair(subsampling):
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:240, 0:320]
+    pixels = np.stack([x * 255 // 320, y * 255 // 240, (x + y) % 256], axis=2) + rng.integers(0, 32, (240, 320, 3))
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    plain, restarts = io.BytesIO(), io.BytesIO()
+    img.save(plain, "JPEG", quality=90, subsampling=subsampling)
+    img.save(restarts, "JPEG", quality=90, subsampling=subsampling, restart_marker_blocks=7)
+    return plain.getvalue(), restarts.getvalue()
+
+
+def decode(data):
+    return np.asarray(Image.open(io.BytesIO(data)))
+
+
+@pytest.mark.parametrize("subsampling", [0, 2])
+@pytest.mark.parametrize("count, position", [(5, 0), (123, 0), (40, 57)])
+def test_insert_with_restart_markers_matches_plain_scan(subsampling, count, position):
+    plain, restarts = encode_pair(subsampling)
+    assert EntropyScan(restarts).restart_interval == 7
+
+    shifted = shift_mcus(restarts, count, position)
+    assert np.array_equal(decode(shifted), decode(shift_mcus(plain, count, position)))
+    assert locate_corruption(shifted, stop=False)["mcu"] is None
+
+
+@pytest.mark.parametrize("subsampling", [0, 2])
+def test_delete_with_restart_markers_matches_plain_scan(subsampling):
+    plain, restarts = encode_pair(subsampling)
+    scan = EntropyScan(restarts)
+
+    # Both scans end early after a delete; decoders fill the tail differently past an RSTn, so only the rows
+    # above the last MCU row and the row chroma upsampling reads below them are compared
+    shifted, expected = decode(shift_mcus(restarts, -9, 100)), decode(shift_mcus(plain, -9, 100))
+    rows = (scan.mcu_rows - 1) * scan.mcu_height - 1
+    assert np.array_equal(shifted[:rows], expected[:rows])